@@ -0,0 +1,105 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BULK_ITEM = b'{"index":{"_id":"benchmark","status":201}}'
+
+
+# answers just enough of the elasticsearch- and cf-api to run the exporter in-process and offline:
+# bulk-requests, checkpoint-updates and the graphql-query (always answered with the same response)
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # headers and body are written separately - without this, delayed ACKs stall every keep-alive request
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send(self, body, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._send(b"")
+
+    def do_GET(self):
+        self._send(b'{"version":{"number":"8.4.2"},"tagline":"You Know, for Search"}')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0]
+        if path.endswith("/_bulk"):
+            self.server.record_bulk(len(body))
+            # every document consists of an action- and a source-line
+            items = b",".join([BULK_ITEM] * (body.count(b"\n") // 2))
+            self._send(b'{"took":1,"errors":false,"items":[' + items + b"]}")
+        elif "/_update/" in path:
+            self._send(b'{"result":"updated"}')
+        elif path.endswith("/graphql"):
+            self._send(self.server.graphql_response)
+        else:
+            self._send(b'{"error":"not supported"}', status=404)
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(object):
+
+    def __init__(self, cf_response=None):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeRequestHandler)
+        self.server.graphql_response = json.dumps({"data": cf_response or {}}).encode("utf-8")
+        self.server.record_bulk = self._record_bulk
+        self.lock = threading.Lock()
+        self.bulk_requests = 0
+        self.bulk_bytes = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-server", daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _record_bulk(self, amount):
+        with self.lock:
+            self.bulk_requests += 1
+            self.bulk_bytes += amount
+
+    def reset(self):
+        with self.lock:
+            self.bulk_requests = 0
+            self.bulk_bytes = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,96 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import random
+
+COUNTRIES = ["DE", "US", "NL", "FR", "GB", "AT", "CH", "IT", "ES", "PL", "SE", "DK", "BE", "CZ", "SG", "JP", "CN", "IN",
+             "BR", "CA", "AU", "RU", "UA", "TR", "IE", "FI", "NO", "PT", "HU", "RO"]
+STATUS_CODES = [200, 204, 206, 301, 302, 304, 400, 401, 403, 404, 405, 410, 429, 499, 500, 502, 503, 504, 520, 522]
+BROWSERS = ["Chrome", "Safari", "Firefox", "Edge", "ChromeMobile", "MobileSafari", "SamsungInternet", "Opera",
+            "ChromeMobileWebview", "Unknown"]
+CONTENT_TYPES = ["html", "js", "css", "json", "png", "jpeg", "gif", "svg", "webp", "woff2", "bin", "txt", "xml",
+                 "empty"]
+SSL_VERSIONS = ["none", "TLSv1.2", "TLSv1.3"]
+HTTP_VERSIONS = ["HTTP/1.1", "HTTP/2", "HTTP/3"]
+IP_CLASSES = ["unknown", "noRecord", "searchEngine", "badHost"]
+
+
+def _keys(values, amount, prefix):
+    keys = values[:amount]
+    keys.extend(f"{prefix}{i}" for i in range(len(keys), amount))
+    return keys
+
+
+def create_zone_tags(zones):
+    return [f"{i:032x}" for i in range(zones)]
+
+
+def create_zone_mapping(zones):
+    return {zone_tag: f"zone{i}.tld" for i, zone_tag in enumerate(create_zone_tags(zones))}
+
+
+# builds a cf-api response ("viewer.zones[].httpRequests1mGroups[]") with one data-group per zone and minute,
+# the maps contain the given amount of keys (filled up with synthetic keys beyond the realistic ones)
+def create_response(zones=10, minutes=60, countries=20, status_codes=10, browsers=8, content_types=10,
+                    start=datetime.datetime(2022, 9, 20, 12, 0), seed=42):
+    rnd = random.Random(seed)
+    country_keys = _keys(COUNTRIES, countries, "X")
+    status_keys = _keys(STATUS_CODES, status_codes, 600)
+    browser_keys = _keys(BROWSERS, browsers, "Browser")
+    content_type_keys = _keys(CONTENT_TYPES, content_types, "type")
+
+    result = []
+    for zone_tag in create_zone_tags(zones):
+        groups = []
+        for minute in range(minutes):
+            timestamp = start + datetime.timedelta(minutes=minute)
+            requests = rnd.randint(1000, 100000)
+            groups.append({
+                "dimensions": {"datetime": timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")},
+                "uniq": {"uniques": rnd.randint(10, requests)},
+                "sum": {
+                    "browserMap": [{"pageViews": rnd.randint(0, 1000), "uaBrowserFamily": key} for key in browser_keys],
+                    "bytes": requests * 2048,
+                    "cachedBytes": requests * 1024,
+                    "cachedRequests": requests // 2,
+                    "clientHTTPVersionMap": [{"clientHTTPProtocol": key, "requests": rnd.randint(0, requests)}
+                                             for key in HTTP_VERSIONS],
+                    "clientSSLMap": [{"clientSSLProtocol": key, "requests": rnd.randint(0, requests)}
+                                     for key in SSL_VERSIONS],
+                    "contentTypeMap": [{"bytes": rnd.randint(0, 10 ** 7), "edgeResponseContentTypeName": key,
+                                        "requests": rnd.randint(0, requests)} for key in content_type_keys],
+                    "countryMap": [{"bytes": rnd.randint(0, 10 ** 7), "clientCountryName": key,
+                                    "requests": rnd.randint(0, requests), "threats": 0} for key in country_keys],
+                    "encryptedBytes": requests * 2000,
+                    "encryptedRequests": requests - 10,
+                    "ipClassMap": [{"ipType": key, "requests": rnd.randint(0, requests)} for key in IP_CLASSES],
+                    "pageViews": requests // 10,
+                    "requests": requests,
+                    "responseStatusMap": [{"edgeResponseStatus": key, "requests": rnd.randint(0, requests)}
+                                          for key in status_keys]
+                }
+            })
+        result.append({"zoneTag": zone_tag, "httpRequests1mGroups": groups})
+
+    return {"viewer": {"zones": result}}
+
+
+# documents per data-group: base + responseStatus + country + sslVersion + browser + contentType
+def expected_doc_amount(zones=10, minutes=60, countries=20, status_codes=10, browsers=8, content_types=10):
+    return zones * minutes * (1 + status_codes + countries + len(SSL_VERSIONS) + browsers + content_types)
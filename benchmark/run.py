@@ -0,0 +1,218 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from elasticsearch import Elasticsearch
+from benchmark import generator
+from benchmark.fake_server import FakeServer
+from cloudflare import analytics_api
+from cloudflare import columnar
+from cloudflare import config
+from cloudflare import main
+from cloudflare import records
+from cloudflare.bulk_writer import BulkWriter
+from cloudflare.datastore import DataStore
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+
+class Stage(object):
+
+    def __init__(self, name, prepare, run, byte_amount):
+        self.name = name
+        self.prepare = prepare
+        self.run = run
+        self.byte_amount = byte_amount
+
+
+def _measure(stage, repeat):
+    durations = []
+    doc_amount = 0
+    for _ in range(repeat):
+        data = stage.prepare()
+        gc.collect()
+        start = time.perf_counter()
+        doc_amount = stage.run(data)
+        durations.append(time.perf_counter() - start)
+    byte_amount = stage.byte_amount()
+
+    # tracing allocations slows everything down - so peak memory is measured in a separate run
+    data = stage.prepare()
+    gc.collect()
+    tracemalloc.start()
+    stage.run(data)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = min(durations)
+    return {"docs": doc_amount, "seconds": round(best, 4), "docs_per_second": round(doc_amount / best),
+            "bytes_per_second": round(byte_amount / best), "peak_memory_bytes": peak_memory}
+
+
+def _count(docs):
+    return sum(1 for _ in docs)
+
+
+def create_stages(response, fake_server, storage, cf_client):
+    payload_bytes = len(json.dumps(response))
+    normalized = list(analytics_api.normalize_data(response))
+    serialized = {}
+    start_datetime = datetime.datetime(2022, 9, 20, 12, 0)
+    end_datetime = start_datetime + datetime.timedelta(minutes=60)
+
+    def serialize(docs):
+        writer = records.BulkBodyWriter(config.es_cf_index, config.es_document_op_type, config.es_bulk_max_chunk_bytes)
+        serialized["bytes"] = 0
+        doc_amount = 0
+        for body, amount in writer.chunks(docs):
+            serialized["bytes"] += len(body)
+            doc_amount += amount
+        return doc_amount
+
+    def store(fast_path):
+        def run(docs):
+            config.es_bulk_fast_path = fast_path
+            return storage.store_documents(docs)
+        return run
+
+    def prepare_store():
+        fake_server.reset()
+        return normalized
+
+    def fetch_and_push(_):
+        result = cf_client.fetch_raw(start_datetime, end_datetime)
+        main.index_window(result, start_datetime, end_datetime, storage)
+        return len(normalized)
+
+    return [
+        Stage("normalize", lambda: response, lambda data: _count(analytics_api.normalize_data(data)),
+              lambda: payload_bytes),
+        Stage("normalize_columnar", lambda: response, lambda data: _count(columnar.normalize_data(data)),
+              lambda: payload_bytes),
+        Stage("serialize", lambda: normalized, serialize, lambda: serialized["bytes"]),
+        Stage("store_documents", prepare_store, store(True), lambda: fake_server.bulk_bytes),
+        Stage("store_documents_streaming", prepare_store, store(False), lambda: fake_server.bulk_bytes),
+        Stage("fetch_and_push", prepare_store, fetch_and_push, lambda: fake_server.bulk_bytes),
+    ]
+
+
+def scenario_key(args):
+    return f"zones={args.zones},minutes={args.minutes},countries={args.countries},status_codes={args.status_codes}"
+
+
+def check_baseline(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result.get("docs_per_second") < expected.get("docs_per_second") * (1 - tolerance):
+            regressions.append(f"{name}: {result.get('docs_per_second')} docs/s "
+                               f"(baseline {expected.get('docs_per_second')} docs/s)")
+        if result.get("peak_memory_bytes") > expected.get("peak_memory_bytes") * (1 + tolerance):
+            regressions.append(f"{name}: {result.get('peak_memory_bytes')} bytes peak memory "
+                               f"(baseline {expected.get('peak_memory_bytes')} bytes)")
+    return regressions
+
+
+def read_baselines():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE, "r") as f:
+        return json.load(f)
+
+
+def write_baselines(baselines):
+    with open(BASELINE_FILE, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="offline benchmark of the exporter stages")
+    parser.add_argument("--zones", type=int, default=10)
+    parser.add_argument("--minutes", type=int, default=60)
+    parser.add_argument("--countries", type=int, default=20)
+    parser.add_argument("--status-codes", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", nargs="*", help="run only these stages")
+    parser.add_argument("--check", action="store_true", help="fail, if a stage is slower than its baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as new baseline")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    response = generator.create_response(zones=args.zones, minutes=args.minutes, countries=args.countries,
+                                         status_codes=args.status_codes)
+    fake_server = FakeServer(response).start()
+
+    config.zones = generator.create_zone_mapping(args.zones)
+    config.cf_api_endpoint = f"{fake_server.url}/graphql"
+    config.cf_max_zones_per_query = args.zones
+    config.cf_query_limit = args.zones * args.minutes
+    config.es_rollup_enabled = False
+    storage = DataStore()
+    storage.es = Elasticsearch(fake_server.url)
+    storage.bulk_writer = BulkWriter(storage.es)
+    cf_client = analytics_api.AnalyticsClient()
+    cf_client.connect()
+
+    results = {}
+    try:
+        for stage in create_stages(response, fake_server, storage, cf_client):
+            if args.stages and stage.name not in args.stages:
+                continue
+            results[stage.name] = result = _measure(stage, args.repeat)
+            print(f"{stage.name:<28}{result.get('docs'):>10} docs {result.get('docs_per_second'):>12} docs/s "
+                  f"{result.get('bytes_per_second') / 1048576:>10.1f} MiB/s "
+                  f"{result.get('peak_memory_bytes') / 1048576:>10.1f} MiB peak")
+    finally:
+        cf_client.close()
+        fake_server.stop()
+
+    baselines = read_baselines()
+    key = scenario_key(args)
+    if args.update_baseline:
+        baselines[key] = {**baselines.get(key, {}), **results}
+        write_baselines(baselines)
+        print(f"stored baseline for {key}")
+
+    if args.check:
+        if key not in baselines:
+            print(f"no baseline for {key}")
+            return 1
+        regressions = check_baseline(results, baselines.get(key), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
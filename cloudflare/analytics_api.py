@@ -17,15 +17,27 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import math
 import os
+import time
 import gql
 
 import gql.transport.requests as gql_transport
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter, Retry
+from cloudflare import capture
+from cloudflare import columnar
 from cloudflare import config
+from cloudflare import metrics
+from cloudflare import rate_limit
+from cloudflare import records
 from cloudflare.datetime_helper import DateTimeHelper
 
 
 dt_helper = DateTimeHelper()
+SELECTION_MARKER = "__SELECTION__"
+# the quota is per user - all clients of this process share one budget
+cf_rate_limiter = rate_limit.create_bucket()
 
 
 def read_gql_query_from_file(filename):
@@ -36,108 +48,295 @@ def read_gql_query_from_file(filename):
 
 
 def _create_doc_internal(zone_tag, timestamp, data_type, data_key, uniques=0, bytes=0, cached_bytes=0,
-                         cached_requests=0, encrypted_bytes=0, encrypted_requests=0, page_views=0, requests=0):
-    doc = {
-        "dataType": data_type,
-        "dataKey": data_key,
-        "zoneTag": zone_tag,
-        "zoneName": config.zones.get(zone_tag),
-        "@timestamp": timestamp,
-        "uniques": uniques,
-        "bytes": bytes,
-        "cachedBytes": cached_bytes,
-        "cachedRequests": cached_requests,
-        "encryptedBytes": encrypted_bytes,
-        "encryptedRequests": encrypted_requests,
-        "pageViews": page_views,
-        "requests": requests
-    }
-    return doc
-
-
-def create_doc_base(zone_tag, data_group, timestamp):
+                         cached_requests=0, encrypted_bytes=0, encrypted_requests=0, page_views=0, requests=0,
+                         timestamp_str=None):
+    if timestamp_str is None:
+        timestamp_str = timestamp.strftime(records.DATETIME_FORMAT)
+    return records.AnalyticsRecord(data_type, records.intern_key(data_key), records.intern_key(zone_tag),
+                                   records.intern_key(config.zones.get(zone_tag)), timestamp, timestamp_str,
+                                   uniques=uniques, bytes=bytes, cached_bytes=cached_bytes,
+                                   cached_requests=cached_requests, encrypted_bytes=encrypted_bytes,
+                                   encrypted_requests=encrypted_requests, page_views=page_views, requests=requests)
+
+
+def reduce_to_top_n(entries, data_type, key_field, rank_field, sum_fields):
+    top_n = config.cf_top_n.get(data_type, 0)
+    if top_n <= 0 or len(entries) <= top_n:
+        return entries
+
+    ranked = sorted(entries, key=lambda entry: entry.get(rank_field) or 0, reverse=True)
+    other = {key_field: config.cf_top_n_other_key}
+    for field in sum_fields:
+        other[field] = sum(entry.get(field) or 0 for entry in ranked[top_n:])
+
+    return ranked[:top_n] + [other]
+
+
+def create_doc_base(zone_tag, data_group, timestamp, timestamp_str=None):
     sums = data_group.get("sum")
     return _create_doc_internal(zone_tag, timestamp, "base", "base", uniques=data_group.get("uniq").get("uniques"),
                                 bytes=sums.get("bytes"), cached_bytes=sums.get("cachedBytes"),
                                 cached_requests=sums.get("cachedRequests"),
                                 encrypted_bytes=sums.get("encryptedBytes"),
                                 encrypted_requests=sums.get("encryptedRequests"), page_views=sums.get("pageViews"),
-                                requests=sums.get("requests"))
+                                requests=sums.get("requests"), timestamp_str=timestamp_str)
+
 
+def create_docs_base(zone_tag, data_group, timestamp, timestamp_str=None):
+    yield create_doc_base(zone_tag, data_group, timestamp, timestamp_str)
 
-def create_docs_responsestatus(zone_tag, data_group, timestamp):
-    docs = []
+
+def create_docs_responsestatus(zone_tag, data_group, timestamp, timestamp_str=None):
     for entry in data_group.get("sum").get("responseStatusMap"):
-        docs.append(_create_doc_internal(zone_tag, timestamp, "responseStatus", entry.get("edgeResponseStatus"),
-                                         requests=entry.get("requests")))
-    return docs
+        yield _create_doc_internal(zone_tag, timestamp, "responseStatus", entry.get("edgeResponseStatus"),
+                                   requests=entry.get("requests"), timestamp_str=timestamp_str)
 
 
-def create_docs_country(zone_tag, data_group, timestamp):
-    docs = []
-    for entry in data_group.get("sum").get("countryMap"):
-        docs.append(_create_doc_internal(zone_tag, timestamp, "country", entry.get("clientCountryName"),
-                                         requests=entry.get("requests"), bytes=entry.get("bytes")))
-    return docs
+def create_docs_country(zone_tag, data_group, timestamp, timestamp_str=None):
+    entries = reduce_to_top_n(data_group.get("sum").get("countryMap"), "country", "clientCountryName",
+                              "requests", ["requests", "bytes"])
+    for entry in entries:
+        yield _create_doc_internal(zone_tag, timestamp, "country", entry.get("clientCountryName"),
+                                   requests=entry.get("requests"), bytes=entry.get("bytes"),
+                                   timestamp_str=timestamp_str)
 
 
-def create_docs_sslversion(zone_tag, data_group, timestamp):
-    docs = []
+def create_docs_sslversion(zone_tag, data_group, timestamp, timestamp_str=None):
     for entry in data_group.get("sum").get("clientSSLMap"):
-        docs.append(_create_doc_internal(zone_tag, timestamp, "sslVersion", entry.get("clientSSLProtocol"),
-                                         requests=entry.get("requests")))
-    return docs
+        yield _create_doc_internal(zone_tag, timestamp, "sslVersion", entry.get("clientSSLProtocol"),
+                                   requests=entry.get("requests"), timestamp_str=timestamp_str)
+
+
+def create_docs_browsers(zone_tag, data_group, timestamp, timestamp_str=None):
+    entries = reduce_to_top_n(data_group.get("sum").get("browserMap"), "browser", "uaBrowserFamily",
+                              "pageViews", ["pageViews"])
+    for entry in entries:
+        yield _create_doc_internal(zone_tag, timestamp, "browser", entry.get("uaBrowserFamily"),
+                                   page_views=entry.get("pageViews"), timestamp_str=timestamp_str)
+
+
+def create_docs_contenttype(zone_tag, data_group, timestamp, timestamp_str=None):
+    entries = reduce_to_top_n(data_group.get("sum").get("contentTypeMap"), "contentType",
+                              "edgeResponseContentTypeName", "requests", ["requests", "bytes"])
+    for entry in entries:
+        yield _create_doc_internal(zone_tag, timestamp, "contentType", entry.get("edgeResponseContentTypeName"),
+                                   requests=entry.get("requests"), bytes=entry.get("bytes"),
+                                   timestamp_str=timestamp_str)
+
+
+def create_docs_httpversion(zone_tag, data_group, timestamp, timestamp_str=None):
+    for entry in data_group.get("sum").get("clientHTTPVersionMap"):
+        yield _create_doc_internal(zone_tag, timestamp, "httpVersion", entry.get("clientHTTPProtocol"),
+                                   requests=entry.get("requests"), timestamp_str=timestamp_str)
+
+
+def create_docs_ipclass(zone_tag, data_group, timestamp, timestamp_str=None):
+    for entry in data_group.get("sum").get("ipClassMap"):
+        yield _create_doc_internal(zone_tag, timestamp, "ipClass", entry.get("ipType"),
+                                   requests=entry.get("requests"), timestamp_str=timestamp_str)
+
+
+def map_fields(map_name, fields):
+    return [f"sum.{map_name}.{field}" for field in fields]
+
+
+# a dataType with the fields it needs from a httpRequests1mGroups data-group (as dotted paths) and its normalizer.
+# datasets read from a map of the data-group also describe the map, so the columnar normalizer can extract them
+class Dataset(object):
+
+    def __init__(self, data_type, fields, create_docs, map_name=None, key_field=None, value_fields=None,
+                 rank_field=None):
+        self.data_type = data_type
+        self.fields = fields
+        self.create_docs = create_docs
+        self.map_name = map_name
+        self.key_field = key_field
+        self.value_fields = value_fields
+        self.rank_field = rank_field
+
+
+# rank_field decides which entries are kept, if the dataType is reduced to its top-n (config.cf_top_n)
+def map_dataset(data_type, map_name, key_field, value_fields, create_docs, rank_field=None):
+    return Dataset(data_type, map_fields(map_name, [key_field] + value_fields), create_docs, map_name=map_name,
+                   key_field=key_field, value_fields=value_fields, rank_field=rank_field)
+
+
+# in the order the documents of a data-group are created
+DATASETS = [
+    Dataset("base", ["uniq.uniques"] + [f"sum.{field}" for field in [
+        "bytes", "cachedBytes", "cachedRequests", "encryptedBytes", "encryptedRequests", "pageViews", "requests"]],
+        create_docs_base),
+    map_dataset("responseStatus", "responseStatusMap", "edgeResponseStatus", ["requests"], create_docs_responsestatus),
+    map_dataset("country", "countryMap", "clientCountryName", ["requests", "bytes"], create_docs_country,
+                rank_field="requests"),
+    map_dataset("sslVersion", "clientSSLMap", "clientSSLProtocol", ["requests"], create_docs_sslversion),
+    map_dataset("browser", "browserMap", "uaBrowserFamily", ["pageViews"], create_docs_browsers,
+                rank_field="pageViews"),
+    map_dataset("contentType", "contentTypeMap", "edgeResponseContentTypeName", ["requests", "bytes"],
+                create_docs_contenttype, rank_field="requests"),
+    map_dataset("httpVersion", "clientHTTPVersionMap", "clientHTTPProtocol", ["requests"], create_docs_httpversion),
+    map_dataset("ipClass", "ipClassMap", "ipType", ["requests"], create_docs_ipclass)
+]
 
 
-def create_docs_browsers(zone_tag, data_group, timestamp):
-    docs = []
-    for entry in data_group.get("sum").get("browserMap"):
-        docs.append(_create_doc_internal(zone_tag, timestamp, "browser", entry.get("uaBrowserFamily"),
-                                         page_views=entry.get("pageViews")))
-    return docs
+def enabled_datasets():
+    return [dataset for dataset in DATASETS if dataset.data_type in config.cf_datasets]
 
 
-def create_docs_contenttype(zone_tag, data_group, timestamp):
-    docs = []
-    for entry in data_group.get("sum").get("contentTypeMap"):
-        docs.append(_create_doc_internal(zone_tag, timestamp, "contentType", entry.get("edgeResponseContentTypeName"),
-                                         requests=entry.get("requests"), bytes=entry.get("bytes")))
-    return docs
+def _render_selection(tree, indent):
+    lines = []
+    for name, children in tree.items():
+        if children:
+            lines.append(f"{indent}{name} {{")
+            lines.extend(_render_selection(children, indent + "\t"))
+            lines.append(f"{indent}}}")
+        else:
+            lines.append(f"{indent}{name}")
+    return lines
 
 
+# merges the fields of all given datasets into one selection - so only enabled datasets are paid for
+def build_query(datasets=None):
+    if datasets is None:
+        datasets = enabled_datasets()
+    tree = {}
+    for path in [field for dataset in datasets for field in dataset.fields] + ["dimensions.datetime"]:
+        node = tree
+        for name in path.split("."):
+            node = node.setdefault(name, {})
+
+    selection = "\n".join(_render_selection(tree, "\t\t\t\t"))
+    return read_gql_query_from_file(filename="zone-totals.graphql").replace(SELECTION_MARKER, selection)
+
+
+# documents are produced lazily, so a window never has to be held in memory as a whole
 def normalize_data(result):
-    docs = []
+    datasets = enabled_datasets()
     for item in result.get("viewer").get("zones"):
         for data_group in item.get("httpRequests1mGroups"):
             zone_tag = item.get('zoneTag')
             timestamp = datetime.datetime.strptime(data_group.get("dimensions").get("datetime"), "%Y-%m-%dT%H:%M:%SZ")
-            docs.append(create_doc_base(zone_tag, data_group, timestamp))
-            docs.extend(create_docs_responsestatus(zone_tag, data_group, timestamp))
-            docs.extend(create_docs_country(zone_tag, data_group, timestamp))
-            docs.extend(create_docs_sslversion(zone_tag, data_group, timestamp))
-            docs.extend(create_docs_browsers(zone_tag, data_group, timestamp))
-            docs.extend(create_docs_contenttype(zone_tag, data_group, timestamp))
+            timestamp_str = timestamp.strftime(records.DATETIME_FORMAT)
+            for dataset in datasets:
+                yield from dataset.create_docs(zone_tag, data_group, timestamp, timestamp_str)
+
 
-    return docs
+def normalize(result):
+    if config.cf_normalize_engine == "columnar":
+        return metrics.timed(columnar.normalize_data(result), metrics.normalize_duration)
 
+    return metrics.timed(normalize_data(result), metrics.normalize_duration)
 
-def fetch_cloudflare_analytics(ref_datetime):
-    cf_api_token = os.getenv(config.cf_api_token_env)
-    cf_headers = {"X-AUTH-EMAIL": config.cf_api_user, "Authorization": f"Bearer {cf_api_token}"}
-    transport = gql_transport.RequestsHTTPTransport(
-        url=config.cf_api_endpoint, verify=True, retries=3, headers=cf_headers)
 
-    client = gql.Client(transport=transport, fetch_schema_from_transport=False)
-    query = gql.gql(read_gql_query_from_file(filename="zone-totals.graphql"))
+# a single query must not return more rows (one per zone and minute) than the configured limit
+def determine_max_interval_in_seconds():
+    zones_per_query = max(1, min(len(config.zones), config.cf_max_zones_per_query))
+    max_minutes = max(1, config.cf_query_limit // zones_per_query)
+    return max_minutes * 60
+
+
+def determine_to_datetime(ref_datetime):
     to_datetime = dt_helper.determine_interval_datetime(ref_datetime)
-    parameters = {
-        "limit": 9999,
-        "mintime": dt_helper.format_datetime(ref_datetime),
-        "maxtime": dt_helper.format_datetime(to_datetime),
-        "zoneIDs": list(config.zones.keys())
-    }
+    if dt_helper.is_need_catchup(ref_datetime):
+        catchup_datetime = dt_helper.determine_catchup_interval_datetime(
+            ref_datetime, max_interval_in_seconds=determine_max_interval_in_seconds())
+        if catchup_datetime > to_datetime:
+            return catchup_datetime
+
+    return to_datetime
+
+
+def create_zone_batches(zone_ids, interval_in_seconds):
+    minutes = max(1, math.ceil(interval_in_seconds / 60))
+    batch_size = max(1, min(config.cf_query_limit // minutes, config.cf_max_zones_per_query))
+    return [zone_ids[i:i + batch_size] for i in range(0, len(zone_ids), batch_size)]
+
+
+def merge_results(results):
+    zones = []
+    for result in results:
+        zones.extend(result.get("viewer").get("zones"))
+
+    return {"viewer": {"zones": zones}}
+
+
+class AnalyticsClient(object):
+
+    def __init__(self):
+        cf_api_token = os.getenv(config.cf_api_token_env)
+        cf_headers = {"X-AUTH-EMAIL": config.cf_api_user, "Authorization": f"Bearer {cf_api_token}",
+                      "Accept-Encoding": "gzip"}
+        self.transport = gql_transport.RequestsHTTPTransport(
+            url=config.cf_api_endpoint, verify=True, headers=cf_headers)
+        self.client = gql.Client(transport=self.transport, fetch_schema_from_transport=False)
+        self.query = gql.gql(build_query())
+        self.session = None
+        self.rate_limiter = cf_rate_limiter
+        self.capture = capture.create_capture()
+
+    # the session (and thus the keep-alive connections) is shared by all fetches of this process.
+    # rate-limited queries (429, Retry-After) are never retried by the transport - every query costs one token and
+    # the throttling has to reach the rate-limiter
+    def connect(self):
+        self.session = self.client.connect_sync()
+        adapter = HTTPAdapter(pool_maxsize=config.cf_http_pool_size, max_retries=Retry(
+            total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504], allowed_methods=None,
+            respect_retry_after_header=False))
+        for prefix in "http://", "https://":
+            self.transport.session.mount(prefix, adapter)
+
+    def close(self):
+        self.client.close_sync()
+        self.session = None
+
+    def _fetch_zone_batch(self, ref_datetime, to_datetime, zone_ids):
+        parameters = {
+            "limit": config.cf_query_limit,
+            "mintime": dt_helper.format_datetime(ref_datetime),
+            "maxtime": dt_helper.format_datetime(to_datetime),
+            "zoneIDs": zone_ids
+        }
+
+        print(f"{datetime.datetime.now()} - query cf-api using fetch-parameters: {parameters}")
+        start = time.perf_counter()
+        result = self.execute(self.query, parameters)
+        metrics.fetched_zones.inc(len(zone_ids))
+        print(f"{datetime.datetime.now()} - fetched batch of {len(zone_ids)} zones in "
+              f"{time.perf_counter() - start:.3f}s: {zone_ids}")
+
+        return result
+
+    # every query of this process (whatever dataset) goes through the shared rate-limiter
+    def execute(self, query, parameters):
+        self.rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            result = self.session.execute(query, variable_values=parameters)
+        except Exception as e:
+            raise rate_limit.handle_error(self.rate_limiter, e)
+        metrics.fetch_duration.observe(time.perf_counter() - start)
+
+        return result
+
+    def fetch_cloudflare_analytics(self, ref_datetime, to_datetime=None, zone_ids=None):
+        return normalize(self.fetch_raw(ref_datetime, to_datetime, zone_ids))
+
+    def fetch_raw(self, ref_datetime, to_datetime=None, zone_ids=None):
+        if to_datetime is None:
+            to_datetime = dt_helper.determine_interval_datetime(ref_datetime)
+        if zone_ids is None:
+            zone_ids = list(config.zones.keys())
+        batches = create_zone_batches(zone_ids, (to_datetime - ref_datetime).total_seconds())
+
+        if len(batches) == 1:
+            results = [self._fetch_zone_batch(ref_datetime, to_datetime, batches[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(batches), config.cf_max_parallel_queries)) as executor:
+                results = list(executor.map(
+                    lambda batch: self._fetch_zone_batch(ref_datetime, to_datetime, batch), batches))
 
-    print(f"{datetime.datetime.now()} - query cf-api using fetch-parameters: {parameters}")
-    result = client.execute(query, variable_values=parameters)
+        result = merge_results(results)
+        if self.capture is not None:
+            self.capture.store(ref_datetime, to_datetime, zone_ids, result)
 
-    return normalize_data(result)
+        return result
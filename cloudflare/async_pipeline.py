@@ -0,0 +1,165 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import os
+import time
+import traceback
+import gql
+
+from gql.transport.aiohttp import AIOHTTPTransport
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk
+from cloudflare import analytics_api
+from cloudflare import backfill
+from cloudflare import capture
+from cloudflare import config
+from cloudflare import metrics
+from cloudflare import rate_limit
+from cloudflare.datastore import DataStore
+
+
+dt_helper = analytics_api.dt_helper
+
+
+# fetch, normalize and index run as separate stages connected by bounded queues,
+# so the next window is fetched while the current one is indexed
+class AsyncPipeline(object):
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.queue_size = config.async_queue_size
+        self.committed_datetime = None
+        self.es = None
+        self.client = None
+        self.session = None
+        self.query = gql.gql(analytics_api.build_query())
+        self.query_semaphore = None
+        self.rate_limiter = analytics_api.cf_rate_limiter
+        self.capture = capture.create_capture()
+
+    async def _connect(self):
+        self.es = AsyncElasticsearch(
+            f"https://{config.es_host}:{config.es_port}",
+            basic_auth=(config.es_user, self.storage.es_password)
+        )
+        cf_api_token = os.getenv(config.cf_api_token_env)
+        cf_headers = {"X-AUTH-EMAIL": config.cf_api_user, "Authorization": f"Bearer {cf_api_token}"}
+        self.client = gql.Client(transport=AIOHTTPTransport(url=config.cf_api_endpoint, headers=cf_headers),
+                                 fetch_schema_from_transport=False)
+        self.session = await self.client.connect_async()
+        self.query_semaphore = asyncio.Semaphore(config.cf_max_parallel_queries)
+
+    async def _close(self):
+        if self.client is not None:
+            await self.client.close_async()
+        if self.es is not None:
+            await self.es.close()
+
+    async def _fetch_zone_batch(self, ref_datetime, to_datetime, zone_ids):
+        parameters = {
+            "limit": config.cf_query_limit,
+            "mintime": dt_helper.format_datetime(ref_datetime),
+            "maxtime": dt_helper.format_datetime(to_datetime),
+            "zoneIDs": zone_ids
+        }
+
+        async with self.query_semaphore:
+            await self.rate_limiter.acquire_async()
+            start = time.perf_counter()
+            try:
+                result = await self.session.execute(self.query, variable_values=parameters)
+            except Exception as e:
+                raise rate_limit.handle_error(self.rate_limiter, e)
+            elapsed = time.perf_counter() - start
+            metrics.fetch_duration.observe(elapsed)
+            metrics.fetched_zones.inc(len(zone_ids))
+            print(f"{datetime.datetime.now()} - fetched batch of {len(zone_ids)} zones in {elapsed:.3f}s: {zone_ids}")
+
+        return result
+
+    async def _fetch_stage(self, partitions, fetched_queue, zone_ids):
+        try:
+            for partition_start, partition_end in partitions:
+                batches = analytics_api.create_zone_batches(zone_ids,
+                                                            (partition_end - partition_start).total_seconds())
+                results = await asyncio.gather(
+                    *[self._fetch_zone_batch(partition_start, partition_end, batch) for batch in batches])
+                result = analytics_api.merge_results(results)
+                if self.capture is not None:
+                    await asyncio.to_thread(self.capture.store, partition_start, partition_end, zone_ids, result)
+                await fetched_queue.put((partition_start, partition_end, result))
+        except Exception:
+            # the partitions fetched so far are still indexed before the error is raised
+            await fetched_queue.put(None)
+            raise
+        await fetched_queue.put(None)
+
+    # normalize returns a lazy generator - it is consumed in a thread here, so the event loop keeps fetching meanwhile
+    @staticmethod
+    async def _normalize_stage(fetched_queue, normalized_queue):
+        while (item := await fetched_queue.get()) is not None:
+            partition_start, partition_end, result = item
+            docs = await asyncio.to_thread(list, analytics_api.normalize(result))
+            await normalized_queue.put((partition_start, partition_end, docs))
+        await normalized_queue.put(None)
+
+    async def _index_stage(self, normalized_queue, zone_ids):
+        while (item := await normalized_queue.get()) is not None:
+            partition_start, partition_end, docs = item
+            start = time.perf_counter()
+            doc_amount, _ = await async_bulk(self.es, DataStore._create_bulk_data(docs),
+                                             ignore_status=DataStore.ignored_bulk_status(),
+                                             max_retries=config.es_bulk_retries,
+                                             initial_backoff=config.es_bulk_retry_backoff_in_seconds)
+            metrics.bulk_duration.observe(time.perf_counter() - start)
+            metrics.indexed_documents.inc(doc_amount)
+            await asyncio.to_thread(self.storage.store_checkpoint, partition_end, zone_ids)
+            self.committed_datetime = partition_end
+            print(f"{datetime.datetime.now()} - committed {doc_amount} documents up to {partition_end}")
+
+    async def _run(self, start_datetime, end_datetime, zone_ids):
+        partitions = backfill.Backfill.create_partitions(start_datetime, end_datetime)
+        print(f"{datetime.datetime.now()} - backfilling {start_datetime} - {end_datetime} "
+              f"in {len(partitions)} partitions using the asyncio pipeline")
+
+        fetched_queue = asyncio.Queue(maxsize=self.queue_size)
+        normalized_queue = asyncio.Queue(maxsize=self.queue_size)
+        tasks = []
+        try:
+            await self._connect()
+            tasks = [asyncio.create_task(self._fetch_stage(partitions, fetched_queue, zone_ids)),
+                     asyncio.create_task(self._normalize_stage(fetched_queue, normalized_queue)),
+                     asyncio.create_task(self._index_stage(normalized_queue, zone_ids))]
+            await asyncio.gather(*tasks[1:])
+            await tasks[0]
+        except Exception as e:
+            print(f"Error during backfill - continue from {self.committed_datetime}: {e}")
+            print(f"{e}\nCaused by: {traceback.format_exc()}")
+            for task in tasks:
+                task.cancel()
+        finally:
+            await self._close()
+
+    def run(self, start_datetime, end_datetime, zone_ids=None):
+        self.committed_datetime = start_datetime
+        asyncio.run(self._run(start_datetime, end_datetime,
+                              zone_ids if zone_ids is not None else list(config.zones.keys())))
+
+        return self.committed_datetime
@@ -0,0 +1,94 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from cloudflare import analytics_api
+from cloudflare import config
+from cloudflare import rate_limit
+from cloudflare import scheduler
+
+
+dt_helper = analytics_api.dt_helper
+
+
+class Backfill(object):
+
+    def __init__(self, storage, cf_client):
+        self.storage = storage
+        self.cf_client = cf_client
+        self.max_workers = config.backfill_max_workers
+        self.partition_retries = config.backfill_partition_retries
+
+    @staticmethod
+    def create_partitions(start_datetime, end_datetime):
+        partition_size = datetime.timedelta(seconds=min(dt_helper.CF_CATCHUP_INTERVAL_IN_SECONDS,
+                                                        analytics_api.determine_max_interval_in_seconds()))
+        partitions = []
+        partition_start = start_datetime
+        while partition_start < end_datetime:
+            partition_end = min(partition_start + partition_size, end_datetime)
+            partitions.append((partition_start, partition_end))
+            partition_start = partition_end
+
+        return partitions
+
+    # rate-limited queries don't count as failed attempts - the shared budget delays the next query anyway
+    # failed attempts are retried with the exponential backoff and jitter of the scheduler - so the workers, that
+    # failed at the same time, don't retry in lockstep
+    def _process_partition(self, partition_start, partition_end, zone_ids=None):
+        schedule = scheduler.Scheduler()
+        while True:
+            try:
+                data = self.cf_client.fetch_cloudflare_analytics(partition_start, partition_end, zone_ids)
+                return self.storage.store_documents(docs=data)
+            except rate_limit.RateLimitError as e:
+                print(f"{datetime.datetime.now()} - backfill of {partition_start} was rate-limited: {e}")
+            except Exception as e:
+                attempt = schedule.failures + 1
+                print(f"{datetime.datetime.now()} - backfill of {partition_start} failed (attempt {attempt}): {e}")
+                if attempt >= self.partition_retries:
+                    raise
+                schedule.failed()
+
+    # partitions are processed in parallel, but the checkpoint only advances over the
+    # uninterrupted sequence of finished partitions - a crash can never leave a hole behind it
+    def run(self, start_datetime, end_datetime, zone_ids=None):
+        partitions = self.create_partitions(start_datetime, end_datetime)
+        print(f"{datetime.datetime.now()} - backfilling {start_datetime} - {end_datetime} "
+              f"in {len(partitions)} partitions using {self.max_workers} workers")
+
+        committed_datetime = start_datetime
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = [executor.submit(self._process_partition, *partition, zone_ids) for partition in partitions]
+            for (partition_start, partition_end), future in zip(partitions, futures):
+                doc_amount = future.result()
+                self.storage.store_checkpoint(partition_end, zone_ids)
+                committed_datetime = partition_end
+                print(f"{datetime.datetime.now()} - committed {doc_amount} documents up to {committed_datetime} "
+                      f"(remaining cf-api budget: {analytics_api.cf_rate_limiter.remaining():.0f} queries)")
+        except Exception as e:
+            print(f"Error during backfill - continue from {committed_datetime}: {e}")
+            print(f"{e}\nCaused by: {traceback.format_exc()}")
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return committed_datetime
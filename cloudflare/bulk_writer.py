@@ -0,0 +1,169 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from cloudflare import config
+from cloudflare import metrics
+from elasticsearch import ApiError
+from elasticsearch.helpers import BulkIndexError
+
+# 429 - the write thread-pool of a node is full (es_rejected_execution_exception)
+RETRY_STATUS = 429
+
+
+def item_status(item):
+    return list(item.values())[0].get("status", 200)
+
+
+# every document takes exactly two lines (action and source) - json never contains a raw newline
+def select_documents(body, positions):
+    lines = body.split(b"\n")
+    return b"".join(lines[2 * i] + b"\n" + lines[2 * i + 1] + b"\n" for i in positions)
+
+
+# sends serialized bulk-bodies in parallel - the allowed concurrency is shared by all callers (e.g. backfill-workers)
+# and adapts to the cluster: halved on every 429, raised by one after a row of successful requests
+class BulkWriter(object):
+
+    def __init__(self, es, max_concurrency=None, recover_after=None, retries=None, backoff_in_seconds=None):
+        self.es = es
+        self.max_concurrency = max(1, max_concurrency if max_concurrency is not None
+                                   else config.es_bulk_max_concurrency)
+        self.recover_after = recover_after if recover_after is not None else config.es_bulk_recover_after
+        self.retries = retries if retries is not None else config.es_bulk_retries
+        self.backoff_in_seconds = backoff_in_seconds if backoff_in_seconds is not None \
+            else config.es_bulk_retry_backoff_in_seconds
+        self.concurrency = self.max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="bulk-writer")
+        metrics.bulk_concurrency.set(self.concurrency)
+
+    def _acquire(self):
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def _release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _throttle(self):
+        with self.condition:
+            self.successes = 0
+            if self.concurrency > 1:
+                self.concurrency = max(1, self.concurrency // 2)
+                metrics.bulk_concurrency.set(self.concurrency)
+                print(f"{datetime.datetime.now()} - elasticsearch is pushing back, "
+                      f"reduced bulk-concurrency to {self.concurrency}")
+
+    def _succeeded(self):
+        with self.condition:
+            self.successes += 1
+            if self.concurrency < self.max_concurrency and self.successes >= self.recover_after:
+                self.successes = 0
+                self.concurrency += 1
+                metrics.bulk_concurrency.set(self.concurrency)
+                self.condition.notify_all()
+
+    def backoff(self, attempt):
+        return self.backoff_in_seconds * 2 ** attempt
+
+    # returns the amount of indexed documents - fails with the first chunk that could not be indexed
+    def write(self, chunks, ignored_status=()):
+        futures = []
+        try:
+            for body, doc_amount in chunks:
+                failed = next((f for f in futures if f.done() and f.exception() is not None), None)
+                if failed is not None:
+                    break
+                self._acquire()
+                try:
+                    futures.append(self.executor.submit(self._send, body, doc_amount, ignored_status))
+                except Exception:
+                    self._release()
+                    raise
+        finally:
+            # the remaining requests are waited for in any case - so no request outlives its window
+            wait(futures)
+
+        return sum(f.result() for f in futures)
+
+    def _send(self, body, doc_amount, ignored_status):
+        try:
+            attempt = 0
+            while True:
+                response = self._request(body, attempt)
+                if response is not None:
+                    positions = self._rejected_positions(response, ignored_status)
+                    if not positions:
+                        self._succeeded()
+                        metrics.indexed_documents.inc(doc_amount)
+                        return doc_amount
+                    if attempt >= self.retries:
+                        metrics.bulk_rejections.inc(len(positions))
+                        raise BulkIndexError(f"{len(positions)} document(s) still rejected after {attempt} retries.",
+                                             [response.get("items")[i] for i in positions])
+                    metrics.bulk_retries.inc(len(positions))
+                    body = select_documents(body, positions)
+                self._throttle()
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+        finally:
+            self._release()
+
+    # a rejected request (instead of rejected documents) is retried as a whole - signalled by returning None
+    def _request(self, body, attempt):
+        start = time.perf_counter()
+        try:
+            response = self.es.bulk(operations=body, require_alias=True)
+        except ApiError as e:
+            if e.status_code != RETRY_STATUS or attempt >= self.retries:
+                raise
+            return None
+        finally:
+            metrics.bulk_duration.observe(time.perf_counter() - start)
+            metrics.bulk_bytes.inc(len(body))
+
+        return response
+
+    @staticmethod
+    def _rejected_positions(response, ignored_status):
+        if not response.get("errors"):
+            return []
+
+        positions = []
+        errors = []
+        for i, item in enumerate(response.get("items")):
+            status = item_status(item)
+            if status == RETRY_STATUS:
+                positions.append(i)
+            elif status >= 300 and status not in ignored_status:
+                errors.append(item)
+        if errors:
+            metrics.bulk_rejections.inc(len(errors))
+            raise BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+
+        return positions
@@ -0,0 +1,72 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import hashlib
+import os
+
+from cloudflare import config
+from cloudflare.segments import SEGMENT_SUFFIX, compress_result, parse_segment_name, segment_name, write_segment
+
+
+# raw cf-api results are archived per fetched window in day-directories ("<capture_dir>/yyyy/mm/dd/"),
+# so the index can be rebuilt by replaying them - without cf-api quota and beyond the cf-api retention
+class Capture(object):
+
+    def __init__(self, capture_dir=None):
+        self.capture_dir = capture_dir if capture_dir is not None else config.capture_dir
+
+    def _day_dir(self, day):
+        return os.path.join(self.capture_dir, day.strftime("%Y"), day.strftime("%m"), day.strftime("%d"))
+
+    # the zones are part of the name, so windows fetched for different zones never overwrite each other
+    @staticmethod
+    def capture_name(start_datetime, end_datetime, zone_ids):
+        zones_hash = hashlib.sha1("|".join(sorted(zone_ids)).encode("utf-8")).hexdigest()[:8]
+        return segment_name(start_datetime, end_datetime)[:-len(SEGMENT_SUFFIX)] + f"_{zones_hash}{SEGMENT_SUFFIX}"
+
+    # capturing must never stop the export
+    def store(self, start_datetime, end_datetime, zone_ids, result):
+        try:
+            day_dir = self._day_dir(start_datetime)
+            os.makedirs(day_dir, exist_ok=True)
+            write_segment(os.path.join(day_dir, self.capture_name(start_datetime, end_datetime, zone_ids)),
+                          compress_result(result))
+        except Exception as e:
+            print(f"{datetime.datetime.now()} - unable to capture {start_datetime} - {end_datetime}: {e}")
+
+    # all captured windows starting within [start_datetime, end_datetime) in chronological order
+    def segments(self, start_datetime, end_datetime):
+        segments = []
+        day = start_datetime.date()
+        while day <= end_datetime.date():
+            day_dir = self._day_dir(day)
+            if os.path.isdir(day_dir):
+                for name in sorted(os.listdir(day_dir)):
+                    if not name.endswith(SEGMENT_SUFFIX):
+                        continue
+                    segment_start, segment_end = parse_segment_name(name)
+                    if start_datetime <= segment_start < end_datetime:
+                        segments.append((segment_start, segment_end, os.path.join(day_dir, name)))
+            day += datetime.timedelta(days=1)
+
+        return segments
+
+
+def create_capture():
+    return Capture() if config.capture_enabled else None
@@ -0,0 +1,145 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import itertools
+
+from array import array
+from cloudflare import analytics_api
+from cloudflare import config
+from cloudflare import records
+
+# array-columns can't hold None - missing values are stored as this marker
+MISSING = -1
+
+
+def _value(value):
+    return MISSING if value is None else value
+
+
+def _restore(column):
+    return [None if value == MISSING else value for value in column]
+
+
+class Columns(object):
+
+    def __init__(self, fields):
+        self.offsets = array("q", [0])
+        self.keys = []
+        self.values = {field: array("q") for field in fields}
+
+    def append(self, entries, key_field):
+        self.keys.extend([entry.get(key_field) for entry in entries])
+        for field, column in self.values.items():
+            column.extend([_value(entry.get(field)) for entry in entries])
+        self.offsets.append(len(self.keys))
+
+    def intern_keys(self):
+        interned = {key: records.intern_key(key) for key in set(self.keys)}
+        self.keys = [interned[key] for key in self.keys]
+
+    # one tuple per row with the values in the positional order of AnalyticsRecord (0 for unused fields)
+    def rows(self):
+        size = len(self.keys)
+        return list(zip(*[_restore(self.values.get(field)) if field in self.values else itertools.repeat(0, size)
+                          for field in records.METRIC_FIELDS]))
+
+
+# extracts the maps of all data-groups into array-columns first, then creates the records from the columns.
+# produces exactly the same records (in the same order) as analytics_api.normalize_data - the maps are taken from
+# the enabled analytics_api.DATASETS
+class ColumnarNormalizer(object):
+
+    def __init__(self, result):
+        datasets = analytics_api.enabled_datasets()
+        self.zone_tags = []
+        self.datetimes = []
+        self.with_base = any(dataset.data_type == "base" for dataset in datasets)
+        self.datasets = [dataset for dataset in datasets if dataset.map_name is not None]
+        self.base = Columns(records.METRIC_FIELDS)
+        self.maps = {dataset.data_type: Columns(dataset.value_fields) for dataset in self.datasets}
+        self._extract(result)
+
+    def _extract(self, result):
+        base_columns = [self.base.values.get(field) for field in records.METRIC_FIELDS[1:]]
+        for item in result.get("viewer").get("zones"):
+            zone_tag = records.intern_key(item.get("zoneTag"))
+            for data_group in item.get("httpRequests1mGroups"):
+                sums = data_group.get("sum")
+                self.zone_tags.append(zone_tag)
+                self.datetimes.append(data_group.get("dimensions").get("datetime"))
+                if self.with_base:
+                    self.base.values.get("uniques").append(_value(data_group.get("uniq").get("uniques")))
+                    for field, column in zip(records.METRIC_FIELDS[1:], base_columns):
+                        column.append(_value(sums.get(field)))
+                for dataset in self.datasets:
+                    self.maps[dataset.data_type].append(sums.get(dataset.map_name), dataset.key_field)
+
+        for columns in self.maps.values():
+            columns.intern_keys()
+
+    # every distinct timestamp is only parsed and formatted once
+    def _parse_timestamps(self):
+        parsed = {}
+        for value in set(self.datetimes):
+            timestamp = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+            parsed[value] = (timestamp, timestamp.strftime(records.DATETIME_FORMAT))
+
+        return [parsed[value] for value in self.datetimes]
+
+    @staticmethod
+    def _rank(columns, rows, rank_field, data_type, start, end):
+        indices = range(start, end)
+        top_n = config.cf_top_n.get(data_type, 0) if rank_field is not None else 0
+        if top_n <= 0 or len(indices) <= top_n:
+            return indices, None
+
+        rank_position = records.METRIC_FIELDS.index(rank_field)
+        ranked = sorted(indices, key=lambda i: rows[i][rank_position] or 0, reverse=True)
+        other = tuple(sum(rows[i][position] or 0 for i in ranked[top_n:]) if field in columns.values else 0
+                      for position, field in enumerate(records.METRIC_FIELDS))
+        return ranked[:top_n], other
+
+    def records(self):
+        zone_names = {zone_tag: records.intern_key(config.zones.get(zone_tag)) for zone_tag in set(self.zone_tags)}
+        base_rows = self.base.rows()
+        map_rows = {data_type: columns.rows() for data_type, columns in self.maps.items()}
+        record = records.AnalyticsRecord
+
+        for group, (timestamp, timestamp_str) in enumerate(self._parse_timestamps()):
+            zone_tag = self.zone_tags[group]
+            zone_name = zone_names.get(zone_tag)
+            if self.with_base:
+                yield record("base", "base", zone_tag, zone_name, timestamp, timestamp_str, *base_rows[group])
+
+            for dataset in self.datasets:
+                data_type = dataset.data_type
+                columns = self.maps[data_type]
+                rows = map_rows[data_type]
+                indices, other = self._rank(columns, rows, dataset.rank_field, data_type, columns.offsets[group],
+                                            columns.offsets[group + 1])
+                keys = columns.keys
+                for i in indices:
+                    yield record(data_type, keys[i], zone_tag, zone_name, timestamp, timestamp_str, *rows[i])
+                if other is not None:
+                    yield record(data_type, config.cf_top_n_other_key, zone_tag, zone_name, timestamp, timestamp_str,
+                                 *other)
+
+
+def normalize_data(result):
+    return ColumnarNormalizer(result).records()
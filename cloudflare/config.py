@@ -22,6 +22,44 @@ cf_api_user = "_REPLACEME_"
 
 cf_fetch_delay_in_seconds = 300
 cf_data_interval_in_seconds = 61
+# while catching up, the fetch-window grows up to this size (capped by the row-limit of a single query)
+cf_catchup_interval_in_seconds = 3600
+cf_query_limit = 9999
+# zones are split into batches (zones x minutes <= cf_query_limit), which are queried in parallel
+cf_max_zones_per_query = 50
+cf_max_parallel_queries = 4
+# cf-api quota (per user): at most cf_rate_limit_queries queries per cf_rate_limit_period_in_seconds
+# lower it, when several exporters share one user/token
+cf_rate_limit_queries = 300
+cf_rate_limit_period_in_seconds = 300
+# pause after a rate-limit response without Retry-After header
+cf_rate_limit_pause_in_seconds = 60
+# failed windows are retried with exponential backoff (base x 2^(failures-1), capped at max) and jitter
+cf_retry_backoff_base_in_seconds = 5
+cf_retry_backoff_max_in_seconds = 300
+# keep-alive connections to the cf-api (should cover backfill_max_workers x cf_max_parallel_queries)
+cf_http_pool_size = 16
+
+# keep only the top-N keys (per zone and minute) of these dataTypes - the remaining keys are summed up
+# in one document with the dataKey "cf_top_n_other_key", so totals stay exact (0 = keep all keys)
+cf_top_n = {
+    "country": 0,
+    "browser": 0,
+    "contentType": 0
+}
+cf_top_n_other_key = "other"
+# only the fields of these dataTypes are queried and normalized - optional: "httpVersion", "ipClass"
+cf_datasets = ["base", "responseStatus", "country", "sslVersion", "browser", "contentType"]
+# further datasets - each is fetched by its own thread with its own schedule, window and checkpoint, so a slow or
+# failing dataset never delays the per-minute http totals (all of them share the cf-api quota though)
+cf_pipelines = {
+    "firewallEvents": {"enabled": False, "interval_in_seconds": 300, "window_in_seconds": 900},
+    "workerInvocations": {"enabled": False, "interval_in_seconds": 300, "window_in_seconds": 900}
+}
+# account of the workers (dataset "workerInvocations")
+cf_account_tag = "_REPLACEME_"
+# "default" or "columnar" (extracts all data-groups into array-columns first - faster for large windows)
+cf_normalize_engine = "default"
 
 es_host = "_REPLACEME_"
 es_port = 9200
@@ -34,6 +72,83 @@ es_cf_initial_index = f"{es_cf_index}-000001"
 es_cf_policy = "cf-analytics-policy"
 es_cf_index_template = "cf-analytics"
 es_cf_index_pattern = "cf-analytics*"
+# documents get deterministic IDs - "index" overwrites existing documents, "create" keeps the first version
+es_document_op_type = "index"
+# serialize the bulk-body directly instead of letting the elasticsearch-client encode every single document
+es_bulk_fast_path = True
+es_bulk_max_chunk_bytes = 5242880
+# up to es_bulk_max_concurrency serialized bulk-requests are in flight - halved whenever elasticsearch pushes back
+# (429 / full write thread-pool) and raised by one again after es_bulk_recover_after successful requests
+es_bulk_max_concurrency = 4
+es_bulk_recover_after = 10
+# only the documents rejected with 429 are re-sent, with exponential backoff
+es_bulk_retries = 5
+es_bulk_retry_backoff_in_seconds = 0.5
+# stores the "committed up to" progress per zone - the name must NOT match "es_cf_index_pattern"!
+es_cf_checkpoint_index = "cfae-checkpoints"
+
+# gaps larger than this are closed by the parallel backfill at startup
+backfill_threshold_in_seconds = 3600
+backfill_max_workers = 4
+backfill_partition_retries = 3
+# zones without checkpoint and documents (e.g. added to "zones" later) are backfilled this far
+backfill_new_zones_in_seconds = 86400
+# "threads" or "asyncio" (overlaps fetching the next partition with indexing the current one)
+backfill_engine = "threads"
+async_queue_size = 2
+# while closing gaps larger than this, refreshes (and optionally replicas) of the write-index are disabled - the
+# original settings are restored by the same replica once it is live again or on shutdown (incl. SIGTERM) - after a
+# crash, the next startup restores them unless the entering replica is still alive
+backfill_mode_enabled = True
+backfill_mode_threshold_in_seconds = 21600
+backfill_mode_drop_replicas = False
+
+# several replicas share the zones: every replica holds leases (in es_lease_index) for its fair share of the zones,
+# the zones of a replica, that stopped renewing its leases, are taken over after sharding_lease_ttl_in_seconds
+sharding_enabled = False
+sharding_replica_id_env = "HOSTNAME"
+sharding_lease_ttl_in_seconds = 60
+sharding_renew_interval_in_seconds = 15
+# the name must NOT match "es_cf_index_pattern"!
+es_lease_index = "cfae-leases"
+
+# hourly and daily aggregates in monthly indices "<es_rollup_index_prefix>-<interval>-<yyyy.mm>"
+# the prefix must NOT match "es_cf_index_pattern"!
+es_rollup_enabled = False
+es_rollup_index_prefix = "cf-rollup"
+es_rollup_index_pattern = "cf-rollup-*"
+es_rollup_policy = "cf-rollup-policy"
+es_rollup_index_template = "cf-rollup"
+
+# prometheus-endpoint "http://<host>:<metrics_port>/metrics" with stage-latencies, throughput and lag
+metrics_enabled = True
+metrics_port = 9110
+
+# profiling is enabled by setting the environment variable "profile_dir_env" to the dump-directory.
+# a cProfile-dump is written every "profile_every" iterations and for every iteration slower than the threshold
+# (both can be overridden by the environment variables "profile_every_env" and "profile_slow_threshold_env")
+profile_dir_env = "CFAE_PROFILE_DIR"
+profile_every_env = "CFAE_PROFILE_EVERY"
+profile_slow_threshold_env = "CFAE_PROFILE_SLOW_SECONDS"
+profile_every = 100
+profile_slow_threshold_in_seconds = 20
+profile_top_functions = 40
+
+# archive the raw cf-api results of all fetched windows in "capture_dir" (gzip, one directory per day),
+# they can be re-indexed with "python -m cloudflare.replay --from <datetime> --to <datetime>"
+capture_enabled = False
+capture_dir = "/data/capture"
+replay_batch_size = 60
+replay_max_workers = 4
+
+# fetched windows, that couldn't be indexed, are kept on disk until elasticsearch is available again
+spool_enabled = True
+spool_dir = "/data/spool"
+spool_max_bytes = 1073741824
+spool_drain_interval_in_seconds = 30
+spool_drain_batch_size = 10
+# segments failing for other reasons than an unavailable elasticsearch are moved to <spool_dir>/quarantine
+spool_max_drain_failures = 5
 
 check_for_concurrency = False
 no_concurrency_uri = "https://cfae-concurrency.local/"
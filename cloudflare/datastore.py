@@ -19,17 +19,43 @@
 import datetime
 import json
 import os
+import time
 
 from cloudflare import config
-from elasticsearch import Elasticsearch, ApiError, helpers
+from cloudflare import leases
+from cloudflare import metrics
+from cloudflare import records
+from cloudflare.bulk_writer import BulkWriter, RETRY_STATUS, item_status
+from elasticsearch import Elasticsearch, ApiError, ConflictError, ConnectionError as ESConnectionError, \
+    ConnectionTimeout, NotFoundError, helpers
+from elasticsearch.helpers import BulkIndexError
 
-DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+DATETIME_FORMAT = records.DATETIME_FORMAT
+MAX_GAP_IN_SECONDS = 608400
+CHECKPOINT_ID = "committed"
+# indices created by dynamic mapping keep strings as text - with a keyword sub-field
+KEYWORD_SUFFIXES = ["", ".keyword"]
+BACKFILL_MODE_ID = "backfill-mode"
+UNAVAILABLE_STATUS = (429, 502, 503, 504)
+
+
+# errors, that are worth to retry later (e.g. from the spool) - every other error is caused by the request itself
+def is_unavailable(e):
+    if isinstance(e, (ESConnectionError, ConnectionTimeout)):
+        return True
+    if isinstance(e, ApiError):
+        return e.meta.status in UNAVAILABLE_STATUS
+    if isinstance(e, BulkIndexError):
+        return bool(e.errors) and all(item_status(item) == RETRY_STATUS for item in e.errors)
+    return False
 
 
 class DataStore(object):
 
     def __init__(self):
         self.es = None
+        self.bulk_writer = None
+        self.replica_id = leases.determine_replica_id()
         self.es_password = os.getenv(config.es_pass_env)
 
     @staticmethod
@@ -44,10 +70,19 @@ class DataStore(object):
             f"https://{config.es_host}:{config.es_port}",
             basic_auth=(config.es_user, self.es_password)
         )
+        # created once, before any worker thread writes - its adaptive concurrency is shared by all of them
+        self.bulk_writer = BulkWriter(self.es)
         self._ensure_index()
 
         print(f"connected to elasticsearch: {self.es.info()}")
 
+    def is_available(self):
+        try:
+            return bool(self.es.ping())
+        except Exception as e:
+            print(f"elasticsearch not available: {e}")
+            return False
+
     def _ensure_index(self):
         if "false" == str(self.es.indices.exists(index=config.es_cf_index_pattern, allow_no_indices=False)).lower():
             print("index not found - commencing setup...")
@@ -55,34 +90,363 @@ class DataStore(object):
             index_template = json.loads(self.read_resource_from_file("index-template.json"))
             self.es.ilm.put_lifecycle(name=config.es_cf_policy, policy=ilm_policy)
             self.es.indices.put_index_template(name=config.es_cf_index_template,
-                                               index_patterns=[config.es_cf_index_pattern], template=index_template)
+                                               index_patterns=[config.es_cf_index_pattern], template=index_template,
+                                               version=self._template_version(index_template))
             self.es.indices.create(index=config.es_cf_initial_index, aliases={config.es_cf_index: {"is_write_index": True}})
+        else:
+            self._ensure_index_template()
+
+        if config.es_rollup_enabled:
+            self._ensure_rollup_template()
+
+    def _ensure_rollup_template(self):
+        ilm_policy = json.loads(self.read_resource_from_file("rollup-ilm-policy.json"))
+        index_template = json.loads(self.read_resource_from_file("rollup-index-template.json"))
+        self.es.ilm.put_lifecycle(name=config.es_rollup_policy, policy=ilm_policy)
+        self.es.indices.put_index_template(name=config.es_rollup_index_template,
+                                           index_patterns=[config.es_rollup_index_pattern], template=index_template,
+                                           version=self._template_version(index_template))
+
+    @staticmethod
+    def _template_version(index_template):
+        return index_template.get("mappings").get("_meta").get("version")
+
+    # mappings and index-sorting only apply to new indices - so the write-index is rolled over after an update
+    def _ensure_index_template(self):
+        index_template = json.loads(self.read_resource_from_file("index-template.json"))
+        version = self._template_version(index_template)
+        existing_version = None
+        try:
+            existing = self.es.indices.get_index_template(name=config.es_cf_index_template)
+            existing_version = existing.get("index_templates")[0].get("index_template").get("version")
+        except NotFoundError:
+            print("index template not found")
+
+        if existing_version != version:
+            print(f"updating outdated index template (version {existing_version} -> {version})...")
+            self.es.indices.put_index_template(name=config.es_cf_index_template,
+                                               index_patterns=[config.es_cf_index_pattern], template=index_template,
+                                               version=version)
+            self.es.indices.rollover(alias=config.es_cf_index)
+
+    # one max-aggregation per zone, limited to the time-range a checkpoint can be resumed from
+    # (the index-sorting by @timestamp keeps this cheap at any index size)
+    # indices created by dynamic mapping keep zoneTag as text - their shards fail the terms aggregation on zoneTag
+    # and only succeed on the keyword sub-field, so both fields are aggregated and the maxima per zone are merged.
+    # elasticsearch answers with partial results on failing shards - a shard, that failed for both fields, would
+    # silently drop its zones (and backfill them as new zones), so that is an error.
+    # documents of other dataTypes (e.g. of pipelines) must not count as the latest http totals of a zone
+    def find_latest_zone_datetimes(self, zone_tags, excluded_data_types=None):
+        latest_refs = {}
+        uncovered_shards = None
+        for suffix in KEYWORD_SUFFIXES:
+            field = "zoneTag" + suffix
+            query = {"bool": {"filter": [{"range": {"@timestamp": {"gte": f"now-{MAX_GAP_IN_SECONDS}s"}}}]}}
+            if excluded_data_types:
+                query["bool"]["must_not"] = [{"terms": {"dataType" + suffix: list(excluded_data_types)}}]
+            try:
+                result = self.es.search(index=config.es_cf_index, size=0, query=query,
+                                        aggs={"zones": {"terms": {"field": field, "include": list(zone_tags),
+                                                                  "size": max(1, len(zone_tags))},
+                                                        "aggs": {"latest": {"max": {"field": "@timestamp"}}}}})
+            except ApiError as e:
+                if e.meta.status != 400:
+                    raise
+                # all shards failed - the other field has to cover all of them
+                print(f"unable to aggregate on {field}: {e}")
+                continue
+
+            failed_shards = self._failed_shards(result)
+            uncovered_shards = failed_shards if uncovered_shards is None else uncovered_shards & failed_shards
+            for bucket in result.get("aggregations").get("zones").get("buckets"):
+                latest = datetime.datetime.utcfromtimestamp(bucket.get("latest").get("value") / 1000)
+                latest_refs[bucket.get("key")] = max(latest, latest_refs.get(bucket.get("key"), latest))
+
+        if uncovered_shards is None or uncovered_shards:
+            raise RuntimeError(f"unable to determine latest reference datetimes - failed shards: {uncovered_shards}")
+
+        return latest_refs
+
+    @staticmethod
+    def _failed_shards(result):
+        return {(failure.get("index"), failure.get("shard"))
+                for failure in result.get("_shards").get("failures", [])}
+
+    @staticmethod
+    def _is_outdated(ref_datetime):
+        return datetime.datetime.utcnow() - datetime.timedelta(seconds=MAX_GAP_IN_SECONDS) > ref_datetime
+
+    @staticmethod
+    def zone_checkpoint_id(zone_tag):
+        return f"{CHECKPOINT_ID}-{zone_tag}"
 
-    def find_latest_reference_datetime(self):
-        latest_ref = None
+    def find_zone_checkpoints(self):
+        zone_tags = list(config.zones.keys())
+        checkpoints = {}
         try:
-            latest_doc = self.es.search(index=config.es_cf_index, size=1,
-                                        query={"match_all": {}}, sort={"@timestamp": "desc"})
-            if latest_doc.get("hits").get("total").get("value") > 0:
-                latest_ref = datetime.datetime.strptime(
-                    latest_doc.get("hits").get("hits")[0].get("_source").get("@timestamp"), DATETIME_FORMAT)
-                if datetime.datetime.utcnow() - datetime.timedelta(seconds=608400) > latest_ref:
-                    latest_ref = None
+            docs = self.es.mget(index=config.es_cf_checkpoint_index,
+                                ids=[self.zone_checkpoint_id(zone_tag) for zone_tag in zone_tags])
+            for zone_tag, doc in zip(zone_tags, docs.get("docs")):
+                if not doc.get("found"):
+                    continue
+                checkpoint = datetime.datetime.strptime(doc.get("_source").get("committedUpTo"), DATETIME_FORMAT)
+                if not self._is_outdated(checkpoint):
+                    checkpoints[zone_tag] = checkpoint
+        except NotFoundError:
+            print("no checkpoint found")
         except ApiError as e:
-            print(f"unable to determine latest reference datetime: {e}")
+            print(f"unable to read checkpoint: {e}")
+
+        return checkpoints
+
+    # one document per zone - replicas committing the same window never write the same document
+    def store_checkpoint(self, committed_datetime, zone_tags=None):
+        if zone_tags is None:
+            zone_tags = config.zones.keys()
+        committed_up_to = committed_datetime.strftime(DATETIME_FORMAT)
+        helpers.bulk(self.es, ({
+            "_index": config.es_cf_checkpoint_index,
+            "_id": self.zone_checkpoint_id(zone_tag),
+            "_source": {"zoneTag": zone_tag, "committedUpTo": committed_up_to}
+        } for zone_tag in zone_tags))
+        metrics.committed_datetime.set(committed_datetime)
+
+    def find_pipeline_checkpoint(self, name):
+        try:
+            source = self.es.get(index=config.es_cf_checkpoint_index, id=f"pipeline-{name}").get("_source")
+            checkpoint = datetime.datetime.strptime(source.get("committedUpTo"), DATETIME_FORMAT)
+            if not self._is_outdated(checkpoint):
+                return checkpoint
+        except NotFoundError:
+            print(f"no checkpoint found for pipeline {name}")
+        except ApiError as e:
+            print(f"unable to read checkpoint of pipeline {name}: {e}")
+
+        return None
+
+    def store_pipeline_checkpoint(self, name, committed_datetime):
+        self.es.index(index=config.es_cf_checkpoint_index, id=f"pipeline-{name}",
+                      document={"committedUpTo": committed_datetime.strftime(DATETIME_FORMAT)})
+
+    # leases are replaced with compare-and-set (_seq_no/_primary_term) - a conflict means another replica was faster
+    def find_leases(self):
+        try:
+            result = self.es.search(index=config.es_lease_index, size=10000, seq_no_primary_term=True,
+                                    query={"match_all": {}})
+        except NotFoundError:
+            return {}
+
+        return {hit.get("_id"): (hit.get("_source"), hit.get("_seq_no"), hit.get("_primary_term"))
+                for hit in result.get("hits").get("hits")}
+
+    def create_lease(self, lease_id, lease):
+        try:
+            self.es.index(index=config.es_lease_index, id=lease_id, document=lease, op_type="create", refresh=True)
+        except ConflictError:
+            return False
 
-        return latest_ref
+        return True
+
+    def update_lease(self, lease_id, lease, seq_no, primary_term):
+        try:
+            self.es.index(index=config.es_lease_index, id=lease_id, document=lease, if_seq_no=seq_no,
+                          if_primary_term=primary_term, refresh=True)
+        except ConflictError:
+            return False
+
+        return True
+
+    def find_write_index(self):
+        for index, alias in self.es.indices.get_alias(name=config.es_cf_index).items():
+            if alias.get("aliases").get(config.es_cf_index).get("is_write_index", False):
+                return index
+
+        return None
+
+    # the original settings are persisted before they are changed - so they survive a crash of the exporter
+    def enter_backfill_mode(self):
+        index = self.find_write_index()
+        if index is None:
+            print("no write-index found - backfill-mode skipped")
+            return
+
+        current = self.es.indices.get_settings(index=index, name="index.refresh_interval,index.number_of_replicas",
+                                               flat_settings=True).get(index).get("settings")
+        original = {"index.refresh_interval": current.get("index.refresh_interval")}
+        tuned = {"index.refresh_interval": "-1"}
+        if config.backfill_mode_drop_replicas:
+            original["index.number_of_replicas"] = current.get("index.number_of_replicas")
+            tuned["index.number_of_replicas"] = 0
+
+        try:
+            self.es.index(index=config.es_cf_checkpoint_index, id=BACKFILL_MODE_ID, op_type="create",
+                          document={"index": index, "settings": original, "owner": self.replica_id})
+        except ConflictError:
+            print(f"{index} is already in backfill-mode")
+            return
+        self.es.indices.put_settings(index=index, settings=tuned)
+        print(f"{datetime.datetime.now()} - entered backfill-mode on {index}: {tuned}")
+
+    def _find_backfill_mode(self):
+        try:
+            return self.es.get(index=config.es_cf_checkpoint_index, id=BACKFILL_MODE_ID).get("_source")
+        except NotFoundError:
+            return None
+
+    def _is_live_replica(self, replica_id):
+        lease = self.find_leases().get(leases.MEMBER_PREFIX + str(replica_id), ({}, None, None))[0]
+        return lease.get("owner") is not None and lease.get("expires", 0) > time.time()
+
+    # a missing refresh_interval (None) resets the setting to the default of the cluster
+    def _restore_backfill_mode(self, source):
+        index = source.get("index")
+        try:
+            self.es.indices.put_settings(index=index, settings=source.get("settings"))
+            self.es.indices.refresh(index=index)
+            print(f"{datetime.datetime.now()} - restored settings of {index}: {source.get('settings')}")
+        except NotFoundError:
+            print(f"index {index} of the backfill-mode no longer exists")
+        self.es.delete(index=config.es_cf_checkpoint_index, id=BACKFILL_MODE_ID)
+
+    # only the replica, that entered the backfill-mode, leaves it
+    def exit_backfill_mode(self):
+        source = self._find_backfill_mode()
+        if source is not None and source.get("owner") == self.replica_id:
+            self._restore_backfill_mode(source)
+
+    # after a crash, the next starting exporter restores the settings - with sharding, only once their owner is dead
+    # (the replicas re-check this regularly). not part of connect(), so e.g. a replay never touches the settings
+    def recover_backfill_mode(self):
+        source = self._find_backfill_mode()
+        if source is None:
+            return
+        owner = source.get("owner")
+        if owner != self.replica_id and config.sharding_enabled and self._is_live_replica(owner):
+            print(f"backfill-mode of replica {owner} is still active")
+            return
+        self._restore_backfill_mode(source)
 
     def store_document(self, doc):
         return self.es.index(index=config.es_cf_index, document=doc, require_alias=True)
 
+    # the same zone, minute, dataType and dataKey always result in the same document,
+    # so re-fetching a window (e.g. after a failed bulk) never creates duplicates
+    @staticmethod
+    def create_document_id(doc):
+        return records.create_document_id(doc.get("zoneTag"), doc.get("@timestamp").strftime(DATETIME_FORMAT),
+                                          doc.get("dataType"), doc.get("dataKey"))
+
     @staticmethod
     def _create_bulk_data(docs):
         for doc in docs:
             yield {
+                "_op_type": config.es_document_op_type,
                 "_index": config.es_cf_index,
-                "_source": doc
+                "_id": DataStore.create_document_id(doc),
+                "_source": records.to_source(doc)
             }
 
+    # with "create", documents that already exist are rejected with a conflict - which is fine
+    @staticmethod
+    def ignored_bulk_status():
+        if config.es_document_op_type == "create":
+            return 409,
+        return ()
+
     def store_documents(self, docs):
-        helpers.bulk(self.es, self._create_bulk_data(docs))
+        if config.es_bulk_fast_path:
+            return self._store_serialized_documents(docs)
+
+        # the streaming helper hides the single requests - so the whole stream is timed
+        doc_amount = 0
+        start = time.perf_counter()
+        try:
+            for _ in helpers.streaming_bulk(self.es, self._create_bulk_data(docs),
+                                            ignore_status=self.ignored_bulk_status(),
+                                            max_retries=config.es_bulk_retries,
+                                            initial_backoff=config.es_bulk_retry_backoff_in_seconds):
+                doc_amount += 1
+        except BulkIndexError as e:
+            metrics.bulk_rejections.inc(len(e.errors))
+            raise
+        finally:
+            metrics.bulk_duration.observe(time.perf_counter() - start)
+            metrics.indexed_documents.inc(doc_amount)
+
+        return doc_amount
+
+    def _store_serialized_documents(self, docs):
+        writer = records.BulkBodyWriter(config.es_cf_index, config.es_document_op_type, config.es_bulk_max_chunk_bytes)
+
+        return self.bulk_writer.write(writer.chunks(docs), self.ignored_bulk_status())
+
+    @staticmethod
+    def rollup_index_name(interval, bucket_datetime):
+        return f"{config.es_rollup_index_prefix}-{interval}-{bucket_datetime.strftime('%Y.%m')}"
+
+    def store_rollups(self, interval, docs):
+        actions = ({
+            "_index": self.rollup_index_name(interval, doc.get("@timestamp")),
+            "_id": self.create_document_id(doc),
+            "_source": doc
+        } for doc in docs)
+        helpers.bulk(self.es, actions)
+
+    # makes the just indexed raw documents visible to aggregate_documents
+    def refresh_documents(self):
+        self.es.indices.refresh(index=config.es_cf_index)
+
+    # sums up the raw documents per interval-bucket, zoneTag, dataType and dataKey.
+    # like find_latest_zone_datetimes, the shards of indices with dynamic mapping fail on the keyword fields, so their
+    # documents are aggregated on the keyword sub-fields instead (which don't exist in the newer indices)
+    def aggregate_documents(self, start_datetime, end_datetime, interval, metric_fields, zone_ids=None,
+                            excluded_data_types=None):
+        uncovered_shards = None
+        for suffix in KEYWORD_SUFFIXES:
+            filters = [{"range": {"@timestamp": {"gte": start_datetime.strftime(DATETIME_FORMAT),
+                                                 "lt": end_datetime.strftime(DATETIME_FORMAT)}}}]
+            if suffix:
+                filters.append({"exists": {"field": "zoneTag" + suffix}})
+            if zone_ids is not None:
+                filters.append({"terms": {"zoneTag" + suffix: list(zone_ids)}})
+            query = {"bool": {"filter": filters}}
+            if excluded_data_types:
+                query["bool"]["must_not"] = [{"terms": {"dataType" + suffix: list(excluded_data_types)}}]
+            sources = [
+                {"bucket": {"date_histogram": {"field": "@timestamp", "fixed_interval": interval}}},
+                {"zoneTag": {"terms": {"field": "zoneTag" + suffix}}},
+                {"dataType": {"terms": {"field": "dataType" + suffix}}},
+                {"dataKey": {"terms": {"field": "dataKey" + suffix, "missing_bucket": True}}}
+            ]
+            failed_shards = set()
+            if (yield from self._aggregate_groups(query, sources, metric_fields, failed_shards)):
+                uncovered_shards = failed_shards if uncovered_shards is None else uncovered_shards & failed_shards
+
+        # partial results would be written over the correct rollups
+        if uncovered_shards is None or uncovered_shards:
+            raise RuntimeError(f"unable to aggregate documents - failed shards: {uncovered_shards}")
+
+    # returns False, if all shards failed (with a 400) on the first page
+    def _aggregate_groups(self, query, sources, metric_fields, failed_shards):
+        composite = {"size": 1000, "sources": sources}
+        while True:
+            try:
+                response = self.es.search(index=config.es_cf_index, size=0, query=query, aggs={"groups": {
+                    "composite": composite, "aggs": {field: {"sum": {"field": field}} for field in metric_fields}}})
+            except ApiError as e:
+                if e.meta.status != 400 or "after" in composite:
+                    raise
+                print(f"unable to aggregate on {sources[1].get('zoneTag').get('terms').get('field')}: {e}")
+                return False
+
+            failed_shards.update(self._failed_shards(response))
+            groups = response.get("aggregations").get("groups")
+            for bucket in groups.get("buckets"):
+                key = bucket.get("key")
+                yield datetime.datetime.utcfromtimestamp(key.get("bucket") / 1000), \
+                    (key.get("zoneTag"), key.get("dataType"), str(key.get("dataKey"))), \
+                    [int(bucket.get(field).get("value")) for field in metric_fields]
+
+            if not groups.get("buckets") or groups.get("after_key") is None:
+                return True
+            composite["after"] = groups.get("after_key")
@@ -26,6 +26,7 @@ class DateTimeHelper(object):
     def __init__(self):
         self.CF_FETCH_DELAY_IN_SECONDS = config.cf_fetch_delay_in_seconds
         self.CF_DATA_INTERVAL_IN_SECONDS = config.cf_data_interval_in_seconds
+        self.CF_CATCHUP_INTERVAL_IN_SECONDS = config.cf_catchup_interval_in_seconds
 
     @staticmethod
     def time_mod(time, delta, epoch=None):
@@ -43,12 +44,26 @@ class DateTimeHelper(object):
     def determine_interval_datetime(self, reference_datetime):
         return reference_datetime + datetime.timedelta(seconds=self.CF_DATA_INTERVAL_IN_SECONDS)
 
+    def determine_catchup_interval_datetime(self, reference_datetime, max_interval_in_seconds=None):
+        interval = self.CF_CATCHUP_INTERVAL_IN_SECONDS
+        if max_interval_in_seconds is not None:
+            interval = min(interval, max_interval_in_seconds)
+        return min(reference_datetime + datetime.timedelta(seconds=interval), self.latest_complete_datetime())
+
+    def latest_complete_datetime(self):
+        return self.time_floor(self.current_ref_datetime(), datetime.timedelta(seconds=60))
+
     def is_need_catchup(self, ref_datetime):
         if self.determine_interval_datetime(ref_datetime) < self.current_ref_datetime():
             return True
 
         return False
 
+    # the window starting at ref_datetime can be fetched as soon as its end is older than the fetch-delay
+    def seconds_until_fetchable(self, ref_datetime):
+        due = self.determine_interval_datetime(ref_datetime) - self.current_ref_datetime()
+        return max(0.0, due.total_seconds())
+
     @staticmethod
     def format_datetime(dt):
         return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -0,0 +1,181 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import math
+import os
+import socket
+import threading
+import time
+import traceback
+
+from cloudflare import config
+
+MEMBER_PREFIX = "member-"
+ZONE_PREFIX = "zone-"
+PIPELINE_PREFIX = "pipeline-"
+
+
+def determine_replica_id():
+    return os.getenv(config.sharding_replica_id_env) or f"{socket.gethostname()}-{os.getpid()}"
+
+
+# local stand-in for the lease-methods of DataStore (same compare-and-set semantics as _seq_no/_primary_term)
+class MemoryLeaseStore(object):
+
+    def __init__(self):
+        self.leases = {}
+        self.seq_no = 0
+        self.lock = threading.Lock()
+
+    def find_leases(self):
+        with self.lock:
+            return {lease_id: (dict(lease), seq_no, 1) for lease_id, (lease, seq_no) in self.leases.items()}
+
+    def create_lease(self, lease_id, lease):
+        with self.lock:
+            if lease_id in self.leases:
+                return False
+            self.seq_no += 1
+            self.leases[lease_id] = (dict(lease), self.seq_no)
+            return True
+
+    def update_lease(self, lease_id, lease, seq_no, primary_term):
+        with self.lock:
+            if lease_id not in self.leases or self.leases.get(lease_id)[1] != seq_no or primary_term != 1:
+                return False
+            self.seq_no += 1
+            self.leases[lease_id] = (dict(lease), self.seq_no)
+            return True
+
+
+# every replica renews a member-lease and holds leases for its fair share (zones / live members, rounded up)
+# of the zones - expired leases of dead replicas are taken over, surplus leases are released for new replicas.
+# all writes are compare-and-set, so a zone is never owned by two replicas at the same time.
+# with another prefix, the leases guard something else than zones (e.g. a pipeline, that runs on one replica only)
+class ZoneLeases(object):
+
+    def __init__(self, store, replica_id, zone_tags, ttl_in_seconds=None, clock=time.time, prefix=ZONE_PREFIX):
+        self.store = store
+        self.replica_id = replica_id
+        self.zone_tags = sorted(zone_tags)
+        self.prefix = prefix
+        self.ttl_in_seconds = ttl_in_seconds if ttl_in_seconds is not None else config.sharding_lease_ttl_in_seconds
+        self.clock = clock
+
+    def _is_live(self, lease, now):
+        return lease.get("owner") is not None and lease.get("expires", 0) > now
+
+    def _lease(self, now):
+        return {"owner": self.replica_id, "expires": now + self.ttl_in_seconds}
+
+    def _put(self, leases, lease_id, lease):
+        if lease_id in leases:
+            _, seq_no, primary_term = leases.get(lease_id)
+            return self.store.update_lease(lease_id, lease, seq_no, primary_term)
+        return self.store.create_lease(lease_id, lease)
+
+    def fair_share(self, leases, now):
+        members = [lease for lease_id, (lease, _, _) in leases.items()
+                   if lease_id.startswith(MEMBER_PREFIX) and self._is_live(lease, now)]
+        return math.ceil(len(self.zone_tags) / max(1, len(members)))
+
+    def refresh(self):
+        now = self.clock()
+        leases = self.store.find_leases()
+        self._put(leases, MEMBER_PREFIX + self.replica_id, self._lease(now))
+        leases = self.store.find_leases()
+        share = self.fair_share(leases, now)
+
+        owned = []
+        free = []
+        for zone_tag in self.zone_tags:
+            lease = leases.get(self.prefix + zone_tag, ({}, None, None))[0]
+            if lease.get("owner") == self.replica_id and self._is_live(lease, now):
+                owned.append(zone_tag)
+            elif not self._is_live(lease, now):
+                free.append(zone_tag)
+
+        renewed = []
+        for zone_tag in owned:
+            if len(renewed) >= share:
+                self._put(leases, self.prefix + zone_tag, {"owner": None, "expires": 0})
+            elif self._put(leases, self.prefix + zone_tag, self._lease(now)):
+                renewed.append(zone_tag)
+        for zone_tag in free:
+            if len(renewed) >= share:
+                break
+            if self._put(leases, self.prefix + zone_tag, self._lease(now)):
+                renewed.append(zone_tag)
+
+        return sorted(renewed)
+
+    def release(self):
+        leases = self.store.find_leases()
+        for lease_id, (lease, _, _) in leases.items():
+            if lease.get("owner") == self.replica_id:
+                self._put(leases, lease_id, {"owner": None, "expires": 0})
+
+
+# renews the leases in the background - so they don't expire while the main loop is busy (e.g. with a backfill)
+class LeaseKeeper(threading.Thread):
+
+    def __init__(self, zone_leases, interval_in_seconds=None):
+        threading.Thread.__init__(self, name="lease-keeper", daemon=True)
+        self.zone_leases = zone_leases
+        self.interval = interval_in_seconds if interval_in_seconds is not None \
+            else config.sharding_renew_interval_in_seconds
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.owned = []
+        self.renewed_at = None
+
+    def owned_zones(self):
+        with self.lock:
+            return list(self.owned)
+
+    def refresh(self):
+        owned = self.zone_leases.refresh()
+        with self.lock:
+            if owned != self.owned:
+                print(f"{datetime.datetime.now()} - replica {self.zone_leases.replica_id} owns {len(owned)} zones: "
+                      f"{owned}")
+            self.owned = owned
+            self.renewed_at = time.monotonic()
+
+        return owned
+
+    # without renewal, the leases expire - from then on, other replicas may own the zones
+    def expire(self):
+        with self.lock:
+            if self.renewed_at is None or time.monotonic() - self.renewed_at > self.zone_leases.ttl_in_seconds:
+                self.owned = []
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error renewing leases: {e}")
+                print(f"{e}\nCaused by: {traceback.format_exc()}")
+                self.expire()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.zone_leases.release()
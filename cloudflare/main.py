@@ -17,41 +17,213 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
+import signal
 import time
 import traceback
 
 from cloudflare import analytics_api
+from cloudflare import async_pipeline
+from cloudflare import backfill
+from cloudflare import config
 from cloudflare import datastore
+from cloudflare import leases
+from cloudflare import metrics
 from cloudflare import no_concurrency
+from cloudflare import pipelines
+from cloudflare import profiling
+from cloudflare import rate_limit
+from cloudflare import rollup
+from cloudflare import scheduler
+from cloudflare import spool
 
 
 dt_helper = analytics_api.dt_helper
 ds = datastore.DataStore()
+profiler = profiling.create_profiler()
 
 
-def run_fetch_and_push(reference_dt, storage):
+# the documents are produced lazily - so the "index" span covers normalizing, serializing and the bulk-requests
+def index_window(result, start_datetime, to_datetime, storage, rollups=None, spooler=None, zone_ids=None):
+    data = analytics_api.normalize(result)
+    if rollups is not None:
+        data = rollups.track(data, start_datetime)
+
+    try:
+        with profiler.span("index"):
+            doc_amount = storage.store_documents(docs=data)
+    except Exception as e:
+        # only an unavailable elasticsearch is worth waiting for - other errors would fail the same way when drained
+        if spooler is None or not datastore.is_unavailable(e):
+            raise
+        if not spooler.append(start_datetime, to_datetime, result):
+            raise
+        print(f"{datetime.datetime.now()} - unable to index - spooled {start_datetime} - {to_datetime}: {e}")
+        return
+
+    print(f"{datetime.datetime.now()} - indexed {doc_amount} documents")
+    with profiler.span("checkpoint"):
+        storage.store_checkpoint(spooler.committed_datetime(to_datetime) if spooler is not None else to_datetime,
+                                 zone_ids)
+    if rollups is not None:
+        with profiler.span("rollups"):
+            commit_rollups(rollups, start_datetime, to_datetime, spooler)
+
+
+# the rollups are derived from the raw documents - failing to write them must never hold back the raw documents,
+# so the failed range is logged and rebuilt with the next commit instead
+def commit_rollups(rollups, start_datetime, to_datetime, spooler=None):
+    drained = spooler.pop_drained() if spooler is not None else []
+    try:
+        rollups.commit(to_datetime)
+        for drained_start, drained_end in drained:
+            rollups.rebuild(drained_start, drained_end)
+    except Exception as e:
+        failed_since = min([start_datetime] + [drained_start for drained_start, _ in drained])
+        print(f"{datetime.datetime.now()} - unable to write rollups from {failed_since} - rebuilding them later: {e}")
+        rollups.mark_failed(failed_since)
+
+
+def rebuild_rollups(rollups, start_datetime, end_datetime):
+    try:
+        rollups.rebuild(start_datetime, end_datetime)
+    except Exception as e:
+        print(f"{datetime.datetime.now()} - unable to rebuild rollups from {start_datetime} - retried later: {e}")
+        rollups.mark_failed(start_datetime)
+
+
+def run_fetch_and_push(reference_dt, storage, cf_client, rollups=None, spooler=None, schedule=None, zone_ids=None):
+    if schedule is None:
+        schedule = scheduler.Scheduler()
     start_datetime = dt_helper.time_floor(reference_dt, datetime.timedelta(seconds=60))
+    schedule.wait_until_fetchable(start_datetime)
 
     try:
-        data = analytics_api.fetch_cloudflare_analytics(start_datetime)
-        print(f"{datetime.datetime.now()} - indexing {len(data)} documents...")
-        storage.store_documents(docs=data)
+        with profiler.iteration():
+            to_datetime = analytics_api.determine_to_datetime(start_datetime)
+            with profiler.span("fetch"):
+                result = cf_client.fetch_raw(start_datetime, to_datetime, zone_ids)
+            index_window(result, start_datetime, to_datetime, storage, rollups, spooler, zone_ids)
+        schedule.succeeded()
 
-        reference_dt = dt_helper.determine_interval_datetime(start_datetime)
+        reference_dt = to_datetime
         if dt_helper.is_need_catchup(reference_dt):
-            print(f"{datetime.datetime.now()} - Still not up2date - use short wait-interval")
-            time.sleep(5)
-        else:
-            print(f"{datetime.datetime.now()} - up2date - going to sleep a while")
-            time.sleep(60)
+            print(f"{datetime.datetime.now()} - Still not up2date - continue with the next window")
+    except rate_limit.RateLimitError as e:
+        print(f"{datetime.datetime.now()} - {e} - continue in {e.retry_after_in_seconds:.0f}s")
     except Exception as e:
         print(f"Error processing data: {e}")
         print(f"{e}\nCaused by: {traceback.format_exc()}")
-        time.sleep(30)
+        schedule.failed()
 
     return reference_dt
 
 
+# every zone resumes from its own checkpoint (or its latest document, if there is no checkpoint yet)
+def determine_zone_start_datetimes(storage, zone_tags=None):
+    if zone_tags is None:
+        zone_tags = list(config.zones.keys())
+    zone_starts = storage.find_zone_checkpoints()
+    missing_zones = [zone_tag for zone_tag in zone_tags if zone_tag not in zone_starts]
+    if missing_zones:
+        zone_starts.update(storage.find_latest_zone_datetimes(missing_zones, pipelines.DATA_TYPES))
+
+    new_zone_start = dt_helper.latest_complete_datetime() - datetime.timedelta(
+        seconds=config.backfill_new_zones_in_seconds)
+    return {zone_tag: dt_helper.time_floor(zone_starts.get(zone_tag, new_zone_start), datetime.timedelta(seconds=60))
+            for zone_tag in zone_tags}
+
+
+def group_zones_by_start(zone_starts):
+    groups = {}
+    for zone_tag, start_datetime in zone_starts.items():
+        groups.setdefault(start_datetime, []).append(zone_tag)
+
+    return groups
+
+
+# zones lagging behind the most recent one are backfilled up to it, so all zones continue with the same window
+def catch_up_zones(zone_starts, storage, cf_client, rollups=None):
+    if not zone_starts:
+        return dt_helper.latest_complete_datetime()
+
+    ref_datetime = max(zone_starts.values())
+    committed_datetime = ref_datetime
+    for start_datetime, zone_ids in sorted(group_zones_by_start(zone_starts).items()):
+        if start_datetime >= ref_datetime:
+            continue
+
+        print(f"{datetime.datetime.now()} - catching up {zone_ids} from {start_datetime}")
+        zone_committed_datetime = create_backfill(storage, cf_client).run(start_datetime, ref_datetime, zone_ids)
+        if rollups is not None:
+            rebuild_rollups(rollups, start_datetime, zone_committed_datetime)
+        committed_datetime = min(committed_datetime, zone_committed_datetime)
+
+    return committed_datetime
+
+
+def is_need_backfill(ref_datetime):
+    gap = dt_helper.latest_complete_datetime() - ref_datetime
+    return gap > datetime.timedelta(seconds=config.backfill_threshold_in_seconds)
+
+
+def is_need_backfill_mode(zone_starts):
+    if not config.backfill_mode_enabled or not zone_starts:
+        return False
+    gap = dt_helper.latest_complete_datetime() - min(zone_starts.values())
+    return gap > datetime.timedelta(seconds=config.backfill_mode_threshold_in_seconds)
+
+
+def create_backfill(storage, cf_client):
+    if config.backfill_engine == "asyncio":
+        return async_pipeline.AsyncPipeline(storage)
+
+    return backfill.Backfill(storage, cf_client)
+
+
+def create_lease_keeper(storage):
+    if not config.sharding_enabled:
+        return None
+
+    zone_leases = leases.ZoneLeases(storage, leases.determine_replica_id(), config.zones.keys())
+    keeper = leases.LeaseKeeper(zone_leases)
+    keeper.refresh()
+    keeper.start()
+    return keeper
+
+
+# the backfill-mode of a crashed replica is only restored once its member-lease expired - which may be long after
+# this replica started (e.g. when the crashed replica was rescheduled under a new name), so it is checked regularly
+def recover_backfill_mode(storage):
+    try:
+        storage.recover_backfill_mode()
+    except Exception as e:
+        print(f"unable to recover backfill-mode: {e}")
+
+
+# with sharding, every pipeline has a lease of its own - so it runs on one replica only
+def create_pipeline_runners(storage, cf_client):
+    runners = []
+    for pipeline in pipelines.create_pipelines():
+        pipeline_leases = None
+        if config.sharding_enabled:
+            pipeline_leases = leases.ZoneLeases(storage, leases.determine_replica_id(), [pipeline.name],
+                                                prefix=leases.PIPELINE_PREFIX)
+        runners.append(pipelines.PipelineRunner(pipeline, storage, cf_client, pipeline_leases))
+
+    return runners
+
+
+def create_spool():
+    if not config.spool_enabled:
+        return None
+
+    try:
+        return spool.Spool()
+    except OSError as e:
+        print(f"unable to create spool in {config.spool_dir} - continue without spool: {e}")
+        return None
+
+
 def still_active(concurrency_checker):
     return concurrency_checker.is_valid_environment()
 
@@ -66,18 +238,93 @@ def verify_allowed_to_run(concurrency_checker):
     print(f"{datetime.datetime.now()} - GOT GREEN LIGHT (matching active environment) - proceed with startup...")
 
 
+# restores the settings left behind by a crashed exporter, then catches up and backfills all zones - the rollups
+# are rebuilt afterwards, once the backfill-mode is left and the backfilled documents are searchable
+def start_up(storage, cf_client, rollups=None, zone_ids=None):
+    storage.recover_backfill_mode()
+    zone_starts = determine_zone_start_datetimes(storage, zone_ids)
+    backfill_mode = is_need_backfill_mode(zone_starts)
+    if backfill_mode:
+        storage.enter_backfill_mode()
+    try:
+        ref_datetime = catch_up_zones(zone_starts, storage, cf_client)
+        if is_need_backfill(ref_datetime):
+            ref_datetime = create_backfill(storage, cf_client).run(ref_datetime, dt_helper.latest_complete_datetime(),
+                                                                   zone_ids)
+    finally:
+        if backfill_mode:
+            storage.exit_backfill_mode()
+
+    if rollups is not None and zone_starts and min(zone_starts.values()) < ref_datetime:
+        rebuild_rollups(rollups, min(zone_starts.values()), ref_datetime)
+
+    return ref_datetime
+
+
+# SIGTERM (e.g. a stopping POD) ends the process like Ctrl+C - so the backfill-mode is left and the leases are released
+def terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
 def main(storage):
     print("START cloudflare-analytics-exporter")
+    signal.signal(signal.SIGTERM, terminate)
     concurrency_checker = no_concurrency.NoConcurrency()
     verify_allowed_to_run(concurrency_checker)
 
+    metrics_server = None
+    if config.metrics_enabled:
+        metrics_server = metrics.MetricsServer()
+        metrics_server.start()
+
     storage.connect()
-    ref_datetime = storage.find_latest_reference_datetime()
-    if ref_datetime is None:
-        ref_datetime = dt_helper.current_ref_datetime()
+    cf_client = analytics_api.AnalyticsClient()
+    cf_client.connect()
+
+    rollups = rollup.Rollup(storage) if config.es_rollup_enabled else None
+    spooler = create_spool()
+    drainer = None
+    if spooler is not None:
+        drainer = spool.SpoolDrainer(spooler, storage)
+        drainer.start()
+    runners = create_pipeline_runners(storage, cf_client)
+    for runner in runners:
+        runner.start()
+
+    keeper = create_lease_keeper(storage)
+    zone_ids = keeper.owned_zones() if keeper is not None else None
+    if rollups is not None and zone_ids is not None:
+        rollups.limit_zones(zone_ids)
+
+    try:
+        ref_datetime = start_up(storage, cf_client, rollups, zone_ids)
 
-    while still_active(concurrency_checker):
-        ref_datetime = run_fetch_and_push(ref_datetime, storage)
+        schedule = scheduler.Scheduler()
+        while still_active(concurrency_checker):
+            if keeper is not None:
+                recover_backfill_mode(storage)
+            # zones taken over from another replica resume from their own checkpoints
+            if keeper is not None and keeper.owned_zones() != zone_ids:
+                zone_ids = keeper.owned_zones()
+                if rollups is not None:
+                    rollups.limit_zones(zone_ids)
+                ref_datetime = catch_up_zones(determine_zone_start_datetimes(storage, zone_ids), storage, cf_client,
+                                              rollups)
+            if zone_ids is not None and not zone_ids:
+                time.sleep(config.sharding_renew_interval_in_seconds)
+                continue
+            ref_datetime = run_fetch_and_push(ref_datetime, storage, cf_client, rollups, spooler, schedule,
+                                              zone_ids)
+    finally:
+        for runner in runners:
+            runner.stop()
+        if keeper is not None:
+            keeper.stop()
+        if drainer is not None:
+            drainer.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        cf_client.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import datetime
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cloudflare import config
+from cloudflare.datetime_helper import DateTimeHelper
+
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+dt_helper = DateTimeHelper()
+
+
+# metrics are rendered in the prometheus text-format, so no client-library is needed
+class Counter(object):
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+class Gauge(object):
+
+    def __init__(self, name, description, function=None):
+        self.name = name
+        self.description = description
+        self.value = None
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def render(self):
+        value = self.get()
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        if value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, description, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum {self.sum}")
+            lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+# lazily produced documents are timed while they are consumed - the histogram gets the total per iterable
+def timed(iterable, histogram):
+    elapsed = 0.0
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            histogram.observe(elapsed + time.perf_counter() - start)
+            return
+        elapsed += time.perf_counter() - start
+        yield item
+
+
+def _lag_in_seconds():
+    if committed_datetime.value is None:
+        return None
+    return (dt_helper.current_ref_datetime() - committed_datetime.value).total_seconds()
+
+
+def _committed_timestamp():
+    if committed_datetime.value is None:
+        return None
+    return (committed_datetime.value - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+fetch_duration = Histogram("cfae_fetch_duration_seconds", "Duration of cf-api queries")
+normalize_duration = Histogram("cfae_normalize_duration_seconds", "Duration of normalizing a fetched window")
+bulk_duration = Histogram("cfae_bulk_duration_seconds", "Duration of bulk-requests to elasticsearch")
+fetched_zones = Counter("cfae_fetched_zones_total", "Zones fetched from the cf-api (one per zone and query)")
+indexed_documents = Counter("cfae_indexed_documents_total", "Documents indexed into elasticsearch")
+bulk_bytes = Counter("cfae_bulk_bytes_total", "Bytes sent with serialized bulk-requests")
+bulk_rejections = Counter("cfae_bulk_rejections_total", "Documents rejected by elasticsearch")
+bulk_retries = Counter("cfae_bulk_retried_documents_total", "Documents re-sent after being rejected with 429")
+bulk_concurrency = Gauge("cfae_bulk_concurrency", "Bulk-requests currently allowed in flight")
+committed_datetime = Gauge("cfae_committed_timestamp_seconds", "End of the last committed window",
+                           function=_committed_timestamp)
+lag = Gauge("cfae_lag_seconds", "Delay between the last committed window and the latest fetchable datetime",
+            function=_lag_in_seconds)
+
+METRICS = [fetch_duration, normalize_duration, bulk_duration, fetched_zones, indexed_documents, bulk_bytes,
+           bulk_rejections, bulk_retries, bulk_concurrency, committed_datetime, lag]
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(threading.Thread):
+
+    def __init__(self, port=None):
+        threading.Thread.__init__(self, name="metrics-server", daemon=True)
+        self.server = ThreadingHTTPServer(("", port if port is not None else config.metrics_port),
+                                          MetricsRequestHandler)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
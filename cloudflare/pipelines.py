@@ -0,0 +1,244 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import abc
+import datetime
+import itertools
+import threading
+import gql
+
+from cloudflare import analytics_api
+from cloudflare import config
+from cloudflare import records
+from cloudflare import scheduler
+from cloudflare.datetime_helper import DateTimeHelper
+
+dt_helper = DateTimeHelper()
+MINUTE_IN_SECONDS = 60
+
+
+def _to_minutes(seconds):
+    return max(1, int(seconds) // MINUTE_IN_SECONDS) * MINUTE_IN_SECONDS
+
+
+# adaptive groups can be split by more than the requested dimensions - the values are summed up per
+# zone, minute, dataType and dataKey, so every document is written exactly once per window
+def sum_up(rows):
+    sums = {}
+    timestamps = {}
+    for zone_tag, datetime_str, data_type, data_key, requests in rows:
+        if datetime_str not in timestamps:
+            timestamp = dt_helper.time_floor(datetime.datetime.strptime(datetime_str, "%Y-%m-%dT%H:%M:%SZ"),
+                                             datetime.timedelta(seconds=MINUTE_IN_SECONDS))
+            timestamps[datetime_str] = (timestamp, timestamp.strftime(records.DATETIME_FORMAT))
+        key = (zone_tag, timestamps[datetime_str], data_type, data_key)
+        sums[key] = sums.get(key, 0) + (requests or 0)
+
+    for (zone_tag, (timestamp, timestamp_str), data_type, data_key), requests in sums.items():
+        yield records.AnalyticsRecord(data_type, records.intern_key(data_key), records.intern_key(zone_tag),
+                                      records.intern_key(config.zones.get(zone_tag)), timestamp, timestamp_str,
+                                      requests=requests)
+
+
+# a dataset with its own query, normalizer, fetch-interval, window-size and checkpoint
+class Pipeline(abc.ABC):
+    name = None
+    query_file = None
+    # the dataTypes of the created documents
+    data_types = []
+
+    def __init__(self, interval_in_seconds, window_in_seconds):
+        self.interval = datetime.timedelta(seconds=_to_minutes(interval_in_seconds))
+        self.window = datetime.timedelta(seconds=_to_minutes(window_in_seconds))
+        self.query = gql.gql(analytics_api.read_gql_query_from_file(filename=self.query_file))
+
+    def create_parameters(self, start_datetime, end_datetime):
+        return {
+            "limit": config.cf_query_limit,
+            "mintime": dt_helper.format_datetime(start_datetime),
+            "maxtime": dt_helper.format_datetime(end_datetime)
+        }
+
+    # the parameters of all queries of a window (e.g. one per batch of zones)
+    def create_queries(self, start_datetime, end_datetime):
+        return [self.create_parameters(start_datetime, end_datetime)]
+
+    # a list of groups, that reached the limit, may have lost groups
+    @abc.abstractmethod
+    def is_truncated(self, result):
+        pass
+
+    @abc.abstractmethod
+    def normalize(self, result):
+        pass
+
+
+class FirewallEventsPipeline(Pipeline):
+    name = "firewallEvents"
+    query_file = "firewall-events.graphql"
+    data_types = ["firewallEvent"]
+
+    def create_queries(self, start_datetime, end_datetime):
+        batches = analytics_api.create_zone_batches(list(config.zones.keys()),
+                                                    (end_datetime - start_datetime).total_seconds())
+        return [dict(self.create_parameters(start_datetime, end_datetime), zoneIDs=batch) for batch in batches]
+
+    def is_truncated(self, result):
+        return any(len(item.get("firewallEventsAdaptiveGroups")) >= config.cf_query_limit
+                   for item in result.get("viewer").get("zones"))
+
+    def normalize(self, result):
+        rows = []
+        for item in result.get("viewer").get("zones"):
+            for group in item.get("firewallEventsAdaptiveGroups"):
+                dimensions = group.get("dimensions")
+                rows.append((item.get("zoneTag"), dimensions.get("datetimeMinute"), "firewallEvent",
+                             f"{dimensions.get('action')}/{dimensions.get('source')}", group.get("count")))
+        return sum_up(rows)
+
+
+# workers belong to the account - its tag takes the place of the zoneTag
+class WorkerInvocationsPipeline(Pipeline):
+    name = "workerInvocations"
+    query_file = "workers-invocations.graphql"
+    data_types = ["workerInvocations", "workerErrors"]
+
+    def create_parameters(self, start_datetime, end_datetime):
+        return dict(Pipeline.create_parameters(self, start_datetime, end_datetime), accountTag=config.cf_account_tag)
+
+    def is_truncated(self, result):
+        return any(len(account.get("workersInvocationsAdaptive")) >= config.cf_query_limit
+                   for account in result.get("viewer").get("accounts"))
+
+    def normalize(self, result):
+        rows = []
+        for account in result.get("viewer").get("accounts"):
+            for group in account.get("workersInvocationsAdaptive"):
+                dimensions = group.get("dimensions")
+                sums = group.get("sum")
+                rows.append((config.cf_account_tag, dimensions.get("datetimeMinute"), "workerInvocations",
+                             dimensions.get("scriptName"), sums.get("requests")))
+                rows.append((config.cf_account_tag, dimensions.get("datetimeMinute"), "workerErrors",
+                             dimensions.get("scriptName"), sums.get("errors")))
+        return sum_up(rows)
+
+
+PIPELINES = {pipeline.name: pipeline for pipeline in [FirewallEventsPipeline, WorkerInvocationsPipeline]}
+# documents of the pipelines share the raw index, but aren't rolled up
+DATA_TYPES = [data_type for pipeline in PIPELINES.values() for data_type in pipeline.data_types]
+
+
+def create_pipelines():
+    return [PIPELINES[name](settings.get("interval_in_seconds"), settings.get("window_in_seconds"))
+            for name, settings in config.cf_pipelines.items() if settings.get("enabled")]
+
+
+# fetches one pipeline as soon as "interval" of new data is complete (back-to-back while catching up),
+# independent of the http totals and all other pipelines.
+# with sharding, only the replica holding the lease of the pipeline runs it
+class PipelineRunner(threading.Thread):
+
+    def __init__(self, pipeline, storage, cf_client, pipeline_leases=None):
+        threading.Thread.__init__(self, name=f"pipeline-{pipeline.name}", daemon=True)
+        self.pipeline = pipeline
+        self.storage = storage
+        self.cf_client = cf_client
+        self.pipeline_leases = pipeline_leases
+        self.stopped = threading.Event()
+        self.schedule = scheduler.Scheduler(sleep=self.stopped.wait)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def determine_start_datetime(self):
+        checkpoint = self.storage.find_pipeline_checkpoint(self.pipeline.name)
+        if checkpoint is not None:
+            return checkpoint
+
+        return dt_helper.latest_complete_datetime() - self.pipeline.window
+
+    def is_owner(self):
+        if self.pipeline_leases is None:
+            return True
+        try:
+            return bool(self.pipeline_leases.refresh())
+        except Exception as e:
+            print(f"{datetime.datetime.now()} - unable to renew the lease of pipeline {self.pipeline.name}: {e}")
+            return False
+
+    # the lease is renewed at least every sharding_renew_interval_in_seconds - a replica, that lost it, continues
+    # from the checkpoint of the new owner once it gets the lease back
+    def run(self):
+        ref_datetime = None
+        while not self.stopped.is_set():
+            if not self.is_owner():
+                ref_datetime = None
+                self.stopped.wait(config.sharding_renew_interval_in_seconds)
+                continue
+            if ref_datetime is None:
+                ref_datetime = self.determine_start_datetime()
+
+            delay = (ref_datetime + self.pipeline.interval - dt_helper.current_ref_datetime()).total_seconds()
+            if delay > 0:
+                if self.pipeline_leases is not None:
+                    delay = min(delay, config.sharding_renew_interval_in_seconds)
+                self.stopped.wait(delay)
+            else:
+                ref_datetime = self.run_once(ref_datetime)
+
+    # a truncated result is fetched again in halves of the window - down to single minutes
+    def fetch(self, parameters, start_datetime, end_datetime):
+        result = self.cf_client.execute(self.pipeline.query, parameters)
+        if not self.pipeline.is_truncated(result):
+            return [result]
+
+        minutes = int((end_datetime - start_datetime).total_seconds()) // MINUTE_IN_SECONDS
+        if minutes <= 1:
+            print(f"{datetime.datetime.now()} - WARNING: pipeline {self.pipeline.name} reached the limit of "
+                  f"{config.cf_query_limit} groups for {start_datetime} - groups beyond the limit are lost")
+            return [result]
+
+        middle_datetime = start_datetime + datetime.timedelta(minutes=minutes // 2)
+        print(f"{datetime.datetime.now()} - pipeline {self.pipeline.name} reached the limit of "
+              f"{config.cf_query_limit} groups - splitting {start_datetime} - {end_datetime} at {middle_datetime}")
+        results = []
+        for window_start, window_end in ((start_datetime, middle_datetime), (middle_datetime, end_datetime)):
+            results.extend(self.fetch(dict(parameters, mintime=dt_helper.format_datetime(window_start),
+                                           maxtime=dt_helper.format_datetime(window_end)), window_start, window_end))
+        return results
+
+    def run_once(self, ref_datetime):
+        to_datetime = min(ref_datetime + self.pipeline.window, dt_helper.latest_complete_datetime())
+        try:
+            results = []
+            for parameters in self.pipeline.create_queries(ref_datetime, to_datetime):
+                results.extend(self.fetch(parameters, ref_datetime, to_datetime))
+            doc_amount = self.storage.store_documents(
+                itertools.chain.from_iterable(self.pipeline.normalize(result) for result in results))
+            self.storage.store_pipeline_checkpoint(self.pipeline.name, to_datetime)
+        except Exception as e:
+            print(f"{datetime.datetime.now()} - pipeline {self.pipeline.name} failed for "
+                  f"{ref_datetime} - {to_datetime}: {e}")
+            self.schedule.failed()
+            return ref_datetime
+
+        self.schedule.succeeded()
+        print(f"{datetime.datetime.now()} - pipeline {self.pipeline.name} committed {doc_amount} documents "
+              f"up to {to_datetime}")
+        return to_datetime
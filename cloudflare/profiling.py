@@ -0,0 +1,103 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import cProfile
+import datetime
+import os
+import pstats
+import time
+
+from cloudflare import config
+
+NO_SPAN = contextlib.nullcontext()
+
+
+# profiling is switched on by environment variables only, so the same image can be profiled in production
+class NoProfiler(object):
+
+    def iteration(self):
+        return NO_SPAN
+
+    def span(self, name):
+        return NO_SPAN
+
+
+class Profiler(object):
+
+    def __init__(self, profile_dir, every=None, slow_threshold_in_seconds=None):
+        self.profile_dir = profile_dir
+        self.every = every if every is not None else config.profile_every
+        self.slow_threshold_in_seconds = slow_threshold_in_seconds if slow_threshold_in_seconds is not None \
+            else config.profile_slow_threshold_in_seconds
+        self.iterations = 0
+        self.spans = {}
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+    # cProfile only sees the calling thread - parallel zone-batches are covered by the "fetch" span only
+    @contextlib.contextmanager
+    def iteration(self):
+        self.iterations += 1
+        self.spans = {}
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            spans = ", ".join(f"{name}={duration:.3f}s" for name, duration in self.spans.items())
+            print(f"{datetime.datetime.now()} - iteration {self.iterations} took {elapsed:.3f}s ({spans})")
+            if elapsed >= self.slow_threshold_in_seconds:
+                self.dump(profile, elapsed, "slow")
+            elif self.every > 0 and self.iterations % self.every == 0:
+                self.dump(profile, elapsed, "periodic")
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+    # a binary dump for pstats/snakeviz and a text-summary with the spans and the top functions
+    def dump(self, profile, elapsed, reason):
+        name = f"profile-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}-{self.iterations}-{reason}"
+        path = os.path.join(self.profile_dir, name)
+        profile.dump_stats(f"{path}.pstats")
+        with open(f"{path}.txt", "w") as f:
+            f.write(f"iteration {self.iterations} took {elapsed:.3f}s ({reason})\n")
+            for span_name, duration in self.spans.items():
+                f.write(f"{span_name}: {duration:.3f}s\n")
+            f.write("\n")
+            pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(config.profile_top_functions)
+        print(f"{datetime.datetime.now()} - wrote profile {path}.pstats")
+
+
+def create_profiler():
+    profile_dir = os.getenv(config.profile_dir_env)
+    if not profile_dir:
+        return NoProfiler()
+
+    every = os.getenv(config.profile_every_env)
+    slow_threshold = os.getenv(config.profile_slow_threshold_env)
+    print(f"profiling enabled - writing profiles to {profile_dir}")
+    return Profiler(profile_dir, every=int(every) if every else None,
+                    slow_threshold_in_seconds=float(slow_threshold) if slow_threshold else None)
@@ -0,0 +1,135 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import email.utils
+import threading
+import time
+
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+from cloudflare import config
+
+
+class RateLimitError(Exception):
+
+    def __init__(self, message, retry_after_in_seconds):
+        Exception.__init__(self, message)
+        self.retry_after_in_seconds = retry_after_in_seconds
+
+
+# the cf-api quota is a budget of queries per period - the bucket refills continuously, so the budget can be used
+# up in bursts but never exceeded. After a rate-limit response, no tokens are handed out until retry-after passed
+class TokenBucket(object):
+
+    def __init__(self, capacity, period_in_seconds):
+        self.capacity = capacity
+        self.rate = capacity / period_in_seconds
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def remaining(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return 0.0 if now < self.blocked_until else self.tokens
+
+    # returns 0 when the tokens were taken, otherwise the seconds to wait before trying again
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        while (wait := self.try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        while (wait := self.try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def block(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+def create_bucket():
+    return TokenBucket(config.cf_rate_limit_queries, config.cf_rate_limit_period_in_seconds)
+
+
+# Retry-After is either a number of seconds or a http-date
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(tz=retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _response_headers(error):
+    cause = error.__cause__
+    headers = getattr(cause, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(cause, "response", None), "headers", None)
+
+    return headers or {}
+
+
+def is_rate_limit_error(error):
+    if isinstance(error, TransportServerError):
+        return error.code == 429
+    # e.g. "rate limiter budget depleted, try again after 5 minutes"
+    if isinstance(error, TransportQueryError):
+        messages = [str(e.get("message")) for e in error.errors or []] or [str(error)]
+        return any("rate limit" in message.lower() for message in messages)
+    return False
+
+
+# blocks the bucket for the time requested by the cf-api and converts the error, so it can be told apart
+def handle_error(bucket, error):
+    if not is_rate_limit_error(error):
+        return error
+
+    retry_after = parse_retry_after(_response_headers(error).get("Retry-After"))
+    if retry_after is None:
+        retry_after = config.cf_rate_limit_pause_in_seconds
+    bucket.block(retry_after)
+    print(f"{datetime.datetime.now()} - cf-api rate-limit reached - pausing queries for {retry_after:.0f}s")
+
+    return RateLimitError(f"cf-api rate-limit reached: {error}", retry_after)
@@ -0,0 +1,156 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import sys
+
+from functools import lru_cache
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# in the positional order of AnalyticsRecord
+METRIC_FIELDS = ("uniques", "bytes", "cachedBytes", "cachedRequests", "encryptedBytes", "encryptedRequests",
+                 "pageViews", "requests")
+
+
+def create_document_id(zone_tag, timestamp_str, data_type, data_key):
+    key = f"{zone_tag}|{timestamp_str}|{data_type}|{data_key}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def intern_key(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+# zone-names, dataTypes and dataKeys repeat in every window - their JSON representation is only built once
+@lru_cache(maxsize=65536)
+def _json_value(value):
+    return json.dumps(value)
+
+
+def _json_number(value):
+    return "null" if value is None else str(value)
+
+
+# the strings are expected to be interned by the producer (see intern_key)
+class AnalyticsRecord(object):
+    __slots__ = ("data_type", "data_key", "zone_tag", "zone_name", "timestamp", "timestamp_str", "uniques", "bytes",
+                 "cached_bytes", "cached_requests", "encrypted_bytes", "encrypted_requests", "page_views", "requests")
+
+    # elasticsearch field -> attribute
+    FIELDS = {
+        "dataType": "data_type",
+        "dataKey": "data_key",
+        "zoneTag": "zone_tag",
+        "zoneName": "zone_name",
+        "@timestamp": "timestamp",
+        "uniques": "uniques",
+        "bytes": "bytes",
+        "cachedBytes": "cached_bytes",
+        "cachedRequests": "cached_requests",
+        "encryptedBytes": "encrypted_bytes",
+        "encryptedRequests": "encrypted_requests",
+        "pageViews": "page_views",
+        "requests": "requests"
+    }
+
+    def __init__(self, data_type, data_key, zone_tag, zone_name, timestamp, timestamp_str, uniques=0, bytes=0,
+                 cached_bytes=0, cached_requests=0, encrypted_bytes=0, encrypted_requests=0, page_views=0,
+                 requests=0):
+        self.data_type = data_type
+        self.data_key = data_key
+        self.zone_tag = zone_tag
+        self.zone_name = zone_name
+        self.timestamp = timestamp
+        self.timestamp_str = timestamp_str
+        self.uniques = uniques
+        self.bytes = bytes
+        self.cached_bytes = cached_bytes
+        self.cached_requests = cached_requests
+        self.encrypted_bytes = encrypted_bytes
+        self.encrypted_requests = encrypted_requests
+        self.page_views = page_views
+        self.requests = requests
+
+    def get(self, field, default=None):
+        attribute = self.FIELDS.get(field)
+        if attribute is None:
+            return default
+        return getattr(self, attribute)
+
+    def to_dict(self):
+        return {field: getattr(self, attribute) for field, attribute in self.FIELDS.items()}
+
+    def document_id(self):
+        return create_document_id(self.zone_tag, self.timestamp_str, self.data_type, self.data_key)
+
+    def to_json(self):
+        return f'{{"dataType":{_json_value(self.data_type)},"dataKey":{_json_value(self.data_key)},' \
+               f'"zoneTag":{_json_value(self.zone_tag)},"zoneName":{_json_value(self.zone_name)},' \
+               f'"@timestamp":"{self.timestamp_str}","uniques":{_json_number(self.uniques)},' \
+               f'"bytes":{_json_number(self.bytes)},"cachedBytes":{_json_number(self.cached_bytes)},' \
+               f'"cachedRequests":{_json_number(self.cached_requests)},' \
+               f'"encryptedBytes":{_json_number(self.encrypted_bytes)},' \
+               f'"encryptedRequests":{_json_number(self.encrypted_requests)},' \
+               f'"pageViews":{_json_number(self.page_views)},"requests":{_json_number(self.requests)}}}'
+
+
+def to_source(doc):
+    if isinstance(doc, AnalyticsRecord):
+        return doc.to_dict()
+    return doc
+
+
+# writes the NDJSON body of a bulk-request directly into one reused buffer
+class BulkBodyWriter(object):
+
+    def __init__(self, index, op_type, max_chunk_bytes):
+        self.action_prefix = f'{{"{op_type}":{{"_index":{json.dumps(index)},"_id":"'.encode("utf-8")
+        self.max_chunk_bytes = max_chunk_bytes
+        self.buffer = bytearray()
+
+    def _append(self, doc):
+        if isinstance(doc, AnalyticsRecord):
+            doc_id = doc.document_id()
+            source = doc.to_json()
+        else:
+            doc_id = create_document_id(doc.get("zoneTag"), doc.get("@timestamp").strftime(DATETIME_FORMAT),
+                                        doc.get("dataType"), doc.get("dataKey"))
+            source = json.dumps(doc, separators=(",", ":"), default=lambda value: value.strftime(DATETIME_FORMAT))
+        self.buffer += self.action_prefix
+        self.buffer += doc_id.encode("ascii")
+        self.buffer += b'"}}\n'
+        self.buffer += source.encode("utf-8")
+        self.buffer += b"\n"
+
+    # yields (body, doc_amount) - the body must be consumed before the next chunk is requested
+    def chunks(self, docs):
+        doc_amount = 0
+        for doc in docs:
+            self._append(doc)
+            doc_amount += 1
+            if len(self.buffer) >= self.max_chunk_bytes:
+                yield bytes(self.buffer), doc_amount
+                self.buffer.clear()
+                doc_amount = 0
+
+        if doc_amount > 0:
+            yield bytes(self.buffer), doc_amount
+            self.buffer.clear()
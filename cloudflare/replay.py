@@ -0,0 +1,96 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import datetime
+import itertools
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from cloudflare import analytics_api
+from cloudflare import capture
+from cloudflare import config
+from cloudflare import datastore
+from cloudflare import rollup
+from cloudflare.segments import read_segment
+
+INPUT_DATETIME_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"]
+
+
+def parse_datetime(value):
+    for datetime_format in INPUT_DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"invalid datetime: {value}")
+
+
+def _index_batch(storage, batch):
+    docs = itertools.chain.from_iterable(analytics_api.normalize(read_segment(path)) for _, _, path in batch)
+    return storage.store_documents(docs=docs)
+
+
+# captured windows are normalized with the current settings and indexed in large bulk-streams - checkpoints are
+# left untouched. Overlapping windows result in the same document IDs, so replaying twice does no harm
+def replay(storage, windows, batch_size=None, max_workers=None):
+    batch_size = batch_size if batch_size is not None else config.replay_batch_size
+    max_workers = max_workers if max_workers is not None else config.replay_max_workers
+    batches = [windows[i:i + batch_size] for i in range(0, len(windows), batch_size)]
+
+    start = time.perf_counter()
+    doc_amount = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda batch: _index_batch(storage, batch), batches)
+        for batch, batch_doc_amount in zip(batches, results):
+            doc_amount += batch_doc_amount
+            print(f"{datetime.datetime.now()} - replayed {batch_doc_amount} documents "
+                  f"of {batch[0][0]} - {batch[-1][1]}")
+
+    print(f"{datetime.datetime.now()} - replayed {len(windows)} windows ({doc_amount} documents) "
+          f"in {time.perf_counter() - start:.1f}s")
+    return doc_amount
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="re-index captured cf-api results without calling the cf-api")
+    parser.add_argument("--from", dest="start", type=parse_datetime, required=True, help="e.g. 2022-09-01")
+    parser.add_argument("--to", dest="end", type=parse_datetime, required=True, help="exclusive, e.g. 2022-10-01")
+    parser.add_argument("--capture-dir", default=None)
+    parser.add_argument("--batch-size", type=int, default=None, help="windows per bulk-stream")
+    parser.add_argument("--workers", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(storage, argv=None):
+    args = parse_args(argv)
+    windows = capture.Capture(args.capture_dir).segments(args.start, args.end)
+    print(f"found {len(windows)} captured windows between {args.start} and {args.end}")
+    if not windows:
+        return 0
+
+    storage.connect()
+    doc_amount = replay(storage, windows, batch_size=args.batch_size, max_workers=args.workers)
+    if config.es_rollup_enabled:
+        rollup.Rollup(storage).rebuild(args.start, args.end)
+
+    return doc_amount
+
+
+if __name__ == '__main__':
+    main(datastore.DataStore())
@@ -0,0 +1,173 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+
+from cloudflare import config
+from cloudflare import pipelines
+from cloudflare import records
+from cloudflare.datetime_helper import DateTimeHelper
+
+MINUTE = datetime.timedelta(minutes=1)
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+# aggregates that were rebuilt from the raw index (e.g. the part of an hour before a restart)
+SEED = "seed"
+
+
+# keeps the aggregates of the currently open hours (per minute) and days (per hour) in memory.
+# minutes are replaced instead of added up, so overlapping or repeated windows are never counted twice.
+class Rollup(object):
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.dt_helper = DateTimeHelper()
+        self.hours = {}
+        self.days = {}
+        self.pending = {}
+        self.zone_ids = None
+        # start of the range, whose rollups failed to be written - rebuilt with the next commit
+        self.failed_since = None
+
+    # with sharding, only the zones owned by this replica are aggregated (None = all zones) - the open hours and
+    # days are seeded again for the new zones
+    def limit_zones(self, zone_ids):
+        self.zone_ids = set(zone_ids) if zone_ids is not None else None
+        self.hours = {}
+        self.days = {}
+        self.pending = {}
+
+    @staticmethod
+    def _add(target, key, metrics):
+        existing = target.get(key)
+        if existing is None:
+            target[key] = list(metrics)
+        else:
+            for i, value in enumerate(metrics):
+                existing[i] += value
+
+    @staticmethod
+    def _sum(parts):
+        totals = {}
+        for part in parts.values():
+            for key, metrics in part.items():
+                Rollup._add(totals, key, metrics)
+
+        return totals
+
+    def _aggregate(self, start_datetime, end_datetime, interval):
+        totals = {}
+        if start_datetime < end_datetime:
+            for _, key, metrics in self.storage.aggregate_documents(start_datetime, end_datetime, interval,
+                                                                    records.METRIC_FIELDS, self.zone_ids,
+                                                                    pipelines.DATA_TYPES):
+                self._add(totals, key, metrics)
+
+        return totals
+
+    # after a restart, the already indexed part of the current hour and day is rebuilt from the raw index
+    def _seed(self, start_datetime):
+        hour_start = self.dt_helper.time_floor(start_datetime, HOUR)
+        day_start = self.dt_helper.time_floor(start_datetime, DAY)
+        if hour_start not in self.hours or day_start not in self.days:
+            self.storage.refresh_documents()
+
+        if hour_start not in self.hours:
+            self.hours[hour_start] = {SEED: self._aggregate(hour_start, start_datetime, "1h")}
+
+        if day_start not in self.days:
+            self.days[day_start] = {SEED: self._aggregate(day_start, hour_start, "1d")}
+
+    def track(self, docs, start_datetime):
+        self._seed(start_datetime)
+        self.pending = {}
+        for doc in docs:
+            if self.zone_ids is not None and doc.get("zoneTag") not in self.zone_ids:
+                yield doc
+                continue
+            key = (doc.get("zoneTag"), doc.get("dataType"), str(doc.get("dataKey")))
+            self._add(self.pending.setdefault(doc.get("@timestamp"), {}), key,
+                      [doc.get(field) or 0 for field in records.METRIC_FIELDS])
+            yield doc
+
+    def mark_failed(self, start_datetime):
+        if self.failed_since is None or start_datetime < self.failed_since:
+            self.failed_since = start_datetime
+
+    # must only be called once the tracked documents are indexed
+    def commit(self, end_datetime):
+        if self.failed_since is not None:
+            self.pending = {}
+            self.rebuild(self.failed_since, end_datetime)
+            print(f"{datetime.datetime.now()} - rebuilt the failed rollups from {self.failed_since}")
+            self.failed_since = None
+            return
+
+        touched_hours = set()
+        for minute, aggregates in self.pending.items():
+            hour_start = self.dt_helper.time_floor(minute, HOUR)
+            self.hours.setdefault(hour_start, {})[minute] = aggregates
+            touched_hours.add(hour_start)
+        self.pending = {}
+
+        touched_days = set()
+        for hour_start in sorted(touched_hours):
+            totals = self._sum(self.hours[hour_start])
+            self.storage.store_rollups("1h", self._create_docs(hour_start, "1h", totals))
+            day_start = self.dt_helper.time_floor(hour_start, DAY)
+            self.days.setdefault(day_start, {})[hour_start] = totals
+            touched_days.add(day_start)
+
+        for day_start in sorted(touched_days):
+            self.storage.store_rollups("1d", self._create_docs(day_start, "1d", self._sum(self.days[day_start])))
+
+        self._evict(self.dt_helper.time_floor(end_datetime, MINUTE))
+
+    def _evict(self, next_start_datetime):
+        self.hours = {start: parts for start, parts in self.hours.items() if start + HOUR > next_start_datetime}
+        self.days = {start: parts for start, parts in self.days.items() if start + DAY > next_start_datetime}
+
+    # used after a backfill, which indexes partitions out of order
+    def rebuild(self, start_datetime, end_datetime):
+        self.storage.refresh_documents()
+        for interval, delta in (("1h", HOUR), ("1d", DAY)):
+            buckets = {}
+            for bucket_start, key, metrics in self.storage.aggregate_documents(
+                    self.dt_helper.time_floor(start_datetime, delta), end_datetime, interval, records.METRIC_FIELDS,
+                    self.zone_ids, pipelines.DATA_TYPES):
+                self._add(buckets.setdefault(bucket_start, {}), key, metrics)
+
+            for bucket_start, totals in buckets.items():
+                self.storage.store_rollups(interval, self._create_docs(bucket_start, interval, totals))
+
+        self.hours = {}
+        self.days = {}
+
+    @staticmethod
+    def _create_docs(bucket_start, interval, totals):
+        for (zone_tag, data_type, data_key), metrics in totals.items():
+            doc = {
+                "dataType": data_type,
+                "dataKey": data_key,
+                "zoneTag": zone_tag,
+                "zoneName": config.zones.get(zone_tag),
+                "@timestamp": bucket_start,
+                "interval": interval
+            }
+            doc.update(zip(records.METRIC_FIELDS, metrics))
+            yield doc
@@ -0,0 +1,68 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import random
+import time
+
+from cloudflare import config
+from cloudflare.datetime_helper import DateTimeHelper
+
+
+dt_helper = DateTimeHelper()
+
+
+# wakes up exactly when the next window becomes fetchable - windows that are already complete (catch-up)
+# are processed back-to-back, failures are retried with exponential backoff and jitter
+class Scheduler(object):
+
+    # sleep can be replaced, e.g. by Event.wait to make waiting and the backoff interruptible
+    def __init__(self, sleep=None):
+        self.sleep = sleep
+        self.failures = 0
+        self.backoff_base = config.cf_retry_backoff_base_in_seconds
+        self.backoff_max = config.cf_retry_backoff_max_in_seconds
+
+    def wait_until_fetchable(self, ref_datetime):
+        delay = dt_helper.seconds_until_fetchable(ref_datetime)
+        if delay > 0:
+            print(f"{datetime.datetime.now()} - up2date - next window is fetchable in {delay:.1f}s")
+            self._sleep(delay)
+
+        return delay
+
+    def _sleep(self, delay):
+        if self.sleep is not None:
+            self.sleep(delay)
+        else:
+            time.sleep(delay)
+
+    def backoff_in_seconds(self):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** max(0, self.failures - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def succeeded(self):
+        self.failures = 0
+
+    def failed(self):
+        self.failures += 1
+        delay = self.backoff_in_seconds()
+        print(f"{datetime.datetime.now()} - retry in {delay:.1f}s ({self.failures} consecutive failures)")
+        self._sleep(delay)
+
+        return delay
@@ -0,0 +1,55 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import gzip
+import json
+import os
+
+SEGMENT_DATETIME_FORMAT = "%Y%m%dT%H%M%S"
+SEGMENT_SUFFIX = ".json.gz"
+
+
+def segment_name(start_datetime, end_datetime):
+    return f"{start_datetime.strftime(SEGMENT_DATETIME_FORMAT)}_" \
+           f"{end_datetime.strftime(SEGMENT_DATETIME_FORMAT)}{SEGMENT_SUFFIX}"
+
+
+# names may carry further parts after start and end (e.g. to tell captures of different zones apart)
+def parse_segment_name(name):
+    start, end = name[:-len(SEGMENT_SUFFIX)].split("_")[:2]
+    return datetime.datetime.strptime(start, SEGMENT_DATETIME_FORMAT), \
+        datetime.datetime.strptime(end, SEGMENT_DATETIME_FORMAT)
+
+
+def compress_result(result):
+    return gzip.compress(json.dumps(result).encode("utf-8"))
+
+
+# written to a temporary file first, so a crash never leaves a truncated segment behind
+def write_segment(path, data):
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def read_segment(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
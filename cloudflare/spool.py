@@ -0,0 +1,160 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import itertools
+import os
+import threading
+import traceback
+
+from cloudflare import analytics_api
+from cloudflare import config
+from cloudflare import datastore
+from cloudflare.segments import SEGMENT_SUFFIX, compress_result, parse_segment_name, read_segment, segment_name, \
+    write_segment
+
+
+QUARANTINE_DIR = "quarantine"
+
+
+# raw results of windows, that were fetched but couldn't be indexed, are kept on disk (one segment per window)
+# until the SpoolDrainer was able to index them - so fetching can continue while elasticsearch is unavailable
+class Spool(object):
+
+    def __init__(self, spool_dir=None, max_bytes=None, max_failures=None):
+        self.spool_dir = spool_dir if spool_dir is not None else config.spool_dir
+        self.max_bytes = max_bytes if max_bytes is not None else config.spool_max_bytes
+        self.max_failures = max_failures if max_failures is not None else config.spool_max_drain_failures
+        self.lock = threading.Lock()
+        self.drained = []
+        self.failures = {}
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+    def segments(self):
+        with self.lock:
+            names = sorted(name for name in os.listdir(self.spool_dir) if name.endswith(SEGMENT_SUFFIX))
+
+        return [(*parse_segment_name(name), os.path.join(self.spool_dir, name)) for name in names]
+
+    def size_in_bytes(self):
+        return sum(os.path.getsize(path) for _, _, path in self.segments())
+
+    def append(self, start_datetime, end_datetime, result):
+        data = compress_result(result)
+        if self.size_in_bytes() + len(data) > self.max_bytes:
+            print(f"{datetime.datetime.now()} - spool is full - unable to spool {start_datetime} - {end_datetime}")
+            return False
+
+        path = os.path.join(self.spool_dir, segment_name(start_datetime, end_datetime))
+        with self.lock:
+            write_segment(path, data)
+
+        return True
+
+    def remove_segment(self, path):
+        with self.lock:
+            os.remove(path)
+
+    # the checkpoint must not advance beyond the oldest window, that is still waiting in the spool
+    def committed_datetime(self, end_datetime):
+        segments = self.segments()
+        if segments:
+            return min(end_datetime, segments[0][0])
+        return end_datetime
+
+    def add_drained(self, start_datetime, end_datetime):
+        with self.lock:
+            self.drained.append((start_datetime, end_datetime))
+
+    def pop_drained(self):
+        with self.lock:
+            drained, self.drained = self.drained, []
+
+        return drained
+
+    # a segment, that still fails after max_failures drains, is moved aside - so it no longer holds back the checkpoint
+    def quarantine(self, path):
+        quarantine_dir = os.path.join(self.spool_dir, QUARANTINE_DIR)
+        with self.lock:
+            os.makedirs(quarantine_dir, exist_ok=True)
+            os.replace(path, os.path.join(quarantine_dir, os.path.basename(path)))
+            self.failures.pop(path, None)
+
+    def _failed(self, segment, e):
+        start_datetime, end_datetime, path = segment
+        with self.lock:
+            failures = self.failures.get(path, 0) + 1
+            self.failures[path] = failures
+
+        if failures < self.max_failures:
+            print(f"{datetime.datetime.now()} - unable to drain {start_datetime} - {end_datetime} "
+                  f"({failures}/{self.max_failures}): {e}")
+            return
+        self.quarantine(path)
+        print(f"{datetime.datetime.now()} - quarantined {start_datetime} - {end_datetime} after {failures} failed "
+              f"drains: {e}")
+
+    # indexes several segments with one bulk-stream and removes them afterwards
+    def drain(self, storage, batch_size=None):
+        batch_size = batch_size if batch_size is not None else config.spool_drain_batch_size
+        segments = self.segments()
+        for i in range(0, len(segments), batch_size):
+            self._drain_batch(storage, segments[i:i + batch_size])
+
+    # an unavailable elasticsearch stops the drain - any other error is accounted to the single segment causing it
+    def _drain_batch(self, storage, batch):
+        try:
+            docs = itertools.chain.from_iterable(
+                analytics_api.normalize(read_segment(path)) for _, _, path in batch)
+            doc_amount = storage.store_documents(docs=docs)
+        except Exception as e:
+            if datastore.is_unavailable(e):
+                raise
+            if len(batch) == 1:
+                self._failed(batch[0], e)
+                return
+            for segment in batch:
+                self._drain_batch(storage, [segment])
+            return
+
+        for start_datetime, end_datetime, path in batch:
+            self.remove_segment(path)
+            self.add_drained(start_datetime, end_datetime)
+        print(f"{datetime.datetime.now()} - drained {len(batch)} spooled windows ({doc_amount} documents)")
+
+
+class SpoolDrainer(threading.Thread):
+
+    def __init__(self, spool, storage):
+        threading.Thread.__init__(self, name="spool-drainer", daemon=True)
+        self.spool = spool
+        self.storage = storage
+        self.interval = config.spool_drain_interval_in_seconds
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                if self.spool.segments() and self.storage.is_available():
+                    self.spool.drain(self.storage)
+            except Exception as e:
+                print(f"Error draining spool: {e}")
+                print(f"{e}\nCaused by: {traceback.format_exc()}")
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,75 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+
+from unittest.mock import patch
+from elasticsearch import Elasticsearch
+from benchmark import generator
+from benchmark import run as sut
+from benchmark.fake_server import FakeServer
+from cloudflare import analytics_api, config
+from cloudflare.bulk_writer import BulkWriter
+from cloudflare.datastore import DataStore
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_create_response(self):
+        response = generator.create_response(zones=3, minutes=5, countries=40, status_codes=4, browsers=2,
+                                             content_types=3)
+
+        with patch.multiple(config, zones=generator.create_zone_mapping(3)):
+            docs = list(analytics_api.normalize_data(response))
+
+        self.assertEqual(generator.expected_doc_amount(zones=3, minutes=5, countries=40, status_codes=4, browsers=2,
+                                                       content_types=3), len(docs))
+        self.assertEqual(3, len(response.get("viewer").get("zones")))
+        self.assertEqual(generator.create_response(zones=3, minutes=5), generator.create_response(zones=3, minutes=5))
+
+    def test_fake_server(self):
+        fake_server = FakeServer().start()
+        storage = DataStore()
+        storage.es = Elasticsearch(fake_server.url)
+        storage.bulk_writer = BulkWriter(storage.es)
+        response = generator.create_response(zones=1, minutes=2)
+        try:
+            with patch.multiple(config, zones=generator.create_zone_mapping(1), es_bulk_fast_path=True):
+                result = storage.store_documents(analytics_api.normalize_data(response))
+        finally:
+            fake_server.stop()
+
+        self.assertEqual(generator.expected_doc_amount(zones=1, minutes=2), result)
+        self.assertEqual(1, fake_server.bulk_requests)
+        self.assertTrue(fake_server.bulk_bytes > 0)
+
+    def test_check_baseline(self):
+        baseline = {"normalize": {"docs_per_second": 1000, "peak_memory_bytes": 1000}}
+
+        self.assertEqual([], sut.check_baseline(
+            {"normalize": {"docs_per_second": 850, "peak_memory_bytes": 1100}}, baseline, 0.2))
+        self.assertEqual(2, len(sut.check_baseline(
+            {"normalize": {"docs_per_second": 700, "peak_memory_bytes": 1300}}, baseline, 0.2)))
+
+    def test_run(self):
+        with patch.multiple(config, zones=config.zones, cf_api_endpoint=config.cf_api_endpoint,
+                            cf_max_zones_per_query=config.cf_max_zones_per_query, cf_query_limit=config.cf_query_limit,
+                            es_rollup_enabled=config.es_rollup_enabled, es_bulk_fast_path=config.es_bulk_fast_path):
+            result = sut.run(["--zones", "2", "--minutes", "2", "--repeat", "1"])
+
+        self.assertEqual(0, result)
@@ -18,15 +18,19 @@
 
 import unittest
 import datetime
-import json
-import os
+import threading
+import types
 import gql
 
 import gql.transport.requests as gql_transport
 from graphql import DocumentNode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
 from mockito import when, mock, unstub, verify, ANY
+from gql.transport.exceptions import TransportServerError
 from cloudflare import analytics_api as sut
-from cloudflare import config
+from cloudflare import capture, config, rate_limit
+from test.fixtures import create_dummy_response
 
 
 class AnalyticsApiTest(unittest.TestCase):
@@ -49,40 +53,280 @@ class AnalyticsApiTest(unittest.TestCase):
 
         self.assertIsNotNone(result)
 
+    def test_build_query(self):
+        with patch.multiple(config, cf_datasets=["base", "country"]):
+            result = sut.build_query()
+
+        self.assertNotIn(sut.SELECTION_MARKER, result)
+        self.assertIn("uniques", result)
+        self.assertIn("clientCountryName", result)
+        self.assertIn("datetime", result)
+        self.assertNotIn("responseStatusMap", result)
+        self.assertNotIn("threats", result)
+        self.assertEqual(1, result.count("sum {"))
+        gql.gql(result)
+
+    def test_build_query_for_all_datasets(self):
+        result = sut.build_query(sut.DATASETS)
+
+        for field in set(path.split(".")[-1] for dataset in sut.DATASETS for path in dataset.fields):
+            self.assertIn(field, result)
+        gql.gql(result)
+
+    def test_normalize_data(self):
+        result = sut.normalize_data(create_dummy_response())
+
+        self.assertIsInstance(result, types.GeneratorType)
+        docs = list(result)
+        self.assertEqual(106, len(docs))
+        self.assertEqual(["base", "base"], [doc.get("dataType") for doc in docs if doc.get("dataType") == "base"])
+
+    def test_normalize_data_for_optional_datasets(self):
+        with patch.multiple(config, cf_datasets=["base", "httpVersion", "ipClass"]):
+            docs = list(sut.normalize_data(create_dummy_response()))
+
+        self.assertEqual({"base", "httpVersion", "ipClass"}, set(doc.get("dataType") for doc in docs))
+        self.assertIn("HTTP/2", [doc.get("dataKey") for doc in docs if doc.get("dataType") == "httpVersion"])
+
+    def test_reduce_to_top_n(self):
+        entries = [{"key": "a", "requests": 1, "bytes": 10}, {"key": "b", "requests": 5, "bytes": 50},
+                   {"key": "c", "requests": 3, "bytes": 30}, {"key": "d", "requests": 2, "bytes": 20}]
+
+        with patch.multiple(config, cf_top_n={"country": 2}):
+            result = sut.reduce_to_top_n(entries, "country", "key", "requests", ["requests", "bytes"])
+
+        self.assertEqual([{"key": "b", "requests": 5, "bytes": 50}, {"key": "c", "requests": 3, "bytes": 30},
+                          {"key": config.cf_top_n_other_key, "requests": 3, "bytes": 30}], result)
+
+    def test_reduce_to_top_n_for_disabled_reduction(self):
+        entries = [{"key": "a", "requests": 1}, {"key": "b", "requests": 5}]
+
+        with patch.multiple(config, cf_top_n={"country": 0}):
+            result = sut.reduce_to_top_n(entries, "country", "key", "requests", ["requests"])
+
+        self.assertEqual(entries, result)
+
+    def test_normalize_data_for_top_n(self):
+        dummy_response = create_dummy_response()
+        expected_totals = self._sum_by_data_type(sut.normalize_data(dummy_response))
+
+        with patch.multiple(config, cf_top_n={"country": 1, "browser": 1, "contentType": 1}):
+            docs = list(sut.normalize_data(dummy_response))
+
+        self.assertLess(len(docs), 106)
+        self.assertEqual(expected_totals, self._sum_by_data_type(docs))
+        country_keys = [doc.get("dataKey") for doc in docs if doc.get("dataType") == "country"]
+        self.assertIn(config.cf_top_n_other_key, country_keys)
+
     @staticmethod
-    def _create_dummy_response():
-        with open(os.path.dirname(__file__) + f"/../resources/dummy-response.json", 'r') as f:
-            gql_query = f.read()
+    def _sum_by_data_type(docs):
+        totals = {}
+        for doc in docs:
+            key = (doc.get("zoneTag"), doc.get("dataType"))
+            totals[key] = [a + (b or 0) for a, b in zip(totals.get(key, [0, 0, 0]),
+                                                        [doc.get("requests"), doc.get("bytes"), doc.get("pageViews")])]
+        return totals
+
+    def test_determine_to_datetime_for_up2date_ref(self):
+        expected_result = self.dummy_datetime + datetime.timedelta(seconds=config.cf_data_interval_in_seconds)
+        when(sut.dt_helper).is_need_catchup(ANY).thenReturn(False)
+
+        result = sut.determine_to_datetime(self.dummy_datetime)
+
+        self.assertEqual(expected_result, result)
+
+    def test_determine_to_datetime_for_catchup(self):
+        expected_result = self.dummy_datetime + datetime.timedelta(minutes=60)
+        when(sut.dt_helper).is_need_catchup(ANY).thenReturn(True)
+        when(sut.dt_helper).determine_catchup_interval_datetime(ANY, max_interval_in_seconds=ANY)\
+            .thenReturn(expected_result)
+
+        result = sut.determine_to_datetime(self.dummy_datetime)
+
+        self.assertEqual(expected_result, result)
+        verify(sut.dt_helper, times=1).determine_catchup_interval_datetime(
+            self.dummy_datetime, max_interval_in_seconds=sut.determine_max_interval_in_seconds())
+
+    def test_determine_max_interval_in_seconds(self):
+        with patch.multiple(config, cf_query_limit=100, zones={"a": "a.tld", "b": "b.tld", "c": "c.tld"}):
+            result = sut.determine_max_interval_in_seconds()
+
+        self.assertEqual(33 * 60, result)
+
+    def test_create_zone_batches(self):
+        zone_ids = [str(i) for i in range(10)]
+
+        with patch.multiple(config, cf_query_limit=240, cf_max_zones_per_query=50):
+            result = sut.create_zone_batches(zone_ids, 3600)
+
+        self.assertEqual([["0", "1", "2", "3"], ["4", "5", "6", "7"], ["8", "9"]], result)
+
+    def test_create_zone_batches_for_max_zones_per_query(self):
+        zone_ids = [str(i) for i in range(10)]
+
+        with patch.multiple(config, cf_query_limit=9999, cf_max_zones_per_query=5):
+            result = sut.create_zone_batches(zone_ids, 61)
+
+        self.assertEqual([zone_ids[:5], zone_ids[5:]], result)
+
+    def test_merge_results(self):
+        dummy_response = create_dummy_response()
+
+        result = sut.merge_results([dummy_response, dummy_response])
+
+        self.assertEqual(4, len(result.get("viewer").get("zones")))
 
-        return json.loads(gql_query)
+    def _create_client(self):
+        self.dummy_client = mock(gql.Client)
+        self.dummy_transport = mock(gql_transport.RequestsHTTPTransport)
+        self.dummy_query = mock(DocumentNode)
+        self.dummy_session = mock()
+
+        when(gql_transport).RequestsHTTPTransport(url=ANY(), verify=ANY(), headers=ANY())\
+            .thenReturn(self.dummy_transport)
+        when(gql).Client(...).thenReturn(self.dummy_client)
+        when(gql).gql(ANY()).thenReturn(self.dummy_query)
+        when(self.dummy_client).connect_sync().thenReturn(self.dummy_session)
+        self.dummy_transport.session = mock()
+
+        return sut.AnalyticsClient()
+
+    def test_analytics_client_connect(self):
+        expected_cf_headers = {"X-AUTH-EMAIL": config.cf_api_user, "Authorization": f"Bearer None",
+                               "Accept-Encoding": "gzip"}
+        client = self._create_client()
+
+        client.connect()
+
+        self.assertEqual(self.dummy_session, client.session)
+        verify(gql_transport, times=1).RequestsHTTPTransport(
+            url=config.cf_api_endpoint, verify=True, headers=expected_cf_headers)
+        verify(gql, times=1).Client(transport=self.dummy_transport, fetch_schema_from_transport=False)
+        verify(gql, times=1).gql(ANY(str))
+        verify(self.dummy_client, times=1).connect_sync()
+        verify(self.dummy_transport.session, times=1).mount("https://", ANY)
+
+    def test_analytics_client_close(self):
+        client = self._create_client()
+        client.connect()
+        when(self.dummy_client).close_sync()
+
+        client.close()
+
+        self.assertIsNone(client.session)
+        verify(self.dummy_client, times=1).close_sync()
+
+    def test_fetch_cloudflare_analytics_for_multiple_batches(self):
+        dummy_response = create_dummy_response()
+        to_datetime = self.dummy_datetime + datetime.timedelta(minutes=60)
+        client = self._create_client()
+        when(client)._fetch_zone_batch(ANY, ANY, ANY).thenReturn(dummy_response)
+
+        with patch.multiple(config, cf_max_zones_per_query=1):
+            result = client.fetch_cloudflare_analytics(self.dummy_datetime, to_datetime)
+
+        self.assertEqual(212, len(list(result)))
+        for zone_tag in config.zones.keys():
+            verify(client, times=1)._fetch_zone_batch(self.dummy_datetime, to_datetime, [zone_tag])
 
     def test_fetch_cloudflare_analytics(self):
         expected_doc_amount = 106
-        expected_cf_headers = {"X-AUTH-EMAIL": config.cf_api_user, "Authorization": f"Bearer None"}
         expected_parameters = {
             "limit": 9999,
             "mintime": "2022-09-20T12:12:00Z",
             "maxtime": "2022-09-20T12:13:01Z",
             "zoneIDs": list(config.zones.keys())
         }
+        client = self._create_client()
+        client.connect()
+        when(self.dummy_session).execute(...).thenReturn(create_dummy_response())
 
-        dummy_client = mock(gql.Client)
-        dummy_transport = mock(gql_transport.RequestsHTTPTransport)
-        dummy_query = mock(DocumentNode)
-
-        when(gql_transport).RequestsHTTPTransport(url=ANY(), verify=ANY(), retries=ANY(), headers=ANY())\
-            .thenReturn(dummy_transport)
-        when(gql).Client(...).thenReturn(dummy_client)
-        when(gql).gql(ANY()).thenReturn(dummy_query)
-        when(dummy_client).execute(...).thenReturn(self._create_dummy_response())
-
-        result = sut.fetch_cloudflare_analytics(self.dummy_datetime)
+        result = client.fetch_cloudflare_analytics(self.dummy_datetime)
+        result2 = client.fetch_cloudflare_analytics(self.dummy_datetime)
 
         self.assertIsNotNone(result)
-        self.assertEqual(expected_doc_amount, len(result))
+        self.assertEqual(expected_doc_amount, len(list(result)))
+        self.assertEqual(expected_doc_amount, len(list(result2)))
 
-        verify(gql_transport, times=1).RequestsHTTPTransport(
-            url=config.cf_api_endpoint, verify=True, retries=3, headers=expected_cf_headers)
-        verify(gql, times=1).Client(transport=dummy_transport, fetch_schema_from_transport=False)
+        verify(gql_transport, times=1).RequestsHTTPTransport(...)
         verify(gql, times=1).gql(ANY(str))
-        verify(dummy_client, times=1).execute(dummy_query, variable_values=expected_parameters)
+        verify(self.dummy_session, times=2).execute(self.dummy_query, variable_values=expected_parameters)
+
+    def test_fetch_raw(self):
+        dummy_response = create_dummy_response()
+        client = self._create_client()
+        client.connect()
+        when(self.dummy_session).execute(...).thenReturn(dummy_response)
+
+        result = client.fetch_raw(self.dummy_datetime)
+
+        self.assertEqual(dummy_response.get("viewer").get("zones"), result.get("viewer").get("zones"))
+
+    def test_fetch_raw_for_rate_limit(self):
+        client = self._create_client()
+        client.rate_limiter = rate_limit.TokenBucket(10, 10)
+        client.connect()
+        when(self.dummy_session).execute(...).thenRaise(TransportServerError("TEST", 429))
+
+        with self.assertRaises(rate_limit.RateLimitError):
+            client.fetch_raw(self.dummy_datetime)
+
+        self.assertEqual(0.0, client.rate_limiter.remaining())
+
+    # the transport must not retry (or sleep on) a 429 - the rate-limiter handles it
+    def test_execute_for_rate_limit_response(self):
+        hits = []
+
+        class RateLimitHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                hits.append(self.path)
+                self.rfile.read(int(self.headers.get("Content-Length")))
+                self.send_response(429)
+                self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), RateLimitHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with patch.multiple(config, cf_api_endpoint=f"http://127.0.0.1:{server.server_port}/graphql"):
+                client = sut.AnalyticsClient()
+            client.rate_limiter = rate_limit.TokenBucket(10, 10)
+            client.connect()
+            with self.assertRaises(rate_limit.RateLimitError):
+                client.execute(gql.gql("{ viewer { zones { zoneTag } } }"), {})
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(1, len(hits))
+
+    def test_execute(self):
+        client = self._create_client()
+        client.rate_limiter = rate_limit.TokenBucket(10, 10)
+        client.connect()
+        dummy_query = mock()
+        when(self.dummy_session).execute(dummy_query, variable_values={"limit": 1}).thenReturn({"viewer": {}})
+
+        result = client.execute(dummy_query, {"limit": 1})
+
+        self.assertEqual({"viewer": {}}, result)
+        self.assertLess(client.rate_limiter.remaining(), 10)
+
+    def test_fetch_raw_for_capture(self):
+        dummy_capture = mock(capture.Capture)
+        when(dummy_capture).store(...)
+        dummy_response = create_dummy_response()
+        client = self._create_client()
+        client.capture = dummy_capture
+        client.connect()
+        when(self.dummy_session).execute(...).thenReturn(dummy_response)
+
+        result = client.fetch_raw(self.dummy_datetime, zone_ids=["zone1"])
+
+        verify(dummy_capture, times=1).store(self.dummy_datetime, self.dummy_datetime + datetime.timedelta(seconds=61),
+                                             ["zone1"], result)
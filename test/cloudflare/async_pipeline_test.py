@@ -0,0 +1,115 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import datetime
+import time
+import unittest
+
+from mockito import when, mock, unstub, verify, ANY
+from cloudflare import analytics_api, async_pipeline, datastore
+from cloudflare.async_pipeline import AsyncPipeline
+from test.fixtures import create_dummy_response
+
+
+class DummyAsyncSession(object):
+
+    def __init__(self, response, fail_for=None, delay_in_seconds=0):
+        self.response = response
+        self.fail_for = fail_for
+        self.delay_in_seconds = delay_in_seconds
+        self.executed = []
+        self.finished = []
+
+    async def execute(self, query, variable_values=None):
+        if variable_values.get("mintime") == self.fail_for:
+            raise Exception("TEST")
+        await asyncio.sleep(self.delay_in_seconds)
+        self.executed.append(variable_values)
+        self.finished.append(time.perf_counter())
+        return self.response
+
+
+class AsyncPipelineTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.dummy_ds = mock(datastore.DataStore)
+        self.sut = AsyncPipeline(self.dummy_ds)
+        self.dummy_start = datetime.datetime.strptime("2022-09-20T10:00:00", "%Y-%m-%dT%H:%M:%S")
+        self.dummy_end = datetime.datetime.strptime("2022-09-20T12:30:00", "%Y-%m-%dT%H:%M:%S")
+        self.indexed = []
+
+        async def dummy_connect():
+            self.sut.query_semaphore = asyncio.Semaphore(1)
+
+        async def dummy_close():
+            pass
+
+        async def dummy_bulk(es, actions, ignore_status=(), max_retries=0, initial_backoff=0):
+            self.indexed.append(list(actions))
+            return len(self.indexed[-1]), []
+
+        self.sut._connect = dummy_connect
+        self.sut._close = dummy_close
+        when(async_pipeline).async_bulk(...).thenAnswer(dummy_bulk)
+        when(self.dummy_ds).store_checkpoint(...)
+        when(analytics_api).determine_max_interval_in_seconds().thenReturn(3600)
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    def test_run(self):
+        self.sut.session = DummyAsyncSession(create_dummy_response())
+
+        result = self.sut.run(self.dummy_start, self.dummy_end)
+
+        self.assertEqual(self.dummy_end, result)
+        self.assertEqual(3, len(self.sut.session.executed))
+        self.assertEqual([106, 106, 106], [len(actions) for actions in self.indexed])
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_start + datetime.timedelta(hours=1), ANY)
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_start + datetime.timedelta(hours=2), ANY)
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_end, ANY)
+
+    def test_run_for_failed_fetch(self):
+        self.sut.session = DummyAsyncSession(create_dummy_response(), fail_for="2022-09-20T11:00:00Z")
+
+        result = self.sut.run(self.dummy_start, self.dummy_end)
+
+        self.assertEqual(self.dummy_start + datetime.timedelta(hours=1), result)
+        verify(self.dummy_ds, times=0).store_checkpoint(self.dummy_end, ANY)
+
+    def test_run_overlaps_fetch_and_normalize(self):
+        self.sut.session = DummyAsyncSession(create_dummy_response(), delay_in_seconds=0.1)
+        normalize = analytics_api.normalize
+        normalized = []
+
+        def slow_normalize(result):
+            start = time.perf_counter()
+            time.sleep(0.2)
+            normalized.append((start, time.perf_counter()))
+            yield from normalize(result)
+
+        when(analytics_api).normalize(ANY).thenAnswer(slow_normalize)
+
+        result = self.sut.run(self.dummy_start, self.dummy_end)
+
+        self.assertEqual(self.dummy_end, result)
+        self.assertEqual([106, 106, 106], [len(actions) for actions in self.indexed])
+        first_start, first_end = normalized[0]
+        self.assertTrue(any(first_start < finished < first_end for finished in self.sut.session.finished))
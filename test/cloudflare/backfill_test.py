@@ -0,0 +1,116 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import random
+import time
+import unittest
+
+from unittest.mock import patch
+from mockito import when, mock, unstub, verify, ANY
+from cloudflare import analytics_api, config, datastore, rate_limit
+from cloudflare.backfill import Backfill
+
+
+class BackfillTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.dummy_ds = mock(datastore.DataStore)
+        self.dummy_client = mock(analytics_api.AnalyticsClient)
+        self.sut = Backfill(self.dummy_ds, self.dummy_client)
+        self.dummy_start = datetime.datetime.strptime("2022-09-20T10:00:00", "%Y-%m-%dT%H:%M:%S")
+        self.dummy_end = datetime.datetime.strptime("2022-09-20T12:30:00", "%Y-%m-%dT%H:%M:%S")
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    def test_create_partitions(self):
+        when(analytics_api).determine_max_interval_in_seconds().thenReturn(3600)
+
+        result = self.sut.create_partitions(self.dummy_start, self.dummy_end)
+
+        self.assertEqual(3, len(result))
+        self.assertEqual(self.dummy_start, result[0][0])
+        self.assertEqual(result[0][1], result[1][0])
+        self.assertEqual(self.dummy_end, result[2][1])
+        self.assertEqual(datetime.timedelta(minutes=30), result[2][1] - result[2][0])
+
+    def test_run(self):
+        when(analytics_api).determine_max_interval_in_seconds().thenReturn(3600)
+        when(self.dummy_client).fetch_cloudflare_analytics(ANY, ANY, ANY).thenReturn([{"data": "dummy"}])
+        when(self.dummy_ds).store_documents(...)
+        when(self.dummy_ds).store_checkpoint(...)
+
+        result = self.sut.run(self.dummy_start, self.dummy_end)
+
+        self.assertEqual(self.dummy_end, result)
+        verify(self.dummy_client, times=3).fetch_cloudflare_analytics(ANY, ANY, ANY)
+        verify(self.dummy_ds, times=3).store_documents(...)
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_start + datetime.timedelta(hours=1), None)
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_start + datetime.timedelta(hours=2), None)
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_end, None)
+
+    def test_run_for_failed_partition(self):
+        second_partition = self.dummy_start + datetime.timedelta(hours=1)
+        when(analytics_api).determine_max_interval_in_seconds().thenReturn(3600)
+        when(self.dummy_client).fetch_cloudflare_analytics(ANY, ANY, ANY).thenReturn([{"data": "dummy"}])
+        when(self.dummy_client).fetch_cloudflare_analytics(second_partition, ANY, ANY).thenRaise(Exception("TEST"))
+        when(self.dummy_ds).store_documents(...)
+        when(self.dummy_ds).store_checkpoint(...)
+        when(time).sleep(ANY)
+        when(random).uniform(ANY, ANY).thenAnswer(lambda low, high: high)
+
+        with patch.multiple(config, cf_retry_backoff_base_in_seconds=5, cf_retry_backoff_max_in_seconds=300):
+            result = self.sut.run(self.dummy_start, self.dummy_end)
+
+        self.assertEqual(second_partition, result)
+        verify(self.dummy_client, times=self.sut.partition_retries)\
+            .fetch_cloudflare_analytics(second_partition, ANY, ANY)
+        verify(time, times=1).sleep(5)
+        verify(time, times=1).sleep(10)
+        verify(self.dummy_ds, times=1).store_checkpoint(second_partition, None)
+        verify(self.dummy_ds, times=0).store_checkpoint(self.dummy_end, None)
+
+    def test_run_for_zone_subset(self):
+        zone_ids = ["zone1"]
+        when(analytics_api).determine_max_interval_in_seconds().thenReturn(3600)
+        when(self.dummy_client).fetch_cloudflare_analytics(ANY, ANY, ANY).thenReturn([{"data": "dummy"}])
+        when(self.dummy_ds).store_documents(...)
+        when(self.dummy_ds).store_checkpoint(...)
+
+        result = self.sut.run(self.dummy_start, self.dummy_end, zone_ids)
+
+        self.assertEqual(self.dummy_end, result)
+        verify(self.dummy_client, times=3).fetch_cloudflare_analytics(ANY, ANY, zone_ids)
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_end, zone_ids)
+
+    def test_run_for_rate_limited_partition(self):
+        when(analytics_api).determine_max_interval_in_seconds().thenReturn(3600)
+        rate_limit_error = rate_limit.RateLimitError("TEST", 0)
+        when(self.dummy_client).fetch_cloudflare_analytics(ANY, ANY, ANY).thenRaise(rate_limit_error)\
+            .thenRaise(rate_limit_error).thenRaise(rate_limit_error).thenReturn([{"data": "dummy"}])
+        when(self.dummy_ds).store_documents(...)
+        when(self.dummy_ds).store_checkpoint(...)
+        when(time).sleep(ANY)
+
+        result = self.sut.run(self.dummy_start, self.dummy_start + datetime.timedelta(hours=1))
+
+        self.assertEqual(self.dummy_start + datetime.timedelta(hours=1), result)
+        verify(self.dummy_client, times=4).fetch_cloudflare_analytics(ANY, ANY, ANY)
+        verify(time, times=0).sleep(ANY)
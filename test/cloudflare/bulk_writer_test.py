@@ -0,0 +1,163 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+import threading
+import time
+
+from mockito import when, mock, unstub, ANY
+from cloudflare import bulk_writer, metrics
+from cloudflare.bulk_writer import BulkWriter
+from elasticsearch import Elasticsearch, ApiError
+from elasticsearch.helpers import BulkIndexError
+from elastic_transport._models import ApiResponseMeta
+
+
+def create_body(*keys):
+    return b"".join(b'{"index":{"_id":"' + key + b'"}}\n{"key":"' + key + b'"}\n' for key in keys)
+
+
+class BulkWriterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.es = mock(Elasticsearch)
+        self.sut = BulkWriter(self.es, max_concurrency=4, recover_after=2, retries=2, backoff_in_seconds=0)
+        self.bodies = []
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    def _answer(self, *responses):
+        responses = list(responses)
+
+        def answer(operations, require_alias):
+            self.bodies.append(operations)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        when(self.es).bulk(operations=ANY, require_alias=True).thenAnswer(answer)
+
+    def test_select_documents(self):
+        result = bulk_writer.select_documents(create_body(b"a", b"b", b"c"), [0, 2])
+
+        self.assertEqual(create_body(b"a", b"c"), result)
+
+    def test_write(self):
+        self._answer(*[{"errors": False, "items": []}] * 3)
+
+        result = self.sut.write([(create_body(b"a"), 1), (create_body(b"b", b"c"), 2), (create_body(b"d"), 1)])
+
+        self.assertEqual(4, result)
+        self.assertEqual(3, len(self.bodies))
+
+    def test_write_retries_only_rejected_documents(self):
+        retries = metrics.bulk_retries.value
+        self._answer({"errors": True, "items": [{"index": {"status": 201}}, {"index": {"status": 429}},
+                                                {"index": {"status": 429}}]},
+                     {"errors": True, "items": [{"index": {"status": 201}}, {"index": {"status": 429}}]},
+                     {"errors": False, "items": [{"index": {"status": 201}}]})
+
+        result = self.sut.write([(create_body(b"a", b"b", b"c"), 3)])
+
+        self.assertEqual(3, result)
+        self.assertEqual([create_body(b"a", b"b", b"c"), create_body(b"b", b"c"), create_body(b"c")], self.bodies)
+        self.assertEqual(retries + 3, metrics.bulk_retries.value)
+        self.assertEqual(1, self.sut.concurrency)
+
+    def test_write_fails_after_retries(self):
+        rejections = metrics.bulk_rejections.value
+        self._answer(*[{"errors": True, "items": [{"index": {"status": 429}}]}] * 3)
+
+        with self.assertRaises(BulkIndexError) as ctx:
+            self.sut.write([(create_body(b"a"), 1)])
+
+        self.assertEqual(1, len(ctx.exception.errors))
+        self.assertEqual(3, len(self.bodies))
+        self.assertEqual(rejections + 1, metrics.bulk_rejections.value)
+
+    def test_write_fails_for_other_errors_without_retry(self):
+        self._answer({"errors": True, "items": [{"index": {"status": 429}}, {"index": {"status": 400}}]})
+
+        with self.assertRaises(BulkIndexError) as ctx:
+            self.sut.write([(create_body(b"a", b"b"), 2)])
+
+        self.assertEqual([{"index": {"status": 400}}], ctx.exception.errors)
+        self.assertEqual(1, len(self.bodies))
+
+    def test_write_ignores_status(self):
+        self._answer({"errors": True, "items": [{"create": {"status": 409}}]})
+
+        result = self.sut.write([(create_body(b"a"), 1)], ignored_status=(409,))
+
+        self.assertEqual(1, result)
+
+    def test_write_retries_rejected_request(self):
+        meta = ApiResponseMeta(status=429, http_version=1, duration=1, node=None, headers=None)
+        self._answer(ApiError(message="TEST", body=None, meta=meta), {"errors": False, "items": []})
+
+        result = self.sut.write([(create_body(b"a"), 1)])
+
+        self.assertEqual(1, result)
+        self.assertEqual([create_body(b"a")] * 2, self.bodies)
+
+    def test_write_raises_other_request_errors(self):
+        meta = ApiResponseMeta(status=500, http_version=1, duration=1, node=None, headers=None)
+        self._answer(ApiError(message="TEST", body=None, meta=meta))
+
+        with self.assertRaises(ApiError):
+            self.sut.write([(create_body(b"a"), 1)])
+
+        self.assertEqual(1, len(self.bodies))
+
+    def test_write_limits_requests_in_flight(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def answer(operations, require_alias):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+            return {"errors": False, "items": []}
+
+        when(self.es).bulk(operations=ANY, require_alias=True).thenAnswer(answer)
+        self.sut.concurrency = 2
+        self.sut.recover_after = 100
+
+        result = self.sut.write([(create_body(b"a"), 1)] * 8)
+
+        self.assertEqual(8, result)
+        self.assertEqual(2, in_flight[1])
+
+    def test_concurrency_adapts(self):
+        self.sut._throttle()
+        self.sut._throttle()
+        self.assertEqual(1, self.sut.concurrency)
+        self.sut._throttle()
+        self.assertEqual(1, self.sut.concurrency)
+
+        for _ in range(4):
+            self.sut._succeeded()
+
+        self.assertEqual(3, self.sut.concurrency)
+        self.assertEqual(3, metrics.bulk_concurrency.value)
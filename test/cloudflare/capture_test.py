@@ -0,0 +1,87 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import os
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from mockito import when, unstub
+from cloudflare import capture, config, segments
+from cloudflare.capture import Capture
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.capture_dir = tempfile.TemporaryDirectory()
+        self.sut = Capture(self.capture_dir.name)
+        self.dummy_start = datetime.datetime.strptime("2022-09-20T23:59:00", "%Y-%m-%dT%H:%M:%S")
+        self.dummy_result = {"viewer": {"zones": [{"zoneTag": "zone1", "httpRequests1mGroups": []}]}}
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        self.capture_dir.cleanup()
+        unstub()
+
+    def _store_window(self, start_datetime, zone_ids=("zone1", "zone2")):
+        self.sut.store(start_datetime, start_datetime + datetime.timedelta(seconds=61), list(zone_ids),
+                       self.dummy_result)
+
+    def test_store(self):
+        self._store_window(self.dummy_start)
+
+        day_dir = os.path.join(self.capture_dir.name, "2022", "09", "20")
+        names = os.listdir(day_dir)
+        self.assertEqual(1, len(names))
+        self.assertTrue(names[0].startswith("20220920T235900_20220921T000001_"))
+        self.assertEqual(self.dummy_result, segments.read_segment(os.path.join(day_dir, names[0])))
+
+    def test_store_for_different_zones(self):
+        self._store_window(self.dummy_start, zone_ids=["zone2", "zone1"])
+        self._store_window(self.dummy_start, zone_ids=["zone1", "zone2"])
+        self._store_window(self.dummy_start, zone_ids=["zone3"])
+
+        self.assertEqual(2, len(self.sut.segments(self.dummy_start, self.dummy_start + datetime.timedelta(minutes=1))))
+
+    def test_store_for_error(self):
+        when(capture).compress_result(...).thenRaise(Exception("TEST"))
+
+        self._store_window(self.dummy_start)
+
+        self.assertEqual([], self.sut.segments(self.dummy_start, self.dummy_start + datetime.timedelta(days=1)))
+
+    def test_segments(self):
+        windows = [self.dummy_start + datetime.timedelta(minutes=minute) for minute in range(-1, 3)]
+        for window_start in reversed(windows):
+            self._store_window(window_start)
+
+        result = self.sut.segments(windows[1], windows[3])
+
+        self.assertEqual(windows[1:3], [segment_start for segment_start, _, _ in result])
+        self.assertEqual(windows[1] + datetime.timedelta(seconds=61), result[0][1])
+
+    def test_segments_for_missing_capture(self):
+        self.assertEqual([], self.sut.segments(self.dummy_start, self.dummy_start + datetime.timedelta(days=3)))
+
+    def test_create_capture(self):
+        with patch.multiple(config, capture_enabled=False):
+            self.assertIsNone(capture.create_capture())
+        with patch.multiple(config, capture_enabled=True, capture_dir=self.capture_dir.name):
+            self.assertIsInstance(capture.create_capture(), Capture)
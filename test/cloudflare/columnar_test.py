@@ -0,0 +1,76 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import unittest
+
+from unittest.mock import patch
+from cloudflare import analytics_api, columnar, config
+from test.fixtures import create_dummy_response
+
+
+class ColumnarTest(unittest.TestCase):
+
+    def _assert_identical_output(self, result):
+        expected_docs = [doc.to_dict() for doc in analytics_api.normalize_data(copy.deepcopy(result))]
+
+        docs = [doc.to_dict() for doc in columnar.normalize_data(result)]
+
+        self.assertEqual(expected_docs, docs)
+
+    def test_normalize_data(self):
+        self._assert_identical_output(create_dummy_response())
+
+    def test_normalize_data_for_top_n(self):
+        with patch.multiple(config, cf_top_n={"country": 1, "browser": 1, "contentType": 2}):
+            self._assert_identical_output(create_dummy_response())
+
+    def test_normalize_data_for_all_datasets(self):
+        with patch.multiple(config, cf_datasets=[dataset.data_type for dataset in analytics_api.DATASETS]):
+            self._assert_identical_output(create_dummy_response())
+
+    def test_normalize_data_for_dataset_subset(self):
+        with patch.multiple(config, cf_datasets=["country", "ipClass"]):
+            self._assert_identical_output(create_dummy_response())
+
+    def test_normalize_data_for_registered_dataset(self):
+        dataset = analytics_api.map_dataset("status", "responseStatusMap", "edgeResponseStatus", ["requests"],
+                                            analytics_api.create_docs_responsestatus)
+
+        with patch.multiple(analytics_api, DATASETS=[dataset]), patch.multiple(config, cf_datasets=["status"]):
+            docs = [doc.to_dict() for doc in columnar.normalize_data(create_dummy_response())]
+
+        self.assertTrue(docs)
+        self.assertEqual({"status"}, {doc.get("dataType") for doc in docs})
+
+    def test_normalize_data_for_missing_values(self):
+        result = create_dummy_response()
+        data_group = result.get("viewer").get("zones")[0].get("httpRequests1mGroups")[0]
+        data_group.get("sum")["cachedBytes"] = None
+        data_group.get("sum").get("countryMap")[0]["bytes"] = None
+
+        self._assert_identical_output(result)
+
+    def test_normalize_data_for_empty_result(self):
+        self.assertEqual([], list(columnar.normalize_data({"viewer": {"zones": []}})))
+
+    def test_normalize(self):
+        with patch.multiple(config, cf_normalize_engine="columnar"):
+            result = list(analytics_api.normalize(create_dummy_response()))
+
+        self.assertEqual(106, len(result))
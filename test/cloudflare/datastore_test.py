@@ -18,12 +18,20 @@
 
 import unittest
 import datetime
+import json
+import threading
+import time
 
+from unittest.mock import patch
 from elasticsearch._sync.client import IlmClient, IndicesClient
 from mockito import when, mock, unstub, verify, ANY, verifyZeroInteractions, eq
-from cloudflare.datastore import DataStore
-from cloudflare import config
-from elasticsearch import Elasticsearch, ApiError
+from cloudflare import datastore
+from cloudflare.bulk_writer import BulkWriter
+from cloudflare.datastore import DataStore, is_unavailable
+from cloudflare import config, metrics
+from elasticsearch import Elasticsearch, ApiError, ConflictError, ConnectionError as ESConnectionError, NotFoundError, \
+    helpers
+from elasticsearch.helpers import BulkIndexError
 from elastic_transport._models import ApiResponseMeta
 
 
@@ -32,6 +40,7 @@ class DataStoreTest(unittest.TestCase):
         unittest.TestCase.setUp(self)
         self.sut = DataStore()
         self.sut.es = mock(Elasticsearch)
+        self.sut.bulk_writer = BulkWriter(self.sut.es)
         self.dummy_now = datetime.datetime.utcnow()
         self.date_format = "%Y-%m-%dT%H:%M:%S"
         self.dummy_now_str = self.dummy_now.strftime(self.date_format)
@@ -41,39 +50,581 @@ class DataStoreTest(unittest.TestCase):
         unittest.TestCase.tearDown(self)
         unstub()
 
-    def test_find_latest_reference_datetime_for_error(self):
-        when(self.sut.es).search(index=ANY(str), size=ANY, query=ANY, sort=ANY).thenRaise(
+    def test_connect(self):
+        dummy_es = self.sut.es
+        when(datastore).Elasticsearch(...).thenReturn(dummy_es)
+        when(self.sut)._ensure_index()
+        when(self.sut).recover_backfill_mode()
+        when(dummy_es).info().thenReturn({})
+
+        self.sut.connect()
+
+        self.assertIs(dummy_es, self.sut.bulk_writer.es)
+        verify(self.sut, times=0).recover_backfill_mode()
+
+    @staticmethod
+    def _zone_buckets(buckets, failures=None):
+        return {"_shards": {"failed": len(failures or []), "failures": failures or []},
+                "aggregations": {"zones": {"buckets": buckets}}}
+
+    def test_find_latest_zone_datetimes(self):
+        expected_result = datetime.datetime.strptime(self.dummy_now_str, self.date_format)
+        dummy_value = (expected_result - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+        when(self.sut.es).search(...).thenReturn(
+            self._zone_buckets([{"key": "zone1", "latest": {"value": dummy_value}}])).thenReturn(
+            self._zone_buckets([]))
+
+        result = self.sut.find_latest_zone_datetimes(["zone1", "zone2"])
+
+        self.assertEqual({"zone1": expected_result}, result)
+        verify(self.sut.es, times=1).search(
+            index=config.es_cf_index, size=0,
+            query={"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-608400s"}}}]}},
+            aggs={"zones": {"terms": {"field": "zoneTag", "include": ["zone1", "zone2"], "size": 2},
+                            "aggs": {"latest": {"max": {"field": "@timestamp"}}}}})
+        verify(self.sut.es, times=1).search(
+            index=config.es_cf_index, size=0,
+            query={"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-608400s"}}}]}},
+            aggs={"zones": {"terms": {"field": "zoneTag.keyword", "include": ["zone1", "zone2"], "size": 2},
+                            "aggs": {"latest": {"max": {"field": "@timestamp"}}}}})
+
+    # firewall events of a zone are newer than its http totals after a gap of the http totals
+    def test_find_latest_zone_datetimes_for_other_data_types(self):
+        dummy_http = datetime.datetime.strptime(self.dummy_now_str, self.date_format) - datetime.timedelta(hours=2)
+        dummy_firewall = datetime.datetime.strptime(self.dummy_now_str, self.date_format)
+        http_value = (dummy_http - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+        firewall_value = (dummy_firewall - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY).thenAnswer(
+            lambda index, size, query, aggs: self._zone_buckets([{"key": "zone1", "latest": {
+                "value": http_value if "must_not" in query.get("bool") else firewall_value}}]))
+
+        result = self.sut.find_latest_zone_datetimes(["zone1"], ["firewallEvent"])
+
+        self.assertEqual({"zone1": dummy_http}, result)
+        verify(self.sut.es, times=1).search(
+            index=config.es_cf_index, size=0, query={"bool": {
+                "filter": [{"range": {"@timestamp": {"gte": "now-608400s"}}}],
+                "must_not": [{"terms": {"dataType": ["firewallEvent"]}}]}}, aggs=ANY)
+        verify(self.sut.es, times=1).search(
+            index=config.es_cf_index, size=0, query={"bool": {
+                "filter": [{"range": {"@timestamp": {"gte": "now-608400s"}}}],
+                "must_not": [{"terms": {"dataType.keyword": ["firewallEvent"]}}]}}, aggs=ANY)
+
+    def test_find_latest_zone_datetimes_for_error(self):
+        when(self.sut.es).search(...).thenRaise(
             ApiError(message="TEST", body=None,
                      meta=ApiResponseMeta(status=500, http_version=1, duration=1, node=None, headers=None)))
 
-        result = self.sut.find_latest_reference_datetime()
+        with self.assertRaises(ApiError):
+            self.sut.find_latest_zone_datetimes(["zone1"])
+
+    def test_find_latest_zone_datetimes_for_legacy_mapping(self):
+        expected_result = datetime.datetime.strptime(self.dummy_now_str, self.date_format)
+        dummy_value = (expected_result - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+        when(self.sut.es).search(index=config.es_cf_index, size=0, query=ANY, aggs=ANY).thenRaise(
+            ApiError(message="Text fields are not optimised for operations that require per-document field data",
+                     body=None, meta=ApiResponseMeta(status=400, http_version=1, duration=1, node=None, headers=None))
+        ).thenReturn(self._zone_buckets([{"key": "zone1", "latest": {"value": dummy_value}}]))
+
+        result = self.sut.find_latest_zone_datetimes(["zone1"])
+
+        self.assertEqual({"zone1": expected_result}, result)
+        verify(self.sut.es, times=1).search(
+            index=config.es_cf_index, size=0,
+            query={"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-608400s"}}}]}},
+            aggs={"zones": {"terms": {"field": "zoneTag.keyword", "include": ["zone1"], "size": 1},
+                            "aggs": {"latest": {"max": {"field": "@timestamp"}}}}})
+
+    # after the rollover of an update, the alias covers old (text) and new (keyword) indices
+    def test_find_latest_zone_datetimes_for_partially_legacy_mapping(self):
+        dummy_old = datetime.datetime.strptime(self.dummy_now_str, self.date_format) - datetime.timedelta(hours=1)
+        dummy_new = datetime.datetime.strptime(self.dummy_now_str, self.date_format)
+        old_value = (dummy_old - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+        new_value = (dummy_new - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+        responses = {
+            "zoneTag": self._zone_buckets([{"key": "zone1", "latest": {"value": new_value}}],
+                                          [{"index": "cf-analytics-000001", "shard": 0}]),
+            "zoneTag.keyword": self._zone_buckets([{"key": "zone1", "latest": {"value": old_value}},
+                                                   {"key": "zone2", "latest": {"value": old_value}}])
+        }
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY).thenAnswer(
+            lambda index, size, query, aggs: responses.get(aggs.get("zones").get("terms").get("field")))
+
+        result = self.sut.find_latest_zone_datetimes(["zone1", "zone2"])
+
+        self.assertEqual({"zone1": dummy_new, "zone2": dummy_old}, result)
+
+    def test_find_latest_zone_datetimes_for_failed_shards(self):
+        failures = [{"index": "cf-analytics-000002", "shard": 0}]
+        when(self.sut.es).search(...).thenReturn(self._zone_buckets([], failures))
+
+        with self.assertRaises(RuntimeError):
+            self.sut.find_latest_zone_datetimes(["zone1"])
 
-        self.assertIsNone(result)
-        verify(self.sut.es, times=1).search(index=config.es_cf_index, size=1, query={"match_all": {}},
-                                            sort={"@timestamp": "desc"})
+    def _mock_checkpoints(self, zone_sources):
+        docs = [{"found": zone_tag in zone_sources, "_source": zone_sources.get(zone_tag)}
+                for zone_tag in config.zones.keys()]
+        when(self.sut.es).mget(...).thenReturn({"docs": docs})
 
-    def test_find_latest_reference_datetime(self):
+    def test_find_zone_checkpoints(self):
         expected_result = datetime.datetime.strptime(self.dummy_now_str, self.date_format)
-        when(self.sut.es).search(index=ANY(str), size=ANY, query=ANY, sort=ANY)\
-            .thenReturn({"hits": {"total": {"value": 1}, "hits": [{"_source": {"@timestamp": self.dummy_now_str}}]}})
+        dummy_outdated = self.dummy_two_weeks_ago.strftime(self.date_format)
+
+        with patch.multiple(config, zones={"zone1": "one", "zone2": "two", "zone3": "three"}):
+            self._mock_checkpoints({"zone1": {"committedUpTo": self.dummy_now_str},
+                                    "zone2": {"committedUpTo": dummy_outdated}})
+            result = self.sut.find_zone_checkpoints()
+
+        self.assertEqual({"zone1": expected_result}, result)
+        verify(self.sut.es, times=1).mget(index=config.es_cf_checkpoint_index,
+                                          ids=["committed-zone1", "committed-zone2", "committed-zone3"])
+
+    def test_find_zone_checkpoints_for_missing_checkpoint(self):
+        when(self.sut.es).mget(...).thenRaise(
+            NotFoundError(message="TEST", body=None,
+                          meta=ApiResponseMeta(status=404, http_version=1, duration=1, node=None, headers=None)))
+
+        result = self.sut.find_zone_checkpoints()
+
+        self.assertEqual({}, result)
+
+    def test_store_checkpoint(self):
+        actions = []
+        when(helpers).bulk(self.sut.es, ANY).thenAnswer(lambda es, docs: actions.extend(docs))
+
+        with patch.multiple(config, zones={"zone1": "one", "zone2": "two"}):
+            self.sut.store_checkpoint(datetime.datetime.strptime(self.dummy_now_str, self.date_format))
+
+        self.assertEqual([{"_index": config.es_cf_checkpoint_index, "_id": "committed-zone1",
+                           "_source": {"zoneTag": "zone1", "committedUpTo": self.dummy_now_str}},
+                          {"_index": config.es_cf_checkpoint_index, "_id": "committed-zone2",
+                           "_source": {"zoneTag": "zone2", "committedUpTo": self.dummy_now_str}}], actions)
+        verify(self.sut.es, times=0).update(...)
+
+    # replicas sharing the zones commit the same window at the same time - they must not write the same document
+    def test_store_checkpoint_for_concurrent_replicas(self):
+        actions = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(2)
+
+        def dummy_bulk(es, docs):
+            docs = list(docs)
+            barrier.wait(timeout=5)
+            with lock:
+                actions.extend(docs)
+
+        when(helpers).bulk(ANY, ANY).thenAnswer(dummy_bulk)
+        replicas = [DataStore(), DataStore()]
+        for replica in replicas:
+            replica.es = self.sut.es
+        committed = datetime.datetime.strptime(self.dummy_now_str, self.date_format)
+        threads = [threading.Thread(target=replica.store_checkpoint, args=(committed, zone_tags))
+                   for replica, zone_tags in zip(replicas, [["zone1", "zone2"], ["zone3"]])]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = [action.get("_id") for action in actions]
+        self.assertEqual(["committed-zone1", "committed-zone2", "committed-zone3"], sorted(ids))
+        verify(self.sut.es, times=0).update(...)
+
+    def test_find_pipeline_checkpoint(self):
+        when(self.sut.es).get(index=config.es_cf_checkpoint_index, id="pipeline-firewallEvents").thenReturn(
+            {"_source": {"committedUpTo": self.dummy_now_str}})
+
+        result = self.sut.find_pipeline_checkpoint("firewallEvents")
+
+        self.assertEqual(datetime.datetime.strptime(self.dummy_now_str, self.date_format), result)
+
+    def test_find_pipeline_checkpoint_for_outdated_checkpoint(self):
+        when(self.sut.es).get(...).thenReturn(
+            {"_source": {"committedUpTo": self.dummy_two_weeks_ago.strftime(self.date_format)}})
+
+        self.assertIsNone(self.sut.find_pipeline_checkpoint("firewallEvents"))
+
+    def test_find_pipeline_checkpoint_for_missing_checkpoint(self):
+        when(self.sut.es).get(...).thenRaise(
+            NotFoundError(message="TEST", body=None,
+                          meta=ApiResponseMeta(status=404, http_version=1, duration=1, node=None, headers=None)))
+
+        self.assertIsNone(self.sut.find_pipeline_checkpoint("firewallEvents"))
 
-        result = self.sut.find_latest_reference_datetime()
+    def test_store_pipeline_checkpoint(self):
+        when(self.sut.es).index(...)
 
-        self.assertIsNotNone(result)
-        self.assertEqual(expected_result, result)
-        verify(self.sut.es, times=1).search(index=config.es_cf_index, size=1, query={"match_all": {}},
-                                            sort={"@timestamp": "desc"})
+        self.sut.store_pipeline_checkpoint("firewallEvents",
+                                           datetime.datetime.strptime(self.dummy_now_str, self.date_format))
 
-    def test_find_latest_reference_datetime_for_outdated_reference(self):
-        dummy_ref = self.dummy_two_weeks_ago.strftime(self.date_format)
-        when(self.sut.es).search(index=ANY(str), size=ANY, query=ANY, sort=ANY)\
-            .thenReturn({"hits": {"total": {"value": 1}, "hits": [{"_source": {"@timestamp": dummy_ref}}]}})
+        verify(self.sut.es, times=1).index(index=config.es_cf_checkpoint_index, id="pipeline-firewallEvents",
+                                           document={"committedUpTo": self.dummy_now_str})
 
-        result = self.sut.find_latest_reference_datetime()
+    @staticmethod
+    def _create_api_error(error_type, status):
+        return error_type(message="TEST", body=None,
+                          meta=ApiResponseMeta(status=status, http_version=1, duration=1, node=None, headers=None))
 
-        self.assertIsNone(result)
-        verify(self.sut.es, times=1).search(index=config.es_cf_index, size=1, query={"match_all": {}},
-                                            sort={"@timestamp": "desc"})
+    def test_find_leases(self):
+        when(self.sut.es).search(...).thenReturn({"hits": {"hits": [
+            {"_id": "zone-zone1", "_seq_no": 3, "_primary_term": 1, "_source": {"owner": "r1", "expires": 10}}]}})
+
+        result = self.sut.find_leases()
+
+        self.assertEqual({"zone-zone1": ({"owner": "r1", "expires": 10}, 3, 1)}, result)
+        verify(self.sut.es, times=1).search(index=config.es_lease_index, size=10000, seq_no_primary_term=True,
+                                            query={"match_all": {}})
+
+    def test_find_leases_for_missing_index(self):
+        when(self.sut.es).search(...).thenRaise(self._create_api_error(NotFoundError, 404))
+
+        self.assertEqual({}, self.sut.find_leases())
+
+    def test_create_lease(self):
+        when(self.sut.es).index(...).thenReturn({}).thenRaise(self._create_api_error(ConflictError, 409))
+
+        self.assertTrue(self.sut.create_lease("zone-zone1", {"owner": "r1"}))
+        self.assertFalse(self.sut.create_lease("zone-zone1", {"owner": "r2"}))
+        verify(self.sut.es, times=1).index(index=config.es_lease_index, id="zone-zone1", document={"owner": "r1"},
+                                           op_type="create", refresh=True)
+
+    def test_update_lease(self):
+        when(self.sut.es).index(...).thenReturn({}).thenRaise(self._create_api_error(ConflictError, 409))
+
+        self.assertTrue(self.sut.update_lease("zone-zone1", {"owner": "r1"}, 3, 1))
+        self.assertFalse(self.sut.update_lease("zone-zone1", {"owner": "r2"}, 3, 1))
+        verify(self.sut.es, times=1).index(index=config.es_lease_index, id="zone-zone1", document={"owner": "r1"},
+                                           if_seq_no=3, if_primary_term=1, refresh=True)
+
+    def _mock_write_index(self):
+        indices_mock = mock(IndicesClient)
+        self.sut.es.indices = indices_mock
+        when(indices_mock).get_alias(name=config.es_cf_index).thenReturn({
+            "cf-analytics-000001": {"aliases": {config.es_cf_index: {"is_write_index": False}}},
+            "cf-analytics-000002": {"aliases": {config.es_cf_index: {"is_write_index": True}}}})
+        return indices_mock
+
+    def test_find_write_index(self):
+        self._mock_write_index()
+
+        self.assertEqual("cf-analytics-000002", self.sut.find_write_index())
+
+    def test_enter_backfill_mode(self):
+        indices_mock = self._mock_write_index()
+        when(indices_mock).get_settings(...).thenReturn({"cf-analytics-000002": {"settings": {
+            "index.refresh_interval": "5s", "index.number_of_replicas": "1"}}})
+        when(indices_mock).put_settings(...)
+        when(self.sut.es).index(...)
+
+        with patch.multiple(config, backfill_mode_drop_replicas=True):
+            self.sut.enter_backfill_mode()
+
+        verify(self.sut.es, times=1).index(
+            index=config.es_cf_checkpoint_index, id="backfill-mode", op_type="create",
+            document={"index": "cf-analytics-000002",
+                      "settings": {"index.refresh_interval": "5s", "index.number_of_replicas": "1"},
+                      "owner": self.sut.replica_id})
+        verify(indices_mock, times=1).put_settings(
+            index="cf-analytics-000002", settings={"index.refresh_interval": "-1", "index.number_of_replicas": 0})
+
+    def test_enter_backfill_mode_keeps_replicas(self):
+        indices_mock = self._mock_write_index()
+        when(indices_mock).get_settings(...).thenReturn({"cf-analytics-000002": {"settings": {
+            "index.number_of_replicas": "1"}}})
+        when(indices_mock).put_settings(...)
+        when(self.sut.es).index(...)
+
+        with patch.multiple(config, backfill_mode_drop_replicas=False):
+            self.sut.enter_backfill_mode()
+
+        verify(self.sut.es, times=1).index(
+            index=config.es_cf_checkpoint_index, id="backfill-mode", op_type="create",
+            document={"index": "cf-analytics-000002", "settings": {"index.refresh_interval": None},
+                      "owner": self.sut.replica_id})
+        verify(indices_mock, times=1).put_settings(index="cf-analytics-000002",
+                                                   settings={"index.refresh_interval": "-1"})
+
+    def test_exit_backfill_mode(self):
+        indices_mock = self._mock_backfill_mode("replica-1")
+        self.sut.replica_id = "replica-1"
+
+        self.sut.exit_backfill_mode()
+
+        self._verify_restored(indices_mock, times=1)
+
+    def test_exit_backfill_mode_of_other_replica(self):
+        indices_mock = self._mock_backfill_mode("replica-2")
+        self.sut.replica_id = "replica-1"
+
+        self.sut.exit_backfill_mode()
+
+        self._verify_restored(indices_mock, times=0)
+
+    def test_recover_backfill_mode(self):
+        indices_mock = self._mock_backfill_mode("replica-2")
+        self.sut.replica_id = "replica-1"
+
+        with patch.multiple(config, sharding_enabled=False):
+            self.sut.recover_backfill_mode()
+
+        self._verify_restored(indices_mock, times=1)
+
+    def test_recover_backfill_mode_of_dead_replica(self):
+        indices_mock = self._mock_backfill_mode("replica-2")
+        self.sut.replica_id = "replica-1"
+        when(self.sut).find_leases().thenReturn(
+            {"member-replica-2": ({"owner": "replica-2", "expires": time.time() - 1}, 1, 1)})
+
+        with patch.multiple(config, sharding_enabled=True):
+            self.sut.recover_backfill_mode()
+
+        self._verify_restored(indices_mock, times=1)
+
+    def test_recover_backfill_mode_of_live_replica(self):
+        indices_mock = self._mock_backfill_mode("replica-2")
+        self.sut.replica_id = "replica-1"
+        when(self.sut).find_leases().thenReturn(
+            {"member-replica-2": ({"owner": "replica-2", "expires": time.time() + 60}, 1, 1)})
+
+        with patch.multiple(config, sharding_enabled=True):
+            self.sut.recover_backfill_mode()
+
+        self._verify_restored(indices_mock, times=0)
+
+    def test_exit_backfill_mode_for_normal_mode(self):
+        when(self.sut.es).get(...).thenRaise(
+            NotFoundError(message="TEST", body=None,
+                          meta=ApiResponseMeta(status=404, http_version=1, duration=1, node=None, headers=None)))
+        when(self.sut.es).delete(...)
+
+        self.sut.exit_backfill_mode()
+        self.sut.recover_backfill_mode()
+
+        verify(self.sut.es, times=0).delete(...)
+
+    def _mock_backfill_mode(self, owner):
+        indices_mock = mock(IndicesClient)
+        self.sut.es.indices = indices_mock
+        when(self.sut.es).get(index=config.es_cf_checkpoint_index, id="backfill-mode").thenReturn(
+            {"_source": {"index": "cf-analytics-000002", "settings": {"index.refresh_interval": None}, "owner": owner}})
+        when(indices_mock).put_settings(...)
+        when(indices_mock).refresh(...)
+        when(self.sut.es).delete(...)
+        return indices_mock
+
+    def _verify_restored(self, indices_mock, times):
+        verify(indices_mock, times=times).put_settings(index="cf-analytics-000002",
+                                                       settings={"index.refresh_interval": None})
+        verify(indices_mock, times=times).refresh(index="cf-analytics-000002")
+        verify(self.sut.es, times=times).delete(index=config.es_cf_checkpoint_index, id="backfill-mode")
+
+    def test_is_unavailable(self):
+        def api_error(status):
+            return ApiError(message="TEST", body=None,
+                            meta=ApiResponseMeta(status=status, http_version=1, duration=1, node=None, headers=None))
+
+        self.assertTrue(is_unavailable(ESConnectionError("TEST")))
+        self.assertTrue(is_unavailable(api_error(503)))
+        self.assertTrue(is_unavailable(BulkIndexError("TEST", [{"index": {"status": 429}}])))
+        self.assertFalse(is_unavailable(api_error(400)))
+        self.assertFalse(is_unavailable(BulkIndexError("TEST", [{"index": {"status": 400}}])))
+        self.assertFalse(is_unavailable(ValueError("TEST")))
+
+    def test_refresh_documents(self):
+        indices_mock = mock(IndicesClient)
+        self.sut.es.indices = indices_mock
+        when(indices_mock).refresh(...)
+
+        self.sut.refresh_documents()
+
+        verify(indices_mock, times=1).refresh(index=config.es_cf_index)
+
+    def test_is_available(self):
+        when(self.sut.es).ping().thenReturn(True)
+
+        self.assertTrue(self.sut.is_available())
+
+    def test_is_available_for_error(self):
+        when(self.sut.es).ping().thenRaise(Exception("TEST"))
+
+        self.assertFalse(self.sut.is_available())
+
+    def test_store_documents(self):
+        dummy_docs = (dict(self._create_dummy_doc(), dataKey=str(i)) for i in range(3))
+        when(helpers).streaming_bulk(ANY, ANY, ignore_status=ANY, max_retries=ANY, initial_backoff=ANY).thenAnswer(
+            lambda es, actions, ignore_status, max_retries, initial_backoff: (
+                (True, {"index": action}) for action in actions))
+
+        with patch.multiple(config, es_bulk_fast_path=False):
+            result = self.sut.store_documents(dummy_docs)
+
+        self.assertEqual(3, result)
+        verify(helpers, times=1).streaming_bulk(self.sut.es, ANY, ignore_status=(), max_retries=config.es_bulk_retries,
+                                                initial_backoff=config.es_bulk_retry_backoff_in_seconds)
+
+    def test_store_documents_for_fast_path(self):
+        dummy_docs = [dict(self._create_dummy_doc(), dataKey=str(i)) for i in range(3)]
+        bodies = []
+        when(self.sut.es).bulk(operations=ANY, require_alias=True).thenAnswer(
+            lambda operations, require_alias: bodies.append(operations) or {"errors": False, "items": []})
+
+        with patch.multiple(config, es_bulk_fast_path=True, es_bulk_max_chunk_bytes=1):
+            result = self.sut.store_documents(dummy_docs)
+
+        self.assertEqual(3, result)
+        self.assertEqual(3, len(bodies))
+        action, source = bodies[0].decode("utf-8").splitlines()
+        self.assertEqual({"index": {"_index": config.es_cf_index, "_id": DataStore.create_document_id(dummy_docs[0])}},
+                         json.loads(action))
+        self.assertEqual("0", json.loads(source).get("dataKey"))
+
+    def test_store_documents_for_fast_path_with_errors(self):
+        when(self.sut.es).bulk(operations=ANY, require_alias=True).thenReturn(
+            {"errors": True, "items": [{"index": {"status": 201}}, {"index": {"status": 400}}]})
+
+        rejections = metrics.bulk_rejections.value
+
+        with patch.multiple(config, es_bulk_fast_path=True):
+            with self.assertRaises(BulkIndexError) as ctx:
+                self.sut.store_documents([self._create_dummy_doc()])
+
+        self.assertEqual(1, len(ctx.exception.errors))
+        self.assertEqual(rejections + 1, metrics.bulk_rejections.value)
+
+    def test_store_documents_for_fast_path_with_ignored_conflicts(self):
+        when(self.sut.es).bulk(operations=ANY, require_alias=True).thenReturn(
+            {"errors": True, "items": [{"create": {"status": 409}}]})
+
+        with patch.multiple(config, es_bulk_fast_path=True, es_document_op_type="create"):
+            result = self.sut.store_documents([self._create_dummy_doc()])
+
+        self.assertEqual(1, result)
+
+    def test__create_bulk_data(self):
+        dummy_doc = self._create_dummy_doc()
+
+        result = list(DataStore._create_bulk_data([dummy_doc]))
+
+        self.assertEqual([{"_op_type": "index", "_index": config.es_cf_index,
+                           "_id": DataStore.create_document_id(dummy_doc), "_source": dummy_doc}], result)
+
+    def test_create_document_id(self):
+        dummy_doc = self._create_dummy_doc()
+        same_doc = dict(dummy_doc, requests=42)
+        other_doc = dict(dummy_doc, dataKey="France")
+
+        result = DataStore.create_document_id(dummy_doc)
+
+        self.assertEqual(result, DataStore.create_document_id(same_doc))
+        self.assertNotEqual(result, DataStore.create_document_id(other_doc))
+
+    def test_ignored_bulk_status(self):
+        with patch.multiple(config, es_document_op_type="create"):
+            self.assertEqual((409,), DataStore.ignored_bulk_status())
+        with patch.multiple(config, es_document_op_type="index"):
+            self.assertEqual((), DataStore.ignored_bulk_status())
+
+    def _create_dummy_doc(self):
+        return {"zoneTag": "dummy-zone", "@timestamp": self.dummy_two_weeks_ago, "dataType": "country",
+                "dataKey": "Germany", "requests": 1}
+
+    def test_rollup_index_name(self):
+        result = DataStore.rollup_index_name("1h", datetime.datetime(2022, 9, 20, 12))
+
+        self.assertEqual(f"{config.es_rollup_index_prefix}-1h-2022.09", result)
+
+    def test_store_rollups(self):
+        dummy_doc = self._create_dummy_doc()
+        stored = []
+        when(helpers).bulk(ANY, ANY).thenAnswer(lambda es, actions: stored.extend(actions))
+
+        self.sut.store_rollups("1d", [dummy_doc])
+
+        self.assertEqual([{"_index": DataStore.rollup_index_name("1d", dummy_doc.get("@timestamp")),
+                           "_id": DataStore.create_document_id(dummy_doc), "_source": dummy_doc}], stored)
+
+    @staticmethod
+    def _groups(buckets, after_key=None, failures=None):
+        return {"_shards": {"failed": len(failures or []), "failures": failures or []},
+                "aggregations": {"groups": {"buckets": buckets, "after_key": after_key}}}
+
+    @staticmethod
+    def _group_field(aggs):
+        return aggs.get("groups").get("composite").get("sources")[1].get("zoneTag").get("terms").get("field")
+
+    def test_aggregate_documents(self):
+        bucket = {"key": {"bucket": 1663675200000, "zoneTag": "zone1", "dataType": "responseStatus", "dataKey": 200},
+                  "requests": {"value": 12.0}}
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY)\
+            .thenReturn(self._groups([bucket], bucket.get("key")))\
+            .thenReturn(self._groups([]))
+
+        result = list(self.sut.aggregate_documents(self.dummy_two_weeks_ago, self.dummy_now, "1h", ["requests"]))
+
+        self.assertEqual([(datetime.datetime(2022, 9, 20, 12), ("zone1", "responseStatus", "200"), [12])], result)
+        verify(self.sut.es, times=3).search(index=config.es_cf_index, size=0, query=ANY, aggs=ANY)
+
+    def test_aggregate_documents_for_zones(self):
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY).thenReturn(self._groups([]))
+
+        list(self.sut.aggregate_documents(self.dummy_two_weeks_ago, self.dummy_now, "1h", ["requests"], ["zone1"]))
+
+        verify(self.sut.es, times=1).search(index=config.es_cf_index, size=0, query={"bool": {"filter": [
+            {"range": {"@timestamp": {"gte": self.dummy_two_weeks_ago.strftime(self.date_format),
+                                      "lt": self.dummy_now_str}}},
+            {"terms": {"zoneTag": ["zone1"]}}]}}, aggs=ANY)
+        verify(self.sut.es, times=1).search(index=config.es_cf_index, size=0, query={"bool": {"filter": [
+            {"range": {"@timestamp": {"gte": self.dummy_two_weeks_ago.strftime(self.date_format),
+                                      "lt": self.dummy_now_str}}},
+            {"exists": {"field": "zoneTag.keyword"}},
+            {"terms": {"zoneTag.keyword": ["zone1"]}}]}}, aggs=ANY)
+
+    def test_aggregate_documents_for_excluded_data_types(self):
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY).thenReturn(self._groups([]))
+
+        list(self.sut.aggregate_documents(self.dummy_two_weeks_ago, self.dummy_now, "1h", ["requests"], None,
+                                          ["firewallEvent"]))
+
+        verify(self.sut.es, times=1).search(index=config.es_cf_index, size=0, query={"bool": {"filter": [
+            {"range": {"@timestamp": {"gte": self.dummy_two_weeks_ago.strftime(self.date_format),
+                                      "lt": self.dummy_now_str}}}],
+            "must_not": [{"terms": {"dataType": ["firewallEvent"]}}]}}, aggs=ANY)
+
+    # after the rollover of an update, the alias covers old (text) and new (keyword) indices
+    def test_aggregate_documents_for_partially_legacy_mapping(self):
+        new_bucket = {"key": {"bucket": 1663675200000, "zoneTag": "zone1", "dataType": "responseStatus",
+                              "dataKey": "200"}, "requests": {"value": 12.0}}
+        old_bucket = {"key": {"bucket": 1663675200000, "zoneTag": "zone1", "dataType": "responseStatus",
+                              "dataKey": "200"}, "requests": {"value": 3.0}}
+        responses = {
+            "zoneTag": self._groups([new_bucket], failures=[{"index": "cf-analytics-000001", "shard": 0}]),
+            "zoneTag.keyword": self._groups([old_bucket])
+        }
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY).thenAnswer(
+            lambda index, size, query, aggs: responses.get(self._group_field(aggs)))
+
+        result = list(self.sut.aggregate_documents(self.dummy_two_weeks_ago, self.dummy_now, "1h", ["requests"]))
+
+        self.assertEqual([(datetime.datetime(2022, 9, 20, 12), ("zone1", "responseStatus", "200"), [12]),
+                          (datetime.datetime(2022, 9, 20, 12), ("zone1", "responseStatus", "200"), [3])], result)
+
+    def test_aggregate_documents_for_failed_shards(self):
+        failures = [{"index": "cf-analytics-000002", "shard": 0}]
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY).thenReturn(self._groups([], None, failures))
+
+        with self.assertRaises(RuntimeError):
+            list(self.sut.aggregate_documents(self.dummy_two_weeks_ago, self.dummy_now, "1h", ["requests"]))
+
+    def test_aggregate_documents_for_legacy_mapping_only(self):
+        when(self.sut.es).search(index=ANY, size=ANY, query=ANY, aggs=ANY).thenRaise(
+            ApiError(message="Text fields are not optimised for operations that require per-document field data",
+                     body=None, meta=ApiResponseMeta(status=400, http_version=1, duration=1, node=None, headers=None))
+        ).thenReturn(self._groups([]))
+
+        result = list(self.sut.aggregate_documents(self.dummy_two_weeks_ago, self.dummy_now, "1h", ["requests"]))
+
+        self.assertEqual([], result)
+        verify(self.sut.es, times=2).search(index=config.es_cf_index, size=0, query=ANY, aggs=ANY)
 
     def test__ensure_index_for_existing_index(self):
         ilm_mock = mock(IlmClient)
@@ -81,14 +632,68 @@ class DataStoreTest(unittest.TestCase):
         self.sut.es.ilm = ilm_mock
         self.sut.es.indices = indices_mock
         when(indices_mock).exists(index=ANY(str), allow_no_indices=ANY).thenReturn("true")
+        when(indices_mock).get_index_template(name=ANY).thenReturn(
+            {"index_templates": [{"index_template": {"version": self._current_template_version()}}]})
 
         self.sut._ensure_index()
 
         verify(indices_mock, times=1).exists(index=config.es_cf_index_pattern, allow_no_indices=False)
-        verify(indices_mock, times=0).create(ANY)
-        verify(indices_mock, times=0).put_index_template(ANY)
+        verify(indices_mock, times=1).get_index_template(name=config.es_cf_index_template)
+        verify(indices_mock, times=0).create(...)
+        verify(indices_mock, times=0).put_index_template(...)
+        verify(indices_mock, times=0).rollover(...)
         verifyZeroInteractions(ilm_mock)
 
+    def test__ensure_index_for_outdated_template(self):
+        indices_mock = mock(IndicesClient)
+        self.sut.es.indices = indices_mock
+        when(indices_mock).exists(index=ANY(str), allow_no_indices=ANY).thenReturn("true")
+        when(indices_mock).get_index_template(name=ANY).thenReturn(
+            {"index_templates": [{"index_template": {"version": 1}}]})
+        when(indices_mock).put_index_template(name=ANY, index_patterns=ANY, template=ANY, version=ANY)
+        when(indices_mock).rollover(alias=ANY)
+
+        self.sut._ensure_index()
+
+        verify(indices_mock, times=1).put_index_template(name=eq(config.es_cf_index_template),
+                                                         index_patterns=[config.es_cf_index_pattern], template=ANY,
+                                                         version=self._current_template_version())
+        verify(indices_mock, times=1).rollover(alias=config.es_cf_index)
+        verify(indices_mock, times=0).create(...)
+
+    def test__ensure_index_for_rollups(self):
+        ilm_mock = mock(IlmClient)
+        indices_mock = mock(IndicesClient)
+        self.sut.es.ilm = ilm_mock
+        self.sut.es.indices = indices_mock
+        when(indices_mock).exists(index=ANY(str), allow_no_indices=ANY).thenReturn("true")
+        when(indices_mock).get_index_template(name=config.es_cf_index_template).thenReturn(
+            {"index_templates": [{"index_template": {"version": self._current_template_version()}}]})
+        when(indices_mock).put_index_template(name=ANY, index_patterns=ANY, template=ANY, version=ANY)
+        when(ilm_mock).put_lifecycle(name=ANY, policy=ANY)
+
+        with patch.multiple(config, es_rollup_enabled=True):
+            self.sut._ensure_index()
+
+        verify(ilm_mock, times=1).put_lifecycle(name=eq(config.es_rollup_policy), policy=ANY)
+        verify(indices_mock, times=1).put_index_template(name=eq(config.es_rollup_index_template),
+                                                         index_patterns=[config.es_rollup_index_pattern],
+                                                         template=ANY, version=ANY)
+
+    def test_index_template_mappings(self):
+        index_template = json.loads(DataStore.read_resource_from_file("index-template.json"))
+        properties = index_template.get("mappings").get("properties")
+
+        for field in ["dataType", "dataKey", "zoneTag", "zoneName"]:
+            self.assertEqual("keyword", properties.get(field).get("type"))
+        for field in index_template.get("settings").get("index").get("sort.field"):
+            self.assertIn(field, properties)
+
+    @staticmethod
+    def _current_template_version():
+        index_template = json.loads(DataStore.read_resource_from_file("index-template.json"))
+        return index_template.get("mappings").get("_meta").get("version")
+
     def test__ensure_index_for_not_existing(self):
         ilm_mock = mock(IlmClient)
         indices_mock = mock(IndicesClient)
@@ -96,7 +701,7 @@ class DataStoreTest(unittest.TestCase):
         self.sut.es.indices = indices_mock
         when(indices_mock).exists(index=ANY(str), allow_no_indices=ANY).thenReturn("false")
         when(indices_mock).create(index=ANY(str), aliases=ANY)
-        when(indices_mock).put_index_template(name=ANY, index_patterns=ANY, template=ANY)
+        when(indices_mock).put_index_template(name=ANY, index_patterns=ANY, template=ANY, version=ANY)
         when(ilm_mock).put_lifecycle(name=ANY, policy=ANY)
 
         self.sut._ensure_index()
@@ -105,5 +710,6 @@ class DataStoreTest(unittest.TestCase):
         verify(indices_mock, times=1).create(index=config.es_cf_initial_index,
                                              aliases={config.es_cf_index: {"is_write_index": True}})
         verify(indices_mock, times=1).put_index_template(name=eq(config.es_cf_index_template),
-                                                         index_patterns=[config.es_cf_index_pattern], template=ANY)
+                                                         index_patterns=[config.es_cf_index_pattern], template=ANY,
+                                                         version=self._current_template_version())
         verify(ilm_mock, times=1).put_lifecycle(name=eq(config.es_cf_policy), policy=ANY)
@@ -64,6 +64,52 @@ class DateTimeHelperTest(unittest.TestCase):
         self.assertIsNotNone(result2)
         self.assertEqual(expected_result2, result2)
 
+    def test_determine_catchup_interval_datetime(self):
+        dt_two_hours_earlier = datetime.datetime.strptime("2022-09-20T10:00:00", "%Y-%m-%dT%H:%M:%S")
+        expected_result = dt_two_hours_earlier + datetime.timedelta(seconds=self.sut.CF_CATCHUP_INTERVAL_IN_SECONDS)
+        when(DateTimeHelper)._utcnow().thenReturn(self.dummy_current_dt)
+
+        result = self.sut.determine_catchup_interval_datetime(dt_two_hours_earlier)
+
+        self.assertEqual(expected_result, result)
+
+    def test_determine_catchup_interval_datetime_for_max_interval(self):
+        dt_two_hours_earlier = datetime.datetime.strptime("2022-09-20T10:00:00", "%Y-%m-%dT%H:%M:%S")
+        expected_result = datetime.datetime.strptime("2022-09-20T10:10:00", "%Y-%m-%dT%H:%M:%S")
+        when(DateTimeHelper)._utcnow().thenReturn(self.dummy_current_dt)
+
+        result = self.sut.determine_catchup_interval_datetime(dt_two_hours_earlier, max_interval_in_seconds=600)
+
+        self.assertEqual(expected_result, result)
+
+    def test_determine_catchup_interval_datetime_for_almost_up2date_ref(self):
+        almost_up2date_dt = datetime.datetime.strptime("2022-09-20T11:50:00", "%Y-%m-%dT%H:%M:%S")
+        expected_result = datetime.datetime.strptime("2022-09-20T12:07:00", "%Y-%m-%dT%H:%M:%S")
+        when(DateTimeHelper)._utcnow().thenReturn(self.dummy_current_dt)
+
+        result = self.sut.determine_catchup_interval_datetime(almost_up2date_dt)
+
+        self.assertEqual(expected_result, result)
+
+    def test_seconds_until_fetchable(self):
+        # current ref-datetime is 12:07:00 - the window 12:06:00 - 12:07:01 is complete one second later
+        when(DateTimeHelper)._utcnow().thenReturn(self.dummy_current_dt)
+
+        ref_datetime = datetime.datetime.strptime("2022-09-20T12:06:00", "%Y-%m-%dT%H:%M:%S")
+
+        result = self.sut.seconds_until_fetchable(ref_datetime)
+
+        self.assertEqual(1.0, result)
+
+    def test_seconds_until_fetchable_for_complete_window(self):
+        when(DateTimeHelper)._utcnow().thenReturn(self.dummy_current_dt)
+
+        ref_datetime = datetime.datetime.strptime("2022-09-20T11:00:00", "%Y-%m-%dT%H:%M:%S")
+
+        result = self.sut.seconds_until_fetchable(ref_datetime)
+
+        self.assertEqual(0.0, result)
+
     def test_format_datetime(self):
         expected_result = "2022-09-20T12:12:00Z"
 
@@ -0,0 +1,154 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import unittest
+
+from unittest.mock import patch
+from mockito import when, mock, unstub, verify
+from cloudflare import config, leases
+from cloudflare.leases import LeaseKeeper, MemoryLeaseStore, ZoneLeases
+
+ZONES = [f"zone{i}" for i in range(10)]
+
+
+class LeasesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.store = MemoryLeaseStore()
+        self.now = 1000.0
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    def _create_replica(self, replica_id):
+        return ZoneLeases(self.store, replica_id, ZONES, ttl_in_seconds=60, clock=lambda: self.now)
+
+    def test_memory_lease_store(self):
+        self.assertTrue(self.store.create_lease("a", {"owner": "r1"}))
+        self.assertFalse(self.store.create_lease("a", {"owner": "r2"}))
+        lease, seq_no, primary_term = self.store.find_leases().get("a")
+
+        self.assertTrue(self.store.update_lease("a", {"owner": "r2"}, seq_no, primary_term))
+        self.assertFalse(self.store.update_lease("a", {"owner": "r3"}, seq_no, primary_term))
+        self.assertEqual({"owner": "r2"}, self.store.find_leases().get("a")[0])
+
+    def test_refresh_for_single_replica(self):
+        result = self._create_replica("r1").refresh()
+
+        self.assertEqual(ZONES, result)
+
+    def test_refresh_divides_zones(self):
+        replica1 = self._create_replica("r1")
+        replica2 = self._create_replica("r2")
+        replica1.refresh()
+
+        # the new replica announces itself, the existing one releases its surplus
+        self.assertEqual([], replica2.refresh())
+        owned1 = replica1.refresh()
+        owned2 = replica2.refresh()
+
+        self.assertEqual(5, len(owned1))
+        self.assertEqual(5, len(owned2))
+        self.assertEqual(ZONES, sorted(owned1 + owned2))
+
+    def test_refresh_for_uneven_zones(self):
+        replicas = [self._create_replica(f"r{i}") for i in range(3)]
+        for _ in range(3):
+            owned = [replica.refresh() for replica in replicas]
+
+        self.assertEqual(ZONES, sorted(sum(owned, [])))
+        self.assertTrue(all(len(zones) <= 4 for zones in owned))
+
+    def test_refresh_takes_over_zones_of_dead_replica(self):
+        replica1 = self._create_replica("r1")
+        replica2 = self._create_replica("r2")
+        for _ in range(2):
+            replica1.refresh()
+            replica2.refresh()
+
+        self.now += 61
+        result = replica2.refresh()
+
+        self.assertEqual(ZONES, result)
+
+    def test_refresh_never_shares_zones(self):
+        replica1 = self._create_replica("r1")
+        replica1.refresh()
+        # a replica with an outdated view must not take over living leases
+        replica2 = self._create_replica("r2")
+        replica2.fair_share = lambda leases, now: len(ZONES)
+
+        self.assertEqual([], replica2.refresh())
+
+    def test_release(self):
+        replica1 = self._create_replica("r1")
+        replica1.refresh()
+
+        replica1.release()
+
+        self.assertEqual(ZONES, self._create_replica("r2").refresh())
+
+    def test_refresh_for_pipeline_lease(self):
+        replica1 = ZoneLeases(self.store, "r1", ["firewallEvents"], ttl_in_seconds=60, clock=lambda: self.now,
+                              prefix=leases.PIPELINE_PREFIX)
+        replica2 = ZoneLeases(self.store, "r2", ["firewallEvents"], ttl_in_seconds=60, clock=lambda: self.now,
+                              prefix=leases.PIPELINE_PREFIX)
+
+        self.assertEqual(["firewallEvents"], replica1.refresh())
+        self.assertEqual([], replica2.refresh())
+        self.assertEqual("r1", self.store.find_leases().get("pipeline-firewallEvents")[0].get("owner"))
+
+        self.now += 61
+        self.assertEqual(["firewallEvents"], replica2.refresh())
+
+    def test_determine_replica_id(self):
+        with patch.multiple(config, sharding_replica_id_env="CFAE_TEST_REPLICA_ID"):
+            with patch.dict(os.environ, {"CFAE_TEST_REPLICA_ID": "pod-1"}):
+                self.assertEqual("pod-1", leases.determine_replica_id())
+            with patch.dict(os.environ, {}, clear=True):
+                self.assertIn(str(os.getpid()), leases.determine_replica_id())
+
+    def test_lease_keeper(self):
+        sut = LeaseKeeper(self._create_replica("r1"), interval_in_seconds=60)
+
+        self.assertEqual(ZONES, sut.refresh())
+        self.assertEqual(ZONES, sut.owned_zones())
+
+        sut.start()
+        sut.stop()
+
+        self.assertEqual({}, {lease_id: lease for lease_id, (lease, _, _) in self.store.find_leases().items()
+                              if lease.get("owner") is not None})
+
+    def test_lease_keeper_expire(self):
+        zone_leases = mock(ZoneLeases)
+        zone_leases.replica_id = "r1"
+        zone_leases.ttl_in_seconds = 60
+        when(zone_leases).refresh().thenReturn(["zone1"])
+        sut = LeaseKeeper(zone_leases, interval_in_seconds=60)
+        sut.refresh()
+
+        sut.expire()
+        self.assertEqual(["zone1"], sut.owned_zones())
+
+        sut.renewed_at -= 61
+        sut.expire()
+        self.assertEqual([], sut.owned_zones())
+        verify(zone_leases, times=1).refresh()
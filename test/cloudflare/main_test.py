@@ -19,9 +19,12 @@
 import unittest
 import datetime
 import time
+import elasticsearch
 
 from mockito import when, mock, unstub, verify, ANY
-from cloudflare import analytics_api, datastore
+from unittest.mock import patch
+from cloudflare import analytics_api, async_pipeline, backfill, config, datastore, metrics, rate_limit, rollup
+from cloudflare import leases, pipelines, scheduler, spool
 from cloudflare import main as sut
 from cloudflare import no_concurrency
 
@@ -31,6 +34,11 @@ class MainTest(unittest.TestCase):
         unittest.TestCase.setUp(self)
         self.dummy_datetime = datetime.datetime.strptime("2022-09-20T12:12:00", "%Y-%m-%dT%H:%M:%S")
         self.dummy_ds = mock(datastore.DataStore)
+        self.dummy_client = mock(analytics_api.AnalyticsClient)
+        self.dummy_schedule = mock(scheduler.Scheduler)
+        when(self.dummy_schedule).wait_until_fetchable(ANY)
+        when(self.dummy_schedule).succeeded()
+        when(self.dummy_schedule).failed()
 
     def tearDown(self) -> None:
         unittest.TestCase.tearDown(self)
@@ -38,36 +46,420 @@ class MainTest(unittest.TestCase):
 
     def test_run_fetch_and_push(self):
         dummy_data = [{"data": "dummy"}, {"data": "narf"}]
-        when(analytics_api).fetch_cloudflare_analytics(ANY).thenReturn(dummy_data)
-        when(time).sleep(ANY)
-        when(self.dummy_ds).store_documents(...)
+        dummy_to_datetime = self.dummy_datetime + datetime.timedelta(minutes=30)
+        dummy_result = {"viewer": {"zones": []}}
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(dummy_to_datetime)
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenReturn(dummy_result)
+        when(analytics_api).normalize(dummy_result).thenReturn(dummy_data)
+        when(self.dummy_ds).store_documents(...).thenReturn(len(dummy_data))
+        when(self.dummy_ds).store_checkpoint(...)
 
-        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds)
+        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client,
+                                        schedule=self.dummy_schedule)
 
         self.assertIsNotNone(result)
-        self.assertNotEqual(result, self.dummy_datetime)
+        self.assertEqual(dummy_to_datetime, result)
+        verify(self.dummy_ds, times=1).store_checkpoint(dummy_to_datetime, None)
 
-        verify(analytics_api, times=1).fetch_cloudflare_analytics(ANY)
+        verify(self.dummy_client, times=1).fetch_raw(self.dummy_datetime, dummy_to_datetime, None)
         verify(self.dummy_ds, times=1).store_documents(docs=dummy_data)
-        verify(time, times=1).sleep(5)
+        verify(self.dummy_schedule, times=1).wait_until_fetchable(self.dummy_datetime)
+        verify(self.dummy_schedule, times=1).succeeded()
+
+    def test_run_fetch_and_push_with_rollups(self):
+        dummy_data = [{"data": "dummy"}]
+        dummy_tracked = [{"data": "tracked"}]
+        dummy_rollups = mock(rollup.Rollup)
+        dummy_to_datetime = self.dummy_datetime + datetime.timedelta(minutes=1)
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(dummy_to_datetime)
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenReturn({})
+        when(analytics_api).normalize(ANY).thenReturn(dummy_data)
+        when(dummy_rollups).track(ANY, ANY).thenReturn(dummy_tracked)
+        when(dummy_rollups).commit(ANY)
+        when(self.dummy_ds).store_documents(...).thenReturn(1)
+        when(self.dummy_ds).store_checkpoint(...)
+
+        sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, dummy_rollups,
+                               schedule=self.dummy_schedule)
+
+        verify(dummy_rollups, times=1).track(dummy_data, self.dummy_datetime)
+        verify(self.dummy_ds, times=1).store_documents(docs=dummy_tracked)
+        verify(dummy_rollups, times=1).commit(dummy_to_datetime)
+
+    def test_run_fetch_and_push_for_rollup_error(self):
+        dummy_rollups = mock(rollup.Rollup)
+        dummy_to_datetime = self.dummy_datetime + datetime.timedelta(minutes=1)
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(dummy_to_datetime)
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenReturn({"viewer": {"zones": []}})
+        when(dummy_rollups).track(ANY, ANY).thenReturn([])
+        when(dummy_rollups).commit(ANY).thenRaise(Exception("TEST"))
+        when(dummy_rollups).mark_failed(ANY)
+        when(self.dummy_ds).store_documents(...).thenReturn(0)
+        when(self.dummy_ds).store_checkpoint(...)
+        when(self.dummy_schedule).succeeded()
+
+        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, dummy_rollups,
+                                        schedule=self.dummy_schedule)
+
+        self.assertEqual(dummy_to_datetime, result)
+        verify(dummy_rollups, times=1).mark_failed(self.dummy_datetime)
+        verify(self.dummy_schedule, times=1).succeeded()
+
+    def test_commit_rollups_for_drained_windows(self):
+        dummy_spool = mock(spool.Spool)
+        dummy_rollups = mock(rollup.Rollup)
+        dummy_drained = (self.dummy_datetime - datetime.timedelta(minutes=10), self.dummy_datetime)
+        when(dummy_spool).pop_drained().thenReturn([dummy_drained])
+        when(dummy_rollups).commit(ANY)
+        when(dummy_rollups).rebuild(ANY, ANY).thenRaise(Exception("TEST"))
+        when(dummy_rollups).mark_failed(ANY)
+
+        sut.commit_rollups(dummy_rollups, self.dummy_datetime, self.dummy_datetime + datetime.timedelta(minutes=1),
+                           dummy_spool)
+
+        verify(dummy_rollups, times=1).mark_failed(dummy_drained[0])
+
+    def test_rebuild_rollups_for_error(self):
+        dummy_rollups = mock(rollup.Rollup)
+        when(dummy_rollups).rebuild(ANY, ANY).thenRaise(Exception("TEST"))
+        when(dummy_rollups).mark_failed(ANY)
+
+        sut.rebuild_rollups(dummy_rollups, self.dummy_datetime, self.dummy_datetime + datetime.timedelta(hours=1))
+
+        verify(dummy_rollups, times=1).mark_failed(self.dummy_datetime)
+
+    def test_run_fetch_and_push_for_error(self):
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(self.dummy_datetime)
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenRaise(Exception("TEST"))
+
+        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client,
+                                        schedule=self.dummy_schedule)
+
+        self.assertEqual(self.dummy_datetime, result)
+        verify(self.dummy_ds, times=0).store_documents(...)
+        verify(self.dummy_ds, times=0).store_checkpoint(...)
+        verify(self.dummy_schedule, times=1).failed()
+
+    def test_run_fetch_and_push_for_rate_limit(self):
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(self.dummy_datetime + datetime.timedelta(minutes=1))
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenRaise(rate_limit.RateLimitError("TEST", 60))
+
+        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client,
+                                        schedule=self.dummy_schedule)
+
+        self.assertEqual(self.dummy_datetime, result)
+        verify(self.dummy_schedule, times=0).failed()
+
+    def test_run_fetch_and_push_for_spooled_window(self):
+        dummy_result = {"viewer": {"zones": []}}
+        dummy_spool = mock(spool.Spool)
+        dummy_to_datetime = self.dummy_datetime + datetime.timedelta(minutes=1)
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(dummy_to_datetime)
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenReturn(dummy_result)
+        when(self.dummy_ds).store_documents(...).thenRaise(elasticsearch.ConnectionError("TEST"))
+        when(dummy_spool).append(ANY, ANY, ANY).thenReturn(True)
+
+        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, spooler=dummy_spool,
+                                        schedule=self.dummy_schedule)
+
+        self.assertEqual(dummy_to_datetime, result)
+        verify(dummy_spool, times=1).append(self.dummy_datetime, dummy_to_datetime, dummy_result)
+        verify(self.dummy_ds, times=0).store_checkpoint(...)
+        verify(self.dummy_schedule, times=0).failed()
+
+    def test_run_fetch_and_push_for_full_spool(self):
+        dummy_spool = mock(spool.Spool)
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(self.dummy_datetime + datetime.timedelta(minutes=1))
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenReturn({"viewer": {"zones": []}})
+        when(self.dummy_ds).store_documents(...).thenRaise(elasticsearch.ConnectionError("TEST"))
+        when(dummy_spool).append(ANY, ANY, ANY).thenReturn(False)
+
+        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, spooler=dummy_spool,
+                                        schedule=self.dummy_schedule)
+
+        self.assertEqual(self.dummy_datetime, result)
+        verify(self.dummy_schedule, times=1).failed()
+
+    def test_run_fetch_and_push_for_unspoolable_error(self):
+        dummy_spool = mock(spool.Spool)
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(self.dummy_datetime + datetime.timedelta(minutes=1))
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenReturn({"viewer": {"zones": []}})
+        when(self.dummy_ds).store_documents(...).thenRaise(Exception("TEST"))
+        when(dummy_spool).append(ANY, ANY, ANY).thenReturn(True)
+
+        result = sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, spooler=dummy_spool,
+                                        schedule=self.dummy_schedule)
+
+        self.assertEqual(self.dummy_datetime, result)
+        verify(dummy_spool, times=0).append(...)
+        verify(self.dummy_schedule, times=1).failed()
+
+    def test_run_fetch_and_push_with_spool_and_rollups(self):
+        dummy_spool = mock(spool.Spool)
+        dummy_rollups = mock(rollup.Rollup)
+        dummy_to_datetime = self.dummy_datetime + datetime.timedelta(minutes=1)
+        dummy_drained = (self.dummy_datetime - datetime.timedelta(minutes=10), self.dummy_datetime)
+        when(analytics_api).determine_to_datetime(ANY).thenReturn(dummy_to_datetime)
+        when(self.dummy_client).fetch_raw(ANY, ANY, ANY).thenReturn({"viewer": {"zones": []}})
+        when(dummy_rollups).track(ANY, ANY).thenReturn([])
+        when(dummy_rollups).commit(ANY)
+        when(dummy_rollups).rebuild(ANY, ANY)
+        when(dummy_spool).committed_datetime(dummy_to_datetime).thenReturn(self.dummy_datetime)
+        when(dummy_spool).pop_drained().thenReturn([dummy_drained])
+        when(self.dummy_ds).store_documents(...).thenReturn(0)
+        when(self.dummy_ds).store_checkpoint(...)
+
+        sut.run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, dummy_rollups, dummy_spool,
+                               self.dummy_schedule)
+
+        verify(self.dummy_ds, times=1).store_checkpoint(self.dummy_datetime, None)
+        verify(dummy_rollups, times=1).rebuild(*dummy_drained)
+
+    def test_create_spool_for_disabled_spool(self):
+        with patch.multiple(config, spool_enabled=False):
+            self.assertIsNone(sut.create_spool())
+
+    def test_create_spool_for_unusable_spool_dir(self):
+        when(spool).Spool().thenRaise(OSError("TEST"))
+
+        with patch.multiple(config, spool_enabled=True):
+            self.assertIsNone(sut.create_spool())
+
+    def test_determine_zone_start_datetimes(self):
+        dummy_latest = self.dummy_datetime + datetime.timedelta(seconds=30)
+        when(self.dummy_ds).find_zone_checkpoints().thenReturn({"zone1": self.dummy_datetime})
+        when(self.dummy_ds).find_latest_zone_datetimes(["zone2", "zone3"], pipelines.DATA_TYPES)\
+            .thenReturn({"zone2": dummy_latest})
+        when(sut.dt_helper).latest_complete_datetime().thenReturn(self.dummy_datetime)
+
+        with patch.multiple(config, zones={"zone1": "one", "zone2": "two", "zone3": "three"},
+                            backfill_new_zones_in_seconds=3600):
+            result = sut.determine_zone_start_datetimes(self.dummy_ds)
+
+        self.assertEqual({"zone1": self.dummy_datetime, "zone2": self.dummy_datetime,
+                          "zone3": self.dummy_datetime - datetime.timedelta(hours=1)}, result)
+
+    def test_determine_zone_start_datetimes_for_checkpoints(self):
+        when(self.dummy_ds).find_zone_checkpoints().thenReturn({"zone1": self.dummy_datetime})
+        when(sut.dt_helper).latest_complete_datetime().thenReturn(self.dummy_datetime)
+
+        with patch.multiple(config, zones={"zone1": "one"}):
+            result = sut.determine_zone_start_datetimes(self.dummy_ds)
+
+        self.assertEqual({"zone1": self.dummy_datetime}, result)
+        verify(self.dummy_ds, times=0).find_latest_zone_datetimes(...)
+
+    def test_catch_up_zones(self):
+        dummy_backfill = mock(backfill.Backfill)
+        dummy_rollups = mock(rollup.Rollup)
+        lagging_start = self.dummy_datetime - datetime.timedelta(hours=2)
+        zone_starts = {"zone1": self.dummy_datetime, "zone2": lagging_start, "zone3": lagging_start}
+        when(sut).create_backfill(ANY, ANY).thenReturn(dummy_backfill)
+        when(dummy_backfill).run(ANY, ANY, ANY).thenReturn(self.dummy_datetime)
+        when(dummy_rollups).rebuild(ANY, ANY)
+
+        result = sut.catch_up_zones(zone_starts, self.dummy_ds, self.dummy_client, dummy_rollups)
+
+        self.assertEqual(self.dummy_datetime, result)
+        verify(dummy_backfill, times=1).run(lagging_start, self.dummy_datetime, ["zone2", "zone3"])
+        verify(dummy_rollups, times=1).rebuild(lagging_start, self.dummy_datetime)
+
+    def test_catch_up_zones_for_incomplete_catch_up(self):
+        dummy_backfill = mock(backfill.Backfill)
+        lagging_start = self.dummy_datetime - datetime.timedelta(hours=2)
+        dummy_committed = lagging_start + datetime.timedelta(hours=1)
+        when(sut).create_backfill(ANY, ANY).thenReturn(dummy_backfill)
+        when(dummy_backfill).run(ANY, ANY, ANY).thenReturn(dummy_committed)
+
+        result = sut.catch_up_zones({"zone1": self.dummy_datetime, "zone2": lagging_start},
+                                    self.dummy_ds, self.dummy_client)
+
+        self.assertEqual(dummy_committed, result)
+
+    def test_catch_up_zones_for_aligned_zones(self):
+        when(sut).create_backfill(ANY, ANY)
+
+        result = sut.catch_up_zones({"zone1": self.dummy_datetime, "zone2": self.dummy_datetime},
+                                    self.dummy_ds, self.dummy_client)
+
+        self.assertEqual(self.dummy_datetime, result)
+        verify(sut, times=0).create_backfill(ANY, ANY)
+
+    def test_is_need_backfill(self):
+        when(sut.dt_helper).latest_complete_datetime().thenReturn(self.dummy_datetime)
+
+        self.assertTrue(sut.is_need_backfill(self.dummy_datetime - datetime.timedelta(days=1)))
+        self.assertFalse(sut.is_need_backfill(self.dummy_datetime - datetime.timedelta(minutes=5)))
+
+    def test_is_need_backfill_mode(self):
+        when(sut.dt_helper).latest_complete_datetime().thenReturn(self.dummy_datetime)
+        zone_starts = {"zone1": self.dummy_datetime - datetime.timedelta(days=1),
+                       "zone2": self.dummy_datetime - datetime.timedelta(minutes=5)}
+
+        with patch.multiple(config, backfill_mode_enabled=True, backfill_mode_threshold_in_seconds=21600):
+            self.assertTrue(sut.is_need_backfill_mode(zone_starts))
+            self.assertFalse(sut.is_need_backfill_mode({"zone2": zone_starts.get("zone2")}))
+            self.assertFalse(sut.is_need_backfill_mode({}))
+        with patch.multiple(config, backfill_mode_enabled=False):
+            self.assertFalse(sut.is_need_backfill_mode(zone_starts))
+
+    def test_create_backfill(self):
+        with patch.multiple(config, backfill_engine="threads"):
+            result = sut.create_backfill(self.dummy_ds, self.dummy_client)
+
+        self.assertIsInstance(result, backfill.Backfill)
+
+    def test_create_backfill_for_asyncio_engine(self):
+        with patch.multiple(config, backfill_engine="asyncio"):
+            result = sut.create_backfill(self.dummy_ds, self.dummy_client)
+
+        self.assertIsInstance(result, async_pipeline.AsyncPipeline)
 
     def test_main(self):
         dummy_concurrency_checker = mock()
+        dummy_metrics_server = mock(metrics.MetricsServer)
+        when(metrics).MetricsServer().thenReturn(dummy_metrics_server)
+        when(dummy_metrics_server).start()
+        when(dummy_metrics_server).stop()
 
         when(self.dummy_ds).connect()
-        when(self.dummy_ds).find_latest_reference_datetime().thenReturn(self.dummy_datetime)
+        when(self.dummy_ds).recover_backfill_mode()
+        when(analytics_api).AnalyticsClient().thenReturn(self.dummy_client)
+        when(self.dummy_client).connect()
+        when(self.dummy_client).close()
+        when(sut).determine_zone_start_datetimes(ANY, ANY).thenReturn({"zone1": self.dummy_datetime})
+        when(sut).is_need_backfill(ANY).thenReturn(False)
+        when(sut).is_need_backfill_mode(ANY).thenReturn(False)
         when(no_concurrency).NoConcurrency().thenReturn(dummy_concurrency_checker)
         when(sut).still_active(ANY).thenReturn(True).thenReturn(False)
-        when(sut).run_fetch_and_push(ANY, ANY)
+        when(sut).run_fetch_and_push(ANY, ANY, ANY, ANY, ANY, ANY, ANY)
         when(sut).verify_allowed_to_run(ANY)
+        when(sut).create_spool().thenReturn(None)
 
         sut.main(self.dummy_ds)
 
         verify(self.dummy_ds, times=1).connect()
-        verify(self.dummy_ds, times=1).find_latest_reference_datetime()
+        verify(self.dummy_ds, times=1).recover_backfill_mode()
+        verify(sut, times=1).determine_zone_start_datetimes(self.dummy_ds, None)
         verify(sut, times=2).still_active(dummy_concurrency_checker)
-        verify(sut, times=1).run_fetch_and_push(self.dummy_datetime, self.dummy_ds)
+        verify(sut, times=1).run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, None, None,
+                                                ANY(scheduler.Scheduler), None)
+        verify(self.dummy_client, times=1).connect()
+        verify(self.dummy_client, times=1).close()
         verify(sut, times=1).verify_allowed_to_run(dummy_concurrency_checker)
+        verify(dummy_metrics_server, times=1).start()
+        verify(dummy_metrics_server, times=1).stop()
+
+    def test_main_for_backfill_mode(self):
+        when(self.dummy_ds).connect()
+        when(self.dummy_ds).recover_backfill_mode()
+        when(self.dummy_ds).enter_backfill_mode()
+        when(self.dummy_ds).exit_backfill_mode()
+        when(analytics_api).AnalyticsClient().thenReturn(self.dummy_client)
+        when(self.dummy_client).connect()
+        when(sut).determine_zone_start_datetimes(ANY, ANY).thenReturn({"zone1": self.dummy_datetime})
+        when(sut).is_need_backfill_mode(ANY).thenReturn(True)
+        when(sut).catch_up_zones(...).thenRaise(Exception("TEST"))
+        when(sut).verify_allowed_to_run(ANY)
+        when(sut).create_spool().thenReturn(None)
+
+        with patch.multiple(config, metrics_enabled=False):
+            with self.assertRaises(Exception):
+                sut.main(self.dummy_ds)
+
+        verify(self.dummy_ds, times=1).enter_backfill_mode()
+        verify(self.dummy_ds, times=1).exit_backfill_mode()
+
+    def test_start_up_rebuilds_after_backfill_mode(self):
+        calls = []
+        dummy_rollups = mock(rollup.Rollup)
+        start = self.dummy_datetime - datetime.timedelta(days=2)
+        when(sut).determine_zone_start_datetimes(ANY, ANY).thenReturn({"zone1": start})
+        when(sut).is_need_backfill_mode(ANY).thenReturn(True)
+        when(sut).catch_up_zones(...).thenReturn(self.dummy_datetime)
+        when(sut).is_need_backfill(ANY).thenReturn(False)
+        when(self.dummy_ds).recover_backfill_mode().thenAnswer(lambda: calls.append("recover"))
+        when(self.dummy_ds).enter_backfill_mode().thenAnswer(lambda: calls.append("enter"))
+        when(self.dummy_ds).exit_backfill_mode().thenAnswer(lambda: calls.append("exit"))
+        when(dummy_rollups).rebuild(ANY, ANY).thenAnswer(lambda start, end: calls.append("rebuild"))
+
+        result = sut.start_up(self.dummy_ds, self.dummy_client, dummy_rollups)
+
+        self.assertEqual(self.dummy_datetime, result)
+        self.assertEqual(["recover", "enter", "exit", "rebuild"], calls)
+        verify(sut, times=1).catch_up_zones({"zone1": start}, self.dummy_ds, self.dummy_client)
+        verify(dummy_rollups, times=1).rebuild(start, self.dummy_datetime)
+
+    def test_terminate(self):
+        with self.assertRaises(SystemExit) as context:
+            sut.terminate(15, None)
+
+        self.assertEqual(143, context.exception.code)
+
+    def test_main_for_sharding(self):
+        dummy_keeper = mock(leases.LeaseKeeper)
+        when(sut).create_lease_keeper(ANY).thenReturn(dummy_keeper)
+        when(dummy_keeper).owned_zones().thenReturn(["zone1"]).thenReturn(["zone1"]).thenReturn(["zone1", "zone2"])
+        when(dummy_keeper).stop()
+        when(self.dummy_ds).connect()
+        when(analytics_api).AnalyticsClient().thenReturn(self.dummy_client)
+        when(self.dummy_client).connect()
+        when(self.dummy_client).close()
+        when(sut).determine_zone_start_datetimes(ANY, ANY).thenReturn({"zone1": self.dummy_datetime})
+        when(sut).catch_up_zones(...).thenReturn(self.dummy_datetime)
+        when(sut).is_need_backfill(ANY).thenReturn(False)
+        when(sut).is_need_backfill_mode(ANY).thenReturn(False)
+        when(sut).still_active(ANY).thenReturn(True).thenReturn(True).thenReturn(False)
+        when(sut).run_fetch_and_push(...).thenReturn(self.dummy_datetime)
+        when(sut).verify_allowed_to_run(ANY)
+        when(sut).create_spool().thenReturn(None)
+        when(self.dummy_ds).recover_backfill_mode()
+
+        dummy_rollups = mock(rollup.Rollup)
+        when(rollup).Rollup(self.dummy_ds).thenReturn(dummy_rollups)
+        when(dummy_rollups).limit_zones(ANY)
+
+        with patch.multiple(config, metrics_enabled=False, es_rollup_enabled=True):
+            sut.main(self.dummy_ds)
+
+        verify(dummy_rollups, times=1).limit_zones(["zone1"])
+        verify(dummy_rollups, times=1).limit_zones(["zone1", "zone2"])
+        verify(sut, times=1).determine_zone_start_datetimes(self.dummy_ds, ["zone1"])
+        verify(sut, times=1).determine_zone_start_datetimes(self.dummy_ds, ["zone1", "zone2"])
+        verify(sut, times=1).run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, dummy_rollups,
+                                                None, ANY(scheduler.Scheduler), ["zone1"])
+        verify(sut, times=1).run_fetch_and_push(self.dummy_datetime, self.dummy_ds, self.dummy_client, dummy_rollups,
+                                                None, ANY(scheduler.Scheduler), ["zone1", "zone2"])
+        verify(self.dummy_ds, times=3).recover_backfill_mode()
+        verify(dummy_keeper, times=1).stop()
+
+    def test_recover_backfill_mode_for_error(self):
+        when(self.dummy_ds).recover_backfill_mode().thenRaise(Exception("TEST"))
+
+        sut.recover_backfill_mode(self.dummy_ds)
+
+        verify(self.dummy_ds, times=1).recover_backfill_mode()
+
+    def test_create_pipeline_runners(self):
+        settings = {"firewallEvents": {"enabled": True, "interval_in_seconds": 120, "window_in_seconds": 600}}
+
+        with patch.multiple(config, cf_pipelines=settings, sharding_enabled=False):
+            runners = sut.create_pipeline_runners(self.dummy_ds, self.dummy_client)
+        self.assertIsNone(runners[0].pipeline_leases)
+
+        with patch.multiple(config, cf_pipelines=settings, sharding_enabled=True):
+            runners = sut.create_pipeline_runners(self.dummy_ds, self.dummy_client)
+        self.assertEqual(["firewallEvents"], runners[0].pipeline_leases.zone_tags)
+        self.assertEqual(leases.PIPELINE_PREFIX, runners[0].pipeline_leases.prefix)
+
+    def test_create_lease_keeper_for_disabled_sharding(self):
+        with patch.multiple(config, sharding_enabled=False):
+            self.assertIsNone(sut.create_lease_keeper(self.dummy_ds))
+
+    def test_catch_up_zones_for_no_zones(self):
+        when(sut.dt_helper).latest_complete_datetime().thenReturn(self.dummy_datetime)
+
+        self.assertEqual(self.dummy_datetime, sut.catch_up_zones({}, self.dummy_ds, self.dummy_client))
 
     @staticmethod
     def test_verify_allowed_to_run():
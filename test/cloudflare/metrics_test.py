@@ -0,0 +1,99 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import unittest
+import urllib.error
+import urllib.request
+
+from mockito import when, unstub
+from cloudflare import metrics
+from cloudflare.metrics import Counter, Gauge, Histogram, MetricsServer
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.dummy_datetime = datetime.datetime.strptime("2022-09-20T12:12:00", "%Y-%m-%dT%H:%M:%S")
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        metrics.committed_datetime.set(None)
+        unstub()
+
+    def test_counter(self):
+        sut = Counter("dummy_total", "Dummy")
+
+        sut.inc()
+        sut.inc(41)
+
+        self.assertEqual(["# HELP dummy_total Dummy", "# TYPE dummy_total counter", "dummy_total 42"], sut.render())
+
+    def test_gauge(self):
+        sut = Gauge("dummy", "Dummy")
+        self.assertEqual(["# HELP dummy Dummy", "# TYPE dummy gauge"], sut.render())
+
+        sut.set(1.5)
+
+        self.assertEqual("dummy 1.5", sut.render()[-1])
+
+    def test_histogram(self):
+        sut = Histogram("dummy_seconds", "Dummy", buckets=(0.1, 1.0))
+
+        for value in 0.05, 0.1, 0.5, 2.0:
+            sut.observe(value)
+
+        self.assertEqual(['dummy_seconds_bucket{le="0.1"} 2', 'dummy_seconds_bucket{le="1.0"} 3',
+                          'dummy_seconds_bucket{le="+Inf"} 4', "dummy_seconds_sum 2.65", "dummy_seconds_count 4"],
+                         sut.render()[2:])
+
+    def test_timed(self):
+        histogram = Histogram("dummy_seconds", "Dummy")
+
+        result = metrics.timed(iter([1, 2, 3]), histogram)
+
+        self.assertEqual(0, sum(histogram.counts))
+        self.assertEqual([1, 2, 3], list(result))
+        self.assertEqual(1, sum(histogram.counts))
+
+    def test_lag(self):
+        when(metrics.dt_helper).current_ref_datetime().thenReturn(self.dummy_datetime)
+        self.assertIsNone(metrics.lag.get())
+
+        metrics.committed_datetime.set(self.dummy_datetime - datetime.timedelta(minutes=40))
+
+        self.assertEqual(2400.0, metrics.lag.get())
+        self.assertEqual(1663673520.0, metrics.committed_datetime.get())
+
+    def test_metrics_server(self):
+        sut = MetricsServer(port=0)
+        sut.start()
+        port = sut.server.server_address[1]
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                body = response.read().decode("utf-8")
+                content_type = response.headers.get("Content-Type")
+            with self.assertRaises(urllib.error.HTTPError) as ctx:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/narf")
+        finally:
+            sut.stop()
+
+        self.assertEqual(metrics.CONTENT_TYPE, content_type)
+        self.assertIn("# TYPE cfae_fetch_duration_seconds histogram", body)
+        self.assertIn("# TYPE cfae_lag_seconds gauge", body)
+        self.assertEqual(404, ctx.exception.code)
@@ -0,0 +1,240 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import unittest
+
+from unittest.mock import patch
+from mockito import when, mock, unstub, verify, ANY
+from cloudflare import config, pipelines
+from cloudflare.analytics_api import AnalyticsClient
+from cloudflare.datastore import DataStore
+from cloudflare.leases import ZoneLeases
+from cloudflare.scheduler import Scheduler
+
+
+class PipelinesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.dummy_datetime = datetime.datetime.strptime("2022-09-20T12:12:00", "%Y-%m-%dT%H:%M:%S")
+        self.dummy_ds = mock(DataStore)
+        self.dummy_client = mock(AnalyticsClient)
+        self.pipeline = pipelines.FirewallEventsPipeline(300, 900)
+        self.sut = pipelines.PipelineRunner(self.pipeline, self.dummy_ds, self.dummy_client)
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    def test_sum_up(self):
+        rows = [("zone1", "2022-09-20T12:12:00Z", "firewallEvent", "block/waf", 2),
+                ("zone1", "2022-09-20T12:12:30Z", "firewallEvent", "block/waf", 3),
+                ("zone1", "2022-09-20T12:13:00Z", "firewallEvent", "block/waf", None),
+                ("zone2", "2022-09-20T12:12:00Z", "firewallEvent", "block/waf", 1)]
+
+        with patch.multiple(config, zones={"zone1": "one", "zone2": "two"}):
+            docs = [doc.to_dict() for doc in pipelines.sum_up(rows)]
+
+        self.assertEqual([("zone1", "one", self.dummy_datetime, 5),
+                          ("zone1", "one", self.dummy_datetime + datetime.timedelta(minutes=1), 0),
+                          ("zone2", "two", self.dummy_datetime, 1)],
+                         [(doc.get("zoneTag"), doc.get("zoneName"), doc.get("@timestamp"), doc.get("requests"))
+                          for doc in docs])
+
+    def test_pipeline_rounds_to_minutes(self):
+        pipeline = pipelines.FirewallEventsPipeline(30, 150)
+
+        self.assertEqual(datetime.timedelta(minutes=1), pipeline.interval)
+        self.assertEqual(datetime.timedelta(minutes=2), pipeline.window)
+
+    def test_pipeline_is_abstract(self):
+        with self.assertRaises(TypeError):
+            pipelines.Pipeline(60, 60)
+
+    def test_data_types(self):
+        self.assertEqual(["firewallEvent", "workerInvocations", "workerErrors"], pipelines.DATA_TYPES)
+
+    def test_firewall_events(self):
+        result = {"viewer": {"zones": [{"zoneTag": "zone1", "firewallEventsAdaptiveGroups": [
+            {"count": 4, "dimensions": {"action": "block", "source": "waf", "datetimeMinute": "2022-09-20T12:12:00Z"}},
+            {"count": 1, "dimensions": {"action": "challenge", "source": "bic",
+                                        "datetimeMinute": "2022-09-20T12:12:00Z"}}]}]}}
+
+        with patch.multiple(config, zones={"zone1": "one"}):
+            queries = self.pipeline.create_queries(self.dummy_datetime,
+                                                   self.dummy_datetime + datetime.timedelta(minutes=15))
+            docs = list(self.pipeline.normalize(result))
+
+        self.assertEqual([{"limit": config.cf_query_limit, "mintime": "2022-09-20T12:12:00Z",
+                           "maxtime": "2022-09-20T12:27:00Z", "zoneIDs": ["zone1"]}], queries)
+        self.assertFalse(self.pipeline.is_truncated(result))
+        self.assertEqual([("firewallEvent", "block/waf", 4), ("firewallEvent", "challenge/bic", 1)],
+                         [(doc.get("dataType"), doc.get("dataKey"), doc.get("requests")) for doc in docs])
+
+    def test_firewall_events_for_zone_batches(self):
+        with patch.multiple(config, zones={"zone1": "one", "zone2": "two", "zone3": "three"},
+                            cf_max_zones_per_query=2):
+            queries = self.pipeline.create_queries(self.dummy_datetime,
+                                                   self.dummy_datetime + datetime.timedelta(minutes=15))
+
+        self.assertEqual([["zone1", "zone2"], ["zone3"]], [query.get("zoneIDs") for query in queries])
+
+    def test_firewall_events_is_truncated(self):
+        group = {"count": 1, "dimensions": {"action": "block", "source": "waf",
+                                            "datetimeMinute": "2022-09-20T12:12:00Z"}}
+        result = {"viewer": {"zones": [{"zoneTag": "zone1", "firewallEventsAdaptiveGroups": [group]},
+                                       {"zoneTag": "zone2", "firewallEventsAdaptiveGroups": [group, group]}]}}
+
+        with patch.multiple(config, cf_query_limit=2):
+            self.assertTrue(self.pipeline.is_truncated(result))
+        with patch.multiple(config, cf_query_limit=3):
+            self.assertFalse(self.pipeline.is_truncated(result))
+
+    def test_worker_invocations(self):
+        pipeline = pipelines.WorkerInvocationsPipeline(300, 900)
+        result = {"viewer": {"accounts": [{"workersInvocationsAdaptive": [
+            {"sum": {"requests": 10, "errors": 1},
+             "dimensions": {"scriptName": "api", "datetimeMinute": "2022-09-20T12:12:00Z"}}]}]}}
+
+        with patch.multiple(config, cf_account_tag="account1"):
+            parameters = pipeline.create_parameters(self.dummy_datetime, self.dummy_datetime)
+            docs = list(pipeline.normalize(result))
+
+        self.assertEqual("account1", parameters.get("accountTag"))
+        self.assertEqual([("account1", "workerInvocations", "api", 10), ("account1", "workerErrors", "api", 1)],
+                         [(doc.get("zoneTag"), doc.get("dataType"), doc.get("dataKey"), doc.get("requests"))
+                          for doc in docs])
+
+    def test_create_pipelines(self):
+        settings = {"firewallEvents": {"enabled": True, "interval_in_seconds": 120, "window_in_seconds": 600},
+                    "workerInvocations": {"enabled": False, "interval_in_seconds": 300, "window_in_seconds": 900}}
+
+        with patch.multiple(config, cf_pipelines=settings):
+            result = pipelines.create_pipelines()
+
+        self.assertEqual(1, len(result))
+        self.assertIsInstance(result[0], pipelines.FirewallEventsPipeline)
+        self.assertEqual(datetime.timedelta(minutes=10), result[0].window)
+
+    def test_determine_start_datetime(self):
+        when(self.dummy_ds).find_pipeline_checkpoint("firewallEvents").thenReturn(self.dummy_datetime)
+
+        self.assertEqual(self.dummy_datetime, self.sut.determine_start_datetime())
+
+    def test_determine_start_datetime_for_missing_checkpoint(self):
+        when(self.dummy_ds).find_pipeline_checkpoint("firewallEvents").thenReturn(None)
+        when(pipelines.dt_helper).latest_complete_datetime().thenReturn(self.dummy_datetime)
+
+        result = self.sut.determine_start_datetime()
+
+        self.assertEqual(self.dummy_datetime - datetime.timedelta(minutes=15), result)
+
+    def test_run_once(self):
+        expected_end = self.dummy_datetime + datetime.timedelta(minutes=15)
+        when(pipelines.dt_helper).latest_complete_datetime().thenReturn(
+            self.dummy_datetime + datetime.timedelta(hours=1))
+        when(self.dummy_client).execute(self.pipeline.query, ANY).thenReturn(
+            {"viewer": {"zones": [{"zoneTag": "zone1", "firewallEventsAdaptiveGroups": []}]}})
+        when(self.dummy_ds).store_documents(ANY).thenReturn(0)
+        when(self.dummy_ds).store_pipeline_checkpoint(...)
+
+        result = self.sut.run_once(self.dummy_datetime)
+
+        self.assertEqual(expected_end, result)
+        verify(self.dummy_ds, times=1).store_pipeline_checkpoint("firewallEvents", expected_end)
+
+    def test_run_once_for_truncated_result(self):
+        full = {"viewer": {"zones": [{"zoneTag": "zone1", "firewallEventsAdaptiveGroups": [
+            {"count": 1, "dimensions": {"action": "block", "source": "waf",
+                                        "datetimeMinute": "2022-09-20T12:12:00Z"}}]}]}}
+        empty = {"viewer": {"zones": [{"zoneTag": "zone1", "firewallEventsAdaptiveGroups": []}]}}
+        windows = []
+        when(pipelines.dt_helper).latest_complete_datetime().thenReturn(
+            self.dummy_datetime + datetime.timedelta(hours=1))
+        when(self.dummy_client).execute(self.pipeline.query, ANY).thenAnswer(
+            lambda query, parameters: windows.append((parameters.get("mintime"), parameters.get("maxtime"))) or
+            (full if parameters.get("mintime") == "2022-09-20T12:12:00Z" else empty))
+        when(self.dummy_ds).store_documents(ANY).thenAnswer(lambda docs: len(list(docs)))
+        when(self.dummy_ds).store_pipeline_checkpoint(...)
+
+        with patch.multiple(config, zones={"zone1": "one"}, cf_query_limit=1):
+            self.sut.run_once(self.dummy_datetime)
+
+        self.assertEqual([("2022-09-20T12:12:00Z", "2022-09-20T12:27:00Z"),
+                          ("2022-09-20T12:12:00Z", "2022-09-20T12:19:00Z"),
+                          ("2022-09-20T12:12:00Z", "2022-09-20T12:15:00Z"),
+                          ("2022-09-20T12:12:00Z", "2022-09-20T12:13:00Z"),
+                          ("2022-09-20T12:13:00Z", "2022-09-20T12:15:00Z"),
+                          ("2022-09-20T12:15:00Z", "2022-09-20T12:19:00Z"),
+                          ("2022-09-20T12:19:00Z", "2022-09-20T12:27:00Z")], windows)
+        verify(self.dummy_ds, times=1).store_pipeline_checkpoint(
+            "firewallEvents", self.dummy_datetime + datetime.timedelta(minutes=15))
+
+    def test_run_once_for_up2date_window(self):
+        expected_end = self.dummy_datetime + datetime.timedelta(minutes=5)
+        when(pipelines.dt_helper).latest_complete_datetime().thenReturn(expected_end)
+        when(self.dummy_client).execute(...).thenReturn({"viewer": {"zones": []}})
+        when(self.dummy_ds).store_documents(ANY).thenReturn(0)
+        when(self.dummy_ds).store_pipeline_checkpoint(...)
+
+        self.assertEqual(expected_end, self.sut.run_once(self.dummy_datetime))
+
+    def test_run_once_for_error(self):
+        when(pipelines.dt_helper).latest_complete_datetime().thenReturn(
+            self.dummy_datetime + datetime.timedelta(hours=1))
+        when(self.dummy_client).execute(...).thenRaise(Exception("TEST"))
+        when(self.sut.schedule).failed()
+
+        result = self.sut.run_once(self.dummy_datetime)
+
+        self.assertEqual(self.dummy_datetime, result)
+        verify(self.sut.schedule, times=1).failed()
+        verify(self.dummy_ds, times=0).store_pipeline_checkpoint(...)
+
+    def test_stop_interrupts_waiting(self):
+        when(self.dummy_ds).find_pipeline_checkpoint(...).thenReturn(self.dummy_datetime)
+        when(pipelines.dt_helper).current_ref_datetime().thenReturn(self.dummy_datetime)
+
+        self.sut.start()
+        self.sut.stop()
+
+        self.assertFalse(self.sut.is_alive())
+        verify(self.dummy_client, times=0).execute(...)
+
+    def test_run_without_lease(self):
+        dummy_leases = mock(ZoneLeases)
+        sut = pipelines.PipelineRunner(self.pipeline, self.dummy_ds, self.dummy_client, dummy_leases)
+        when(dummy_leases).refresh().thenAnswer(lambda: sut.stopped.set() or [])
+
+        sut.run()
+
+        verify(self.dummy_ds, times=0).find_pipeline_checkpoint(...)
+        verify(self.dummy_client, times=0).execute(...)
+
+    def test_is_owner(self):
+        dummy_leases = mock(ZoneLeases)
+        when(dummy_leases).refresh().thenReturn(["firewallEvents"]).thenRaise(Exception("TEST"))
+        sut = pipelines.PipelineRunner(self.pipeline, self.dummy_ds, self.dummy_client, dummy_leases)
+
+        self.assertTrue(self.sut.is_owner())
+        self.assertTrue(sut.is_owner())
+        self.assertFalse(sut.is_owner())
+
+    def test_runner_uses_interruptible_backoff(self):
+        self.assertIsInstance(self.sut.schedule, Scheduler)
+        self.assertEqual(self.sut.stopped.wait, self.sut.schedule.sleep)
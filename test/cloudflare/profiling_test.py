@@ -0,0 +1,96 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+from unittest.mock import patch
+from mockito import when, unstub
+from cloudflare import config, profiling
+from cloudflare.profiling import NoProfiler, Profiler
+
+
+class ProfilingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.profile_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        self.profile_dir.cleanup()
+        unstub()
+
+    def _dumps(self, suffix):
+        return sorted(name for name in os.listdir(self.profile_dir.name) if name.endswith(suffix))
+
+    def test_create_profiler_for_disabled_profiling(self):
+        with patch.dict(os.environ, {}, clear=True):
+            result = profiling.create_profiler()
+
+        self.assertIsInstance(result, NoProfiler)
+        with result.iteration():
+            with result.span("dummy"):
+                pass
+
+    def test_create_profiler(self):
+        with patch.dict(os.environ, {config.profile_dir_env: self.profile_dir.name, config.profile_every_env: "5",
+                                     config.profile_slow_threshold_env: "2.5"}):
+            result = profiling.create_profiler()
+
+        self.assertIsInstance(result, Profiler)
+        self.assertEqual(5, result.every)
+        self.assertEqual(2.5, result.slow_threshold_in_seconds)
+
+    def test_iteration_for_periodic_dump(self):
+        sut = Profiler(self.profile_dir.name, every=2, slow_threshold_in_seconds=60)
+
+        for _ in range(4):
+            with sut.iteration():
+                with sut.span("fetch"):
+                    sum(range(1000))
+
+        self.assertEqual(2, len(self._dumps("-periodic.pstats")))
+        self.assertEqual(2, len(self._dumps("-periodic.txt")))
+        self.assertIn("fetch", sut.spans)
+        pstats.Stats(os.path.join(self.profile_dir.name, self._dumps(".pstats")[0]))
+
+    def test_iteration_for_slow_iteration(self):
+        sut = Profiler(self.profile_dir.name, every=0, slow_threshold_in_seconds=0)
+
+        with self.assertRaises(Exception):
+            with sut.iteration():
+                with sut.span("index"):
+                    raise Exception("TEST")
+
+        self.assertEqual(1, len(self._dumps("-slow.pstats")))
+        with open(os.path.join(self.profile_dir.name, self._dumps("-slow.txt")[0])) as f:
+            self.assertIn("index: ", f.read())
+
+    def test_span(self):
+        sut = Profiler(self.profile_dir.name)
+        when(time).perf_counter().thenReturn(1.0).thenReturn(1.5).thenReturn(2.0).thenReturn(2.25)
+
+        with sut.span("fetch"):
+            pass
+        with sut.span("fetch"):
+            pass
+
+        self.assertEqual({"fetch": 0.75}, sut.spans)
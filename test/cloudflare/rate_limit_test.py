@@ -0,0 +1,133 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import email.utils
+import time
+import unittest
+
+import requests
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+from unittest.mock import patch
+from mockito import when, unstub
+from cloudflare import config, rate_limit
+from cloudflare.rate_limit import TokenBucket, RateLimitError
+
+
+class RateLimitTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.now = 1000.0
+        when(time).monotonic().thenAnswer(lambda: self.now)
+        self.sut = TokenBucket(10, 20)
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    @staticmethod
+    def _create_server_error(code, headers=None):
+        response = requests.Response()
+        response.status_code = code
+        response.headers.update(headers or {})
+        try:
+            try:
+                raise requests.HTTPError("TEST", response=response)
+            except requests.HTTPError as e:
+                raise TransportServerError(str(e), code) from e
+        except TransportServerError as e:
+            return e
+
+    def test_try_acquire(self):
+        results = [self.sut.try_acquire() for _ in range(11)]
+
+        self.assertEqual([0.0] * 10, results[:10])
+        self.assertEqual(2.0, results[10])
+        self.assertEqual(0.0, self.sut.remaining())
+
+    def test_try_acquire_for_refill(self):
+        for _ in range(10):
+            self.sut.try_acquire()
+
+        self.now += 4
+
+        self.assertEqual(2.0, self.sut.remaining())
+        self.assertEqual(0.0, self.sut.try_acquire())
+        self.now += 100
+        self.assertEqual(10.0, self.sut.remaining())
+
+    def test_block(self):
+        self.sut.block(30)
+
+        self.assertEqual(0.0, self.sut.remaining())
+        self.assertEqual(30.0, self.sut.try_acquire())
+        self.now += 30
+        self.assertEqual(0.0, self.sut.try_acquire())
+
+    def test_acquire(self):
+        sleeps = []
+
+        def dummy_sleep(seconds):
+            sleeps.append(seconds)
+            self.now += seconds
+
+        when(time).sleep(...).thenAnswer(dummy_sleep)
+        self.sut.block(5)
+
+        self.sut.acquire()
+
+        self.assertEqual([5.0], sleeps)
+
+    def test_parse_retry_after(self):
+        retry_at = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=120)
+
+        self.assertEqual(30.0, rate_limit.parse_retry_after("30"))
+        self.assertAlmostEqual(120, rate_limit.parse_retry_after(email.utils.format_datetime(retry_at)), delta=2)
+        self.assertIsNone(rate_limit.parse_retry_after("narf"))
+        self.assertIsNone(rate_limit.parse_retry_after(None))
+
+    def test_is_rate_limit_error(self):
+        self.assertTrue(rate_limit.is_rate_limit_error(self._create_server_error(429)))
+        self.assertFalse(rate_limit.is_rate_limit_error(self._create_server_error(500)))
+        self.assertTrue(rate_limit.is_rate_limit_error(TransportQueryError(
+            "TEST", errors=[{"message": "rate limiter budget depleted, try again after 5 minutes"}])))
+        self.assertFalse(rate_limit.is_rate_limit_error(TransportQueryError("TEST", errors=[{"message": "narf"}])))
+        self.assertFalse(rate_limit.is_rate_limit_error(Exception("rate limit")))
+
+    def test_handle_error(self):
+        result = rate_limit.handle_error(self.sut, self._create_server_error(429, {"Retry-After": "42"}))
+
+        self.assertIsInstance(result, RateLimitError)
+        self.assertEqual(42.0, result.retry_after_in_seconds)
+        self.assertEqual(42.0, self.sut.try_acquire())
+
+    def test_handle_error_for_missing_retry_after(self):
+        with patch.multiple(config, cf_rate_limit_pause_in_seconds=90):
+            result = rate_limit.handle_error(self.sut, TransportQueryError(
+                "TEST", errors=[{"message": "rate limiter budget depleted"}]))
+
+        self.assertIsInstance(result, RateLimitError)
+        self.assertEqual(90, result.retry_after_in_seconds)
+
+    def test_handle_error_for_other_error(self):
+        error = Exception("TEST")
+
+        result = rate_limit.handle_error(self.sut, error)
+
+        self.assertIs(error, result)
+        self.assertEqual(0.0, self.sut.try_acquire())
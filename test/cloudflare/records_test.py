@@ -0,0 +1,74 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import unittest
+
+from cloudflare import records
+from cloudflare.datastore import DataStore
+from cloudflare.records import AnalyticsRecord, BulkBodyWriter
+
+
+class RecordsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.dummy_datetime = datetime.datetime.strptime("2022-09-20T12:12:00", "%Y-%m-%dT%H:%M:%S")
+        self.sut = AnalyticsRecord("country", "Germany", "zone1", "domain.tld", self.dummy_datetime,
+                                   "2022-09-20T12:12:00", requests=5, bytes=None)
+
+    def test_get(self):
+        self.assertEqual("Germany", self.sut.get("dataKey"))
+        self.assertEqual(self.dummy_datetime, self.sut.get("@timestamp"))
+        self.assertEqual(5, self.sut.get("requests"))
+        self.assertIsNone(self.sut.get("invalid"))
+
+    def test_to_json(self):
+        expected_result = dict(self.sut.to_dict(), **{"@timestamp": "2022-09-20T12:12:00"})
+
+        result = json.loads(self.sut.to_json())
+
+        self.assertEqual(expected_result, result)
+
+    def test_to_json_for_special_characters(self):
+        record = AnalyticsRecord("browser", 'Quote"Browser\\', "zone1", None, self.dummy_datetime,
+                                 "2022-09-20T12:12:00", page_views=1)
+
+        result = json.loads(record.to_json())
+
+        self.assertEqual('Quote"Browser\\', result.get("dataKey"))
+        self.assertIsNone(result.get("zoneName"))
+
+    def test_document_id(self):
+        self.assertEqual(DataStore.create_document_id(self.sut.to_dict()), self.sut.document_id())
+
+    def test_to_source(self):
+        self.assertEqual(self.sut.to_dict(), records.to_source(self.sut))
+        self.assertEqual({"data": "dummy"}, records.to_source({"data": "dummy"}))
+
+    def test_bulk_body_writer_chunks(self):
+        writer = BulkBodyWriter("dummy-index", "index", 600)
+
+        result = list(writer.chunks([self.sut, self.sut.to_dict(), self.sut]))
+
+        self.assertEqual(2, len(result))
+        self.assertEqual(3, sum(doc_amount for _, doc_amount in result))
+        lines = b"".join(body for body, _ in result).decode("utf-8").splitlines()
+        self.assertEqual(6, len(lines))
+        self.assertEqual(lines[1], lines[3])
+        self.assertEqual({"index": {"_index": "dummy-index", "_id": self.sut.document_id()}}, json.loads(lines[0]))
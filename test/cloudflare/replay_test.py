@@ -0,0 +1,88 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import tempfile
+import unittest
+
+from unittest.mock import patch
+from mockito import when, mock, unstub, verify, ANY
+from cloudflare import config, datastore, replay
+from cloudflare.capture import Capture
+from test.fixtures import create_dummy_response
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.capture_dir = tempfile.TemporaryDirectory()
+        self.capture = Capture(self.capture_dir.name)
+        self.dummy_ds = mock(datastore.DataStore)
+        self.dummy_start = datetime.datetime.strptime("2022-09-30T10:00:00", "%Y-%m-%dT%H:%M:%S")
+        self.stored = []
+        when(self.dummy_ds).store_documents(docs=ANY).thenAnswer(lambda docs: self._store(docs))
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        self.capture_dir.cleanup()
+        unstub()
+
+    def _store(self, docs):
+        docs = list(docs)
+        self.stored.append(docs)
+        return len(docs)
+
+    def _capture_windows(self, amount):
+        for minute in range(amount):
+            window_start = self.dummy_start + datetime.timedelta(minutes=minute)
+            self.capture.store(window_start, window_start + datetime.timedelta(seconds=61), ["zone1"],
+                               create_dummy_response())
+
+    def test_parse_datetime(self):
+        self.assertEqual(datetime.datetime(2022, 9, 1), replay.parse_datetime("2022-09-01"))
+        self.assertEqual(datetime.datetime(2022, 9, 1, 10, 5), replay.parse_datetime("2022-09-01T10:05"))
+        with self.assertRaises(Exception):
+            replay.parse_datetime("narf")
+
+    def test_replay(self):
+        self._capture_windows(5)
+        windows = self.capture.segments(self.dummy_start, self.dummy_start + datetime.timedelta(hours=1))
+
+        result = replay.replay(self.dummy_ds, windows, batch_size=2, max_workers=2)
+
+        self.assertEqual(5 * 106, result)
+        self.assertEqual([106, 212, 212], sorted(len(docs) for docs in self.stored))
+        verify(self.dummy_ds, times=0).store_checkpoint(...)
+
+    def test_main(self):
+        self._capture_windows(3)
+        when(self.dummy_ds).connect()
+
+        with patch.multiple(config, es_rollup_enabled=False):
+            result = replay.main(self.dummy_ds, ["--from", "2022-09-30T10:01", "--to", "2022-10-01",
+                                                 "--capture-dir", self.capture_dir.name])
+
+        self.assertEqual(2 * 106, result)
+        verify(self.dummy_ds, times=1).connect()
+
+    def test_main_for_missing_capture(self):
+        result = replay.main(self.dummy_ds, ["--from", "2022-09-30", "--to", "2022-10-01",
+                                             "--capture-dir", self.capture_dir.name])
+
+        self.assertEqual(0, result)
+        verify(self.dummy_ds, times=0).connect()
@@ -0,0 +1,160 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import unittest
+
+from mockito import when, mock, unstub, verify, ANY
+from cloudflare import datastore
+from cloudflare.records import METRIC_FIELDS
+from cloudflare.rollup import Rollup
+from cloudflare.pipelines import DATA_TYPES
+
+
+class RollupTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.dummy_ds = mock(datastore.DataStore)
+        self.sut = Rollup(self.dummy_ds)
+        self.dummy_hour = datetime.datetime.strptime("2022-09-20T12:00:00", "%Y-%m-%dT%H:%M:%S")
+        self.stored = {"1h": {}, "1d": {}}
+
+        def dummy_store_rollups(interval, docs):
+            for doc in docs:
+                self.stored[interval][(doc.get("@timestamp"), doc.get("zoneTag"), doc.get("dataKey"))] = doc
+
+        when(self.dummy_ds).store_rollups(ANY, ANY).thenAnswer(dummy_store_rollups)
+        when(self.dummy_ds).aggregate_documents(...).thenReturn([])
+        when(self.dummy_ds).refresh_documents()
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    def _create_doc(self, minute, requests, data_key="200"):
+        return {"zoneTag": "zone1", "dataType": "responseStatus", "dataKey": data_key,
+                "@timestamp": self.dummy_hour + datetime.timedelta(minutes=minute), "requests": requests}
+
+    def _process_window(self, start_minute, docs):
+        start = self.dummy_hour + datetime.timedelta(minutes=start_minute)
+        result = list(self.sut.track(docs, start))
+        self.sut.commit(start + datetime.timedelta(seconds=61))
+        return result
+
+    def test_track_and_commit(self):
+        docs = [self._create_doc(0, 5), self._create_doc(1, 7)]
+
+        result = self._process_window(0, docs)
+
+        self.assertEqual(docs, result)
+        self.assertEqual(12, self.stored["1h"][(self.dummy_hour, "zone1", "200")].get("requests"))
+        self.assertEqual(12, self.stored["1d"][(self.dummy_hour - datetime.timedelta(hours=12), "zone1", "200")]
+                         .get("requests"))
+
+    def test_commit_for_overlapping_windows(self):
+        self._process_window(0, [self._create_doc(0, 5), self._create_doc(1, 7)])
+        self._process_window(1, [self._create_doc(1, 7), self._create_doc(2, 1)])
+
+        self.assertEqual(13, self.stored["1h"][(self.dummy_hour, "zone1", "200")].get("requests"))
+
+    def test_track_for_restart_within_hour(self):
+        seeded_metrics = [100 if field == "requests" else 0 for field in METRIC_FIELDS]
+        window_start = self.dummy_hour + datetime.timedelta(minutes=30)
+        when(self.dummy_ds).aggregate_documents(self.dummy_hour, window_start, "1h", METRIC_FIELDS, None,
+                                                DATA_TYPES)\
+            .thenReturn([(self.dummy_hour, ("zone1", "responseStatus", "200"), seeded_metrics)])
+
+        self._process_window(30, [self._create_doc(30, 5)])
+
+        self.assertEqual(105, self.stored["1h"][(self.dummy_hour, "zone1", "200")].get("requests"))
+        verify(self.dummy_ds, times=1).aggregate_documents(self.dummy_hour, window_start, "1h", METRIC_FIELDS, None,
+                                                           DATA_TYPES)
+        verify(self.dummy_ds, times=1).aggregate_documents(self.dummy_hour - datetime.timedelta(hours=12),
+                                                           self.dummy_hour, "1d", METRIC_FIELDS, None, DATA_TYPES)
+        verify(self.dummy_ds, times=1).refresh_documents()
+
+    def test_commit_for_failed_rollups(self):
+        failed_since = self.dummy_hour + datetime.timedelta(minutes=5)
+        self.sut.mark_failed(failed_since + datetime.timedelta(minutes=1))
+        self.sut.mark_failed(failed_since)
+        when(self.sut).rebuild(ANY, ANY)
+
+        self._process_window(6, [self._create_doc(6, 5)])
+
+        self.assertIsNone(self.sut.failed_since)
+        self.assertEqual({}, self.sut.pending)
+        verify(self.sut, times=1).rebuild(failed_since, self.dummy_hour + datetime.timedelta(minutes=6, seconds=61))
+
+    def test_commit_evicts_completed_hours(self):
+        self._process_window(59, [self._create_doc(59, 5), self._create_doc(60, 1)])
+
+        self.assertNotIn(self.dummy_hour, self.sut.hours)
+        self.assertIn(self.dummy_hour + datetime.timedelta(hours=1), self.sut.hours)
+
+    def test_track_without_commit(self):
+        self._process_window(0, [self._create_doc(0, 5)])
+        list(self.sut.track([self._create_doc(1, 7)], self.dummy_hour + datetime.timedelta(minutes=1)))
+        self._process_window(1, [self._create_doc(1, 7)])
+
+        self.assertEqual(12, self.stored["1h"][(self.dummy_hour, "zone1", "200")].get("requests"))
+
+    def test_rebuild(self):
+        end = self.dummy_hour + datetime.timedelta(hours=2)
+        metrics = [1 for _ in METRIC_FIELDS]
+        when(self.dummy_ds).aggregate_documents(ANY, end, "1h", METRIC_FIELDS, None, DATA_TYPES).thenReturn(
+            [(self.dummy_hour, ("zone1", "country", "Germany"), metrics),
+             (self.dummy_hour + datetime.timedelta(hours=1), ("zone1", "country", "Germany"), metrics)])
+
+        self.sut.rebuild(self.dummy_hour, end)
+
+        self.assertEqual(2, len(self.stored["1h"]))
+        self.assertEqual("1h", self.stored["1h"][(self.dummy_hour, "zone1", "Germany")].get("interval"))
+        verify(self.dummy_ds, times=1).refresh_documents()
+
+    # documents of the same bucket in old and new indices are aggregated separately
+    def test_rebuild_for_repeated_group(self):
+        end = self.dummy_hour + datetime.timedelta(hours=1)
+        when(self.dummy_ds).aggregate_documents(ANY, end, "1h", METRIC_FIELDS, None, DATA_TYPES).thenReturn(
+            [(self.dummy_hour, ("zone1", "country", "Germany"), [1 for _ in METRIC_FIELDS]),
+             (self.dummy_hour, ("zone1", "country", "Germany"), [2 for _ in METRIC_FIELDS])])
+
+        self.sut.rebuild(self.dummy_hour, end)
+
+        self.assertEqual(3, self.stored["1h"][(self.dummy_hour, "zone1", "Germany")].get("requests"))
+
+    def test_limit_zones(self):
+        self._process_window(0, [self._create_doc(0, 5)])
+        self.sut.limit_zones(["zone2"])
+        other_doc = dict(self._create_doc(1, 7), zoneTag="zone2")
+
+        result = self._process_window(1, [self._create_doc(1, 3), other_doc])
+
+        self.assertEqual(2, len(result))
+        self.assertEqual(5, self.stored["1h"][(self.dummy_hour, "zone1", "200")].get("requests"))
+        self.assertEqual(7, self.stored["1h"][(self.dummy_hour, "zone2", "200")].get("requests"))
+        verify(self.dummy_ds, times=1).aggregate_documents(self.dummy_hour, self.dummy_hour + datetime.timedelta(
+            minutes=1), "1h", METRIC_FIELDS, {"zone2"}, DATA_TYPES)
+
+    def test_rebuild_for_limited_zones(self):
+        end = self.dummy_hour + datetime.timedelta(hours=1)
+        self.sut.limit_zones(["zone1"])
+
+        self.sut.rebuild(self.dummy_hour, end)
+
+        verify(self.dummy_ds, times=1).aggregate_documents(self.dummy_hour, end, "1h", METRIC_FIELDS, {"zone1"},
+                                                           DATA_TYPES)
@@ -0,0 +1,104 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import random
+import time
+import unittest
+
+from mockito import when, unstub, verify, ANY
+from unittest.mock import patch
+from cloudflare import config
+from cloudflare import scheduler
+from cloudflare.scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        with patch.multiple(config, cf_retry_backoff_base_in_seconds=5, cf_retry_backoff_max_in_seconds=60):
+            self.sut = Scheduler()
+        self.dummy_datetime = datetime.datetime.strptime("2022-09-20T12:12:00", "%Y-%m-%dT%H:%M:%S")
+        when(time).sleep(ANY)
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        unstub()
+
+    def test_wait_until_fetchable(self):
+        when(scheduler.dt_helper).seconds_until_fetchable(self.dummy_datetime).thenReturn(12.5)
+
+        result = self.sut.wait_until_fetchable(self.dummy_datetime)
+
+        self.assertEqual(12.5, result)
+        verify(time, times=1).sleep(12.5)
+
+    def test_wait_until_fetchable_for_catchup(self):
+        when(scheduler.dt_helper).seconds_until_fetchable(self.dummy_datetime).thenReturn(0.0)
+
+        result = self.sut.wait_until_fetchable(self.dummy_datetime)
+
+        self.assertEqual(0.0, result)
+        verify(time, times=0).sleep(ANY)
+
+    def test_wait_until_fetchable_for_custom_sleep(self):
+        sleeps = []
+        sut = Scheduler(sleep=sleeps.append)
+        when(scheduler.dt_helper).seconds_until_fetchable(self.dummy_datetime).thenReturn(12.5)
+
+        sut.wait_until_fetchable(self.dummy_datetime)
+
+        self.assertEqual([12.5], sleeps)
+        verify(time, times=0).sleep(...)
+
+    def test_failed(self):
+        when(random).uniform(ANY, ANY).thenAnswer(lambda low, high: high)
+
+        delays = [self.sut.failed() for _ in range(6)]
+
+        self.assertEqual([5, 10, 20, 40, 60, 60], delays)
+        self.assertEqual(6, self.sut.failures)
+        verify(time, times=2).sleep(60)
+
+    def test_failed_for_jitter(self):
+        when(random).uniform(ANY, ANY).thenReturn(0.0)
+
+        self.sut.failed()
+        result = self.sut.failed()
+
+        self.assertEqual(5.0, result)
+
+    def test_failed_for_custom_sleep(self):
+        sleeps = []
+        with patch.multiple(config, cf_retry_backoff_base_in_seconds=5, cf_retry_backoff_max_in_seconds=60):
+            sut = Scheduler(sleep=sleeps.append)
+        when(random).uniform(ANY, ANY).thenAnswer(lambda low, high: high)
+
+        sut.failed()
+
+        self.assertEqual([5], sleeps)
+        verify(time, times=0).sleep(...)
+
+    def test_succeeded(self):
+        self.sut.failed()
+        self.sut.failed()
+
+        self.sut.succeeded()
+
+        self.assertEqual(0, self.sut.failures)
+        self.assertTrue(2.5 <= self.sut.failed() <= 5)
@@ -0,0 +1,138 @@
+# Copyright (C) 2022, Martin Drößler <m.droessler@handelsblattgroup.com>
+# Copyright (C) 2022, Handelsblatt GmbH
+#
+# This file is part of cloudflare-analytics-exporter
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import os
+import tempfile
+import unittest
+import elasticsearch
+
+from mockito import when, mock, unstub, verify, ANY
+from cloudflare import analytics_api, datastore
+from cloudflare.segments import read_segment
+from cloudflare.spool import Spool
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self) -> None:
+        unittest.TestCase.setUp(self)
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.sut = Spool(spool_dir=self.spool_dir.name, max_bytes=1024 * 1024)
+        self.dummy_ds = mock(datastore.DataStore)
+        self.dummy_start = datetime.datetime.strptime("2022-09-20T12:12:00", "%Y-%m-%dT%H:%M:%S")
+        self.dummy_end = self.dummy_start + datetime.timedelta(seconds=61)
+        self.dummy_result = {"viewer": {"zones": [{"zoneTag": "zone1", "httpRequests1mGroups": []}]}}
+
+    def tearDown(self) -> None:
+        unittest.TestCase.tearDown(self)
+        self.spool_dir.cleanup()
+        unstub()
+
+    def test_append(self):
+        result = self.sut.append(self.dummy_start, self.dummy_end, self.dummy_result)
+
+        self.assertTrue(result)
+        segments = self.sut.segments()
+        self.assertEqual(1, len(segments))
+        self.assertEqual(self.dummy_start, segments[0][0])
+        self.assertEqual(self.dummy_end, segments[0][1])
+        self.assertEqual(self.dummy_result, read_segment(segments[0][2]))
+        self.assertEqual(["20220920T121200_20220920T121301.json.gz"], os.listdir(self.spool_dir.name))
+
+    def test_append_for_full_spool(self):
+        self.sut.max_bytes = 10
+
+        result = self.sut.append(self.dummy_start, self.dummy_end, self.dummy_result)
+
+        self.assertFalse(result)
+        self.assertEqual([], self.sut.segments())
+
+    def test_committed_datetime(self):
+        later_end = self.dummy_end + datetime.timedelta(minutes=5)
+        self.assertEqual(later_end, self.sut.committed_datetime(later_end))
+
+        self.sut.append(self.dummy_start, self.dummy_end, self.dummy_result)
+
+        self.assertEqual(self.dummy_start, self.sut.committed_datetime(later_end))
+
+    def test_drain(self):
+        second_start = self.dummy_start + datetime.timedelta(minutes=1)
+        second_end = self.dummy_end + datetime.timedelta(minutes=1)
+        self.sut.append(self.dummy_start, self.dummy_end, self.dummy_result)
+        self.sut.append(second_start, second_end, self.dummy_result)
+        when(analytics_api).normalize(ANY).thenReturn([{"doc": 1}])
+        stored = []
+        when(self.dummy_ds).store_documents(docs=ANY).thenAnswer(lambda docs: stored.append(list(docs)) or 1)
+
+        self.sut.drain(self.dummy_ds, batch_size=1)
+
+        self.assertEqual([[{"doc": 1}], [{"doc": 1}]], stored)
+        self.assertEqual([], self.sut.segments())
+        self.assertEqual([(self.dummy_start, self.dummy_end), (second_start, second_end)], self.sut.pop_drained())
+        self.assertEqual([], self.sut.pop_drained())
+
+    def test_drain_for_unavailable_elasticsearch(self):
+        self.sut.append(self.dummy_start, self.dummy_end, self.dummy_result)
+        when(self.dummy_ds).store_documents(docs=ANY).thenRaise(elasticsearch.ConnectionError("TEST"))
+
+        with self.assertRaises(elasticsearch.ConnectionError):
+            self.sut.drain(self.dummy_ds)
+
+        self.assertEqual(1, len(self.sut.segments()))
+        self.assertEqual({}, self.sut.failures)
+        self.assertEqual([], self.sut.pop_drained())
+        verify(self.dummy_ds, times=1).store_documents(docs=ANY)
+
+    def test_drain_for_error(self):
+        self.sut.max_failures = 2
+        self.sut.append(self.dummy_start, self.dummy_end, self.dummy_result)
+        when(self.dummy_ds).store_documents(docs=ANY).thenRaise(Exception("TEST"))
+
+        self.sut.drain(self.dummy_ds)
+
+        self.assertEqual(1, len(self.sut.segments()))
+        self.assertEqual([], self.sut.pop_drained())
+
+        self.sut.drain(self.dummy_ds)
+
+        self.assertEqual([], self.sut.segments())
+        self.assertEqual({}, self.sut.failures)
+        self.assertEqual(["20220920T121200_20220920T121301.json.gz"],
+                         os.listdir(os.path.join(self.spool_dir.name, "quarantine")))
+        verify(self.dummy_ds, times=2).store_documents(docs=ANY)
+
+    def test_drain_for_broken_segment_in_batch(self):
+        second_start = self.dummy_start + datetime.timedelta(minutes=1)
+        second_end = self.dummy_end + datetime.timedelta(minutes=1)
+        self.sut.append(self.dummy_start, self.dummy_end, {"broken": True})
+        self.sut.append(second_start, second_end, self.dummy_result)
+
+        def store(docs):
+            docs = list(docs)
+            if {"broken": True} in docs:
+                raise Exception("TEST")
+            return len(docs)
+
+        when(analytics_api).normalize(ANY).thenAnswer(lambda result: [result])
+        when(self.dummy_ds).store_documents(docs=ANY).thenAnswer(store)
+
+        self.sut.drain(self.dummy_ds, batch_size=2)
+
+        self.assertEqual([(second_start, second_end)], self.sut.pop_drained())
+        self.assertEqual([self.dummy_start], [start for start, _, _ in self.sut.segments()])
+        self.assertEqual(1, list(self.sut.failures.values())[0])